@@ -19,7 +19,8 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 For more details, see the LICENSE file.
 """
 
-from lib import *
+from lib_display import *
+from lib_audio import audio
 
 display()
 audio() # TODO: Consider if this is the right place for this?
@@ -3,7 +3,9 @@
 """
 lib.py: MIDI Pipes - A standalone MIDI processing and routing system
 
-Shared library for MIDI Pipes
+Shared library for MIDI Pipes (core: logging, settings, locking)
+
+Kept free of heavy imports, routing, audio, display and web live in lib_*.py
 
 Copyright (C) 2024 imprecision
 
@@ -23,391 +25,719 @@ import sys
 import subprocess
 import re
 import os
-from inky import InkyWHAT
-from PIL import Image, ImageFont, ImageDraw
-from font_source_sans_pro import SourceSansProSemibold, SourceSansProLight, SourceSansPro, SourceSansProBold
+import time
+import json
+import socket
+import threading
+import queue
+import fcntl
+import errno
+import atexit
+from contextlib import contextmanager
+from collections import deque
 from datetime import datetime, timezone
 
-import qrcode
-
-import socket
-import psutil
+file_log = "/tmp/midi-log.txt"
+file_settings = "/tmp/midi-settings.json" # Working copy (this boot, shared between processes)
+file_settings_persistent = next((path + "/midipipes-settings.json" for path in ("/boot/firmware", "/boot") if os.path.isdir(path)), None) # Survives the read-only overlay
+file_lock = "/tmp/midi-lock.txt"
+file_profile = "/tmp/midi-profile.txt"
+dir_tools = os.environ.get("MIDIPIPES_TOOLS", "") # Directory of stand-ins for the system tools (see dev/bench/standins)
 
-import json
+class Logger:
+    """
+    Log with a timestamp per entry.
 
-display_mode = "colourful" # "fast" or "colourful" (slower)
-display_title = "MIDI Pipes"
-file_log = "/tmp/midi-log.txt"
-file_last = "/tmp/midi-last.txt"
-file_settings = "/tmp/midi-settings.json"
-current_datetime = datetime.now(timezone.utc)
-names = [] # Contains the list of MIDI devices found
+    The last `keep` entries stay in memory (ring buffer, served by /logs), every
+    entry is appended to file_log through one open file handle, which is rotated
+    to file_log + ".1" when it reaches `max_bytes` (the file lives in RAM on the
+    read-only overlay).
+    """
 
-def getsize(font, text):
-    _, _, right, bottom = font.getbbox(text)
-    return (right, bottom)
+    def __init__(self, keep = 1000, max_bytes = 256 * 1024):
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.entries = deque(maxlen=keep)
+        self.next_id = 1
+        self.file = None
+        self.path = None
+        self.size = 0
+
+    def write(self, msg):
+        entry = {"id": 0, "time": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), "msg": msg}
+
+        with self.cond:
+            entry["id"] = self.next_id
+            self.next_id += 1
+            self.entries.append(entry)
+            self._append(entry["time"] + "\t" + msg + "\n")
+            self.cond.notify_all()
+
+    def _append(self, line):
+        try:
+            if self.file is not None and (self.path != file_log or self.size + len(line) > self.max_bytes):
+                self.file.close()
+                self.file = None
+                if self.path == file_log:
+                    os.replace(file_log, file_log + ".1")
+
+            if self.file is None:
+                set_perms = not os.path.exists(file_log)
+                self.path = file_log
+                self.file = open(file_log, "a")
+                if set_perms:
+                    os.chmod(file_log, 0o777)
+
+            self.file.write(line)
+            self.file.flush()
+            self.size = self.file.tell() # Includes lines appended by other processes
+        except OSError:
+            pass # The log file is a copy, never fail the caller over it
+
+    def tail(self, count = 100):
+        """
+        Returns the last `count` entries (at most `keep`), oldest first.
+        """
+        with self.cond:
+            return list(self.entries)[-count:] if count > 0 else []
+
+    def follow(self, last_id, timeout = 15):
+        """
+        Waits (up to timeout seconds) for entries newer than last_id and returns them.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.next_id - 1 > last_id, timeout)
+            return [entry for entry in self.entries if entry["id"] > last_id]
 
 def log(msg):
     """
-    Logs a message to the log file.
+    Logs a message (log file and in-memory buffer).
 
     Args:
         msg (str): The message to be logged.
     """
-    if os.path.exists(file_log):
-        set_perms = False
-    else:
-        set_perms = True
+    logger.write(msg)
 
-    with open(file_log, "a") as file:
-        file.write(current_datetime.strftime("%Y-%m-%d %H:%M:%S") + "\t" + msg + "\n")
+def tool(path):
+    """
+    Returns the path of a system tool (e.g. "/usr/bin/aconnect"), or of its
+    stand-in in MIDIPIPES_TOOLS if set (benchmarks without the real tools).
+    """
+    if dir_tools:
+        return os.path.join(dir_tools, os.path.basename(path))
+    return path
 
-    if set_perms:
-        os.chmod(file_log, 0o777)
+class Metrics:
+    """
+    Control plane counters and timers (subprocess calls, reconcile passes,
+    renders, HTTP handlers), exported by the web interface at /metrics.
 
-def midi_devices():
-    output = subprocess.check_output("/usr/bin/aconnect -i -l", shell=True).decode()
-    names = []
+    Each metric has a name and optional labels, timers keep the count, total
+    and maximum seconds. Gauges are functions returning [(name, labels, value)]
+    read at export time.
+    """
 
-    for line in output.splitlines():
-        match = re.search(r'client (\d*): \'(.*)\'', line)
-        if match and match.group(1) != '0' and 'Through' not in line:
-            names.append(match.group(2))
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.gauges = []
+        self.started = time.monotonic()
+
+    def count(self, metric, value = 1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, metric, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        """
+        Returns all metrics as a JSON friendly dict.
+        """
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+            timers = [{"name": name, "labels": dict(labels), "count": count, "total_ms": round(total * 1000, 3), "mean_ms": round(total / count * 1000, 3), "max_ms": round(most * 1000, 3)} for (name, labels), (count, total, most) in sorted(self.timers.items())]
+
+        gauges = []
+        for gauge in self.gauges:
+            try:
+                gauges += [{"name": name, "labels": labels, "value": value} for name, labels, value in gauge()]
+            except Exception as e:
+                log("Metrics: gauge failed (" + repr(e) + ")")
+
+        return {"uptime_s": round(time.monotonic() - self.started, 1), "counters": counters, "timers": timers, "gauges": gauges}
+
+    def prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format (prefixed "midipipes_").
+        """
+        def labels(values):
+            return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in sorted(values.items())) + "}" if values else ""
+
+        snapshot = self.snapshot()
+        families = {} # Name -> (type, sample lines), each family written in one block
+
+        def sample(family, type, name, values, value):
+            families.setdefault(family, (type, []))[1].append(name + labels(values) + " " + value)
+
+        sample("midipipes_uptime_seconds", "gauge", "midipipes_uptime_seconds", {}, str(snapshot["uptime_s"]))
+
+        for counter in snapshot["counters"]:
+            name = "midipipes_" + counter["name"] + "_total"
+            sample(name, "counter", name, counter["labels"], str(counter["value"]))
+
+        for timer in snapshot["timers"]:
+            name = "midipipes_" + timer["name"] + "_seconds"
+            sample(name, "summary", name + "_count", timer["labels"], str(timer["count"]))
+            sample(name, "summary", name + "_sum", timer["labels"], "%g" % (timer["total_ms"] / 1000))
+
+        for timer in snapshot["timers"]:
+            name = "midipipes_" + timer["name"] + "_seconds_max"
+            sample(name, "gauge", name, timer["labels"], "%g" % (timer["max_ms"] / 1000))
+
+        for gauge in snapshot["gauges"]:
+            name = "midipipes_" + gauge["name"]
+            sample(name, "gauge", name, gauge["labels"], str(gauge["value"]))
+
+        lines = []
+        for name, (type, samples) in families.items():
+            lines.append("# TYPE " + name + " " + type)
+            lines += samples
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class Profiler:
+    """
+    Opt-in sampling profiler for the whole process.
 
-    return sorted(list(set(names)))
+    While running, a thread samples the stacks of all other threads every
+    `interval` seconds (sys._current_frames) and counts them as collapsed
+    stacks ("thread;function (file:line);... count", the flame graph format).
+    """
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.samples = {}
+        self.count = 0
+        self.thread = None
+        self.started = None
+
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.samples = {}
+        self.count = 0
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and returns the profile (also written to file_profile).
+        """
+        thread = self.thread
+        if thread is None:
+            return ""
+        self.thread = None
+        thread.join()
+
+        lines = [stack + " " + str(count) for stack, count in sorted(self.samples.items(), key=lambda item: -item[1])]
+        profile = "# " + str(self.count) + " samples over " + str(round(time.monotonic() - self.started, 1)) + "s\n" + "\n".join(lines) + "\n"
+        with open(file_profile, "w") as file:
+            file.write(profile)
+
+        return profile
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.thread is not None:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code.co_name + " (" + os.path.basename(frame.f_code.co_filename) + ":" + str(frame.f_code.co_firstlineno) + ")")
+                    frame = frame.f_back
+                key = names.get(ident, str(ident)) + ";" + ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.count += 1
+            time.sleep(self.interval)
+
+profiler = Profiler()
+
+def command_tool(cmd):
+    """
+    Returns the name of the tool a shell command runs, e.g. "pactl" for "sudo -u pulse /usr/bin/pactl list".
+    """
+    args = cmd.split()
+    while args and os.path.basename(args[0]) == "sudo":
+        args = args[3:] if len(args) > 1 and args[1] == "-u" else args[1:]
+    return os.path.basename(args[0]) if args else ""
 
-def midi():
+def tool_env():
     """
-    Connects MIDI devices using the aconnect command.
+    Returns the environment for the system tools: C locale, so their output is
+    not translated for the parsers (sudo keeps LC_* variables).
     """
+    return dict(os.environ, LC_ALL="C")
 
-    # unconnect everything
-    subprocess.run("/usr/bin/aconnect -x", shell=True)
+def shell(cmd, check = True):
+    """
+    Runs a shell command (C locale), timed in the metrics ("subprocess" by tool).
 
-    # get the list of available ports
-    output = subprocess.check_output("/usr/bin/aconnect -i -l", shell=True).decode()
-    ports = []
+    Args:
+        cmd (str): Shell command.
+        check (bool): Raise subprocess.CalledProcessError if the command fails.
 
-    for line in output.splitlines():
-        match = re.search(r'client (\d*): \'(.*)\'', line)
-        if match and match.group(1) != '0' and 'Through' not in line:
-            ports.append(match.group(1))
-            names.append(match.group(2))
+    Returns:
+        str: The command's output.
+    """
+    name = command_tool(cmd)
+    with metrics.timer("subprocess", tool=name):
+        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, env=tool_env())
 
-    # connect ports
-    for p1 in ports:
-        for p2 in ports:
-            if p1 != p2:
-                subprocess.run(f"/usr/bin/aconnect {p1}:0 {p2}:0", shell=True)
+    if result.returncode:
+        metrics.count("subprocess_failures", tool=name)
+        if check:
+            raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout)
 
-    if len(names) < 1:
-        log("Devices: None found")
-    else:
-        log("Devices: " + ", ".join(str(name) for name in names))
+    return result.stdout.decode()
 
-def display():
+@contextmanager
+def lock():
+    """
+    Holds the reconcile lock, so only one MIDI / audio reconcile runs at a time
+    (across processes).
     """
-    Displays MIDI device information on an InkyWHAT display.
+    set_perms = not os.path.exists(file_lock)
+
+    with open(file_lock, "a") as file:
+        if set_perms:
+            os.chmod(file_lock, 0o777)
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+class Coalescer:
     """
+    Debounces bursts of events into single reconcile passes.
 
-    names_mid = midi_devices()
-    names_aud = audio_devices()
+    A pass runs once no event arrived for `quiet` seconds (or `limit` seconds
+    after the first event of a burst). Passes run one at a time on a worker
+    thread and are given the number of events they absorbed.
+    """
 
-    # Check if the last display update was the same, if so exit
-    names_combined = json.dumps(names_mid) + "|" + json.dumps(names_aud)
+    def __init__(self, reconcile, quiet=0.5, limit=3.0):
+        self.reconcile = reconcile
+        self.quiet = quiet
+        self.limit = limit
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.first = 0
+        self.last = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def poke(self, count=1):
+        with self.cond:
+            now = time.monotonic()
+            if not self.pending:
+                self.first = now
+            self.pending += count
+            self.last = now
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+                while True:
+                    due = min(self.last + self.quiet, self.first + self.limit)
+                    now = time.monotonic()
+                    if now >= due:
+                        break
+                    self.cond.wait(due - now)
+
+                count = self.pending
+                self.pending = 0
+
+            try:
+                with metrics.timer("pass", name=getattr(self.reconcile, "__name__", "reconcile")):
+                    self.reconcile(count)
+                metrics.count("pass_events", count, name=getattr(self.reconcile, "__name__", "reconcile"))
+            except Exception as e:
+                log("Coalescer: " + getattr(self.reconcile, "__name__", "reconcile") + " failed (" + repr(e) + ")")
+
+class Bus:
+    """
+    Internal event bus: publish(topic, data) from any thread, handlers run in
+    order on the bus thread (keep them quick, e.g. poke a Coalescer).
+    """
 
-    if os.path.exists(file_last):
-        with open(file_last, "r") as file:
-            last = file.read()
-        if last == names_combined:
+    def __init__(self):
+        self.handlers = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, topic, handler):
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic, data = None):
+        self.queue.put((topic, data))
+
+    def _run(self):
+        while True:
+            topic, data = self.queue.get()
+            for handler in self.handlers.get(topic, []):
+                try:
+                    handler(data)
+                except Exception as e:
+                    log("Bus: " + topic + " handler failed (" + repr(e) + ")")
+
+def supervise(name, func, *args):
+    """
+    Runs func(*args) on a daemon thread, restarting it (with backoff) if it returns or fails.
+    """
+    def run():
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                func(*args)
+                log("Supervisor: " + name + " stopped, restarting")
+            except Exception as e:
+                log("Supervisor: " + name + " failed (" + repr(e) + "), restarting")
+            delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 60)
+            time.sleep(delay)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+class Jobs:
+    """
+    Background job queue with a single worker.
+
+    Submitting a job with the same name as one that is still queued returns the
+    queued job's id instead of adding a duplicate. Finished jobs are kept (the
+    last `keep`) so their state can be polled.
+    """
+
+    def __init__(self, keep = 50):
+        self.keep = keep
+        self.cond = threading.Condition()
+        self.queue = []
+        self.jobs = {}
+        self.next_id = 1
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name, func, *args):
+        """
+        Queues func(*args), returns the job id.
+        """
+        with self.cond:
+            for job in self.queue:
+                if job["name"] == name:
+                    return job["id"]
+
+            job = {
+                "id": self.next_id,
+                "name": name,
+                "state": "queued", # queued, running, done or failed
+                "queued": time.time(),
+                "started": None,
+                "finished": None,
+                "error": None,
+                "func": func,
+                "args": args,
+            }
+            self.next_id += 1
+            self.jobs[job["id"]] = job
+            self.queue.append(job)
+            self.cond.notify()
+
+            return job["id"]
+
+    def get(self, id):
+        """
+        Returns a job's state (without its function), None if unknown.
+        """
+        with self.cond:
+            job = self.jobs.get(id)
+            if job is None:
+                return None
+            return {key: value for key, value in job.items() if key not in ("func", "args")}
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                job = self.queue.pop(0)
+                job["state"] = "running"
+                job["started"] = time.time()
+
+            try:
+                job["func"](*job["args"])
+                state = "done"
+            except Exception as e:
+                log("Job " + job["name"] + " failed (" + repr(e) + ")")
+                job["error"] = repr(e)
+                state = "failed"
+
+            with self.cond:
+                job["state"] = state
+                job["finished"] = time.time()
+                for id in list(self.jobs)[:-self.keep]:
+                    if self.jobs[id]["state"] in ("done", "failed"):
+                        del self.jobs[id]
+
+class State:
+    """
+    Process-wide cache of the latest state (e.g. "midi", "audio").
+
+    Each key has a loader, values are reloaded when older than `ttl` seconds
+    or after invalidate(). Concurrent readers of a stale key share one reload.
+    """
+
+    def __init__(self, ttl = 30):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.loaders = {}
+        self.locks = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.listeners = []
+
+    def register(self, key, loader):
+        self.loaders[key] = loader
+        self.locks[key] = threading.Lock()
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def get(self, key):
+        with self.locks[key]:
+            with self.lock:
+                if self._fresh(key):
+                    self.hits += 1
+                    return self.entries[key][1]
+                self.misses += 1
+
+            value = self.loaders[key]()
+
+            with self.lock:
+                self.entries[key] = (time.monotonic(), value)
+
+            return value
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys or list(self.entries):
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+        for listener in self.listeners:
+            listener(keys)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "age": {key: round(time.monotonic() - entry[0], 1) for key, entry in self.entries.items()},
+            }
+
+settings_defaults = {
+    "sink_preference": "alsa_output.platform-bcm2835_audio.analog-stereo", # Audio output
+    "display_mode": "colourful", # "fast" or "colourful" (slower)
+    "display_backend": "inky",
+    "display_settle": 2.0, # Seconds without changes before the display updates
+    "display_full_interval": 180, # Minimum seconds between full colour refreshes (faster black and white ones in between)
+    "state_ttl": 30,
+    "log_keep": 1000,
+    "log_max_kb": 256,
+    "mixer_interval": 0.1,
+}
+
+def write_atomic(path, text):
+    """
+    Replaces a file's content atomically (readers see the old or the new file, never a partial one).
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+class Settings(dict):
+    """
+    Settings store: an in-memory dict (reads are plain lookups, unset keys fall
+    back to settings_defaults), changes are saved with save().
+
+    Saving writes the working copy (file_settings, tmpfs) at once and the
+    persistent copy (file_settings_persistent, e.g. on the boot partition) once
+    no change came for `delay` seconds, at most `budget` times a day to limit
+    SD card wear (a change held back by the budget is written once it allows
+    it again, or at exit, a failed write is tried again a minute later). Both
+    writes are atomic.
+
+    The flusher thread is only started by the first save, processes that
+    just read the settings (CLI tools, benchmarks) don't run one.
+    """
+
+    def __init__(self, delay = 10, budget = 50):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.delay = delay
+        self.budget = budget
+        self.writes = deque() # Times of the persistent writes in the last day
+        self.dirty = False # Persistent copy behind the working copy
+        self.changes = 0 # Saves so far, to tell if one came during a flush
+        self.flusher = None
+        self.retry = None # Timer flushing again when the budget allows it
+
+    def poke(self):
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = Coalescer(self.flush, self.delay, self.delay * 6)
+                atexit.register(self.flush, final=True)
+        self.flusher.poke()
+
+    def __missing__(self, key):
+        return settings_defaults[key]
+
+    def get(self, key, default = None):
+        if key in self:
+            return dict.get(self, key)
+        return settings_defaults.get(key, default)
+
+    def load(self):
+        """
+        Loads the working copy (changes made since boot), or the persistent one.
+        """
+        for path in (file_settings, file_settings_persistent):
+            if path is not None and os.path.exists(path):
+                try:
+                    with open(path, "r") as file:
+                        self.update(json.load(file))
+                    return
+                except (OSError, ValueError):
+                    pass # Damaged copy, try the next one
+
+    def save(self, values = None):
+        """
+        Applies changed values (if any) and saves the settings.
+        """
+        with self.lock:
+            if values is not None and values is not self:
+                self.update(values)
+            text = json.dumps(self, indent=4)
+            self.changes += 1
+
+        write_atomic(file_settings, text)
+
+        if file_settings_persistent is not None:
+            self.dirty = True
+            self.poke()
+
+    def flush(self, count = 0, final = False):
+        """
+        Writes the persistent copy if changed (and the daily write budget allows it,
+        or `final` at exit).
+        """
+        if not self.dirty or file_settings_persistent is None:
+            return
+
+        now = time.time()
+        while self.writes and now - self.writes[0] > 86400:
+            self.writes.popleft()
+        if len(self.writes) >= self.budget and not final:
+            if self.retry is None or not self.retry.is_alive():
+                log("Settings: daily write budget used, persistent copy updated when it allows")
+                self.retry = threading.Timer(86400 - (now - self.writes[0]) + 1, self.poke)
+                self.retry.daemon = True
+                self.retry.start()
             return
 
-    with open(file_last, "w") as file:
-        file.write(names_combined)
-
-    if display_mode == "colourful": 
-        inky_display = InkyWHAT("yellow") # Colourful but slow (OK for production)
-    else:
-        inky_display = InkyWHAT("black") # Dull but fast (maintain sanity during development!)
-
-    inky_display.set_border(inky_display.WHITE)
-
-    WIDTH = inky_display.width
-    HEIGHT = inky_display.height
-
-    img = Image.new("P", (WIDTH, HEIGHT))
-    draw = ImageDraw.Draw(img)
-
-    # Draw the logo
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
-    img_logo = Image.open(cur_dir + "/../lib/logo-bg.png")
-    img.paste(img_logo, (0, 0))
-
-    # Load the fonts
-    ts_font = ImageFont.truetype(SourceSansPro, 11)
-    info_font_size = 26
-    info_font = ImageFont.truetype(SourceSansProSemibold, info_font_size)
-    info2_font_size = 16
-    info2_font = ImageFont.truetype(SourceSansProLight, info2_font_size)
-    info2_font_b = ImageFont.truetype(SourceSansProBold, info2_font_size)
-
-    font_prehdr = ImageFont.truetype(SourceSansProBold, info_font_size)
-
-    y_running = 0
-    y_pad = 2
-    x_pad = 10
-
-    draw.text((x_pad, y_running), "MIDI", fill=inky_display.BLACK, font=font_prehdr, align="left")
-    y_running += info_font_size + y_pad
-
-    for name1 in names_mid:
-        text = "• " + name1
-        draw.text((x_pad, y_running), text, fill=inky_display.RED, font=info_font, align="left")
-        # y_running += info_font_size + y_pad
-        y_running += info_font_size
-
-    y_running += 10
-
-    draw.text((x_pad, y_running), "Audio", fill=inky_display.BLACK, font=font_prehdr, align="left")
-    y_running += info_font_size + y_pad
-
-    for name2 in names_aud["detail"]:
-        if name2["type"] == "sink":
-            text = "• " + name2["desc"] + " (" + str(name2["vol"]) + "%)"
-            f = info2_font
-            if name2["id"] == names_aud["output"]:
-                f = info2_font_b
-            draw.text((x_pad, y_running), text, fill=inky_display.BLACK, font=f, align="left")
-            y_running += info2_font_size + y_pad
-
-    # Network
-    ip_address = ""
-    ip_interface = ""
-    net_interfaces = psutil.net_if_addrs()
-    for interface, addrs in net_interfaces.items():
-        for addr in addrs:
-            if addr.family == socket.AF_INET and addr.address != "127.0.0.1":
-                ip_address = addr.address
-                ip_interface = interface
-                break
-
-    # Draw the timestamp, IP address
-    msg_mini_bits = []
-    msg_mini_bits.append(current_datetime.strftime("%Y-%m-%d"))
-    msg_mini_bits.append(current_datetime.strftime("%H:%M:%S"))
-    if len(ip_address):
-        hostname, aliaslist, ipaddrlist = socket.gethostbyaddr(ip_address)
-        msg_mini_bits.append(ip_interface)
-        msg_mini_bits.append(ip_address)
-        msg_mini_bits.append(hostname)
-    draw.multiline_text((0, HEIGHT - 13), "  •  ".join(str(m) for m in msg_mini_bits), fill=inky_display.BLACK, font=ts_font, align="left")
-
-    if len(ip_address):
-        # Generate barcode
-        url = "http://" + ip_address
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=2,
-            border=0,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        # Create display-compatible palette
-        qr_w, qr_h = qr_image.size
-        pal_img = Image.new("P", (1, 1))
-        pal_img.putpalette((255, 255, 255, 0, 0, 0, 255, 0, 0) + (0, 0, 0) * 252)
-        # Quantize the barcode image to the palette and add it to the canvas
-        qr_image = qr_image.convert("RGB").quantize(palette=pal_img)
-        img.paste(qr_image, (WIDTH - qr_w - 5, HEIGHT - qr_h - 58))
-
-    flipped = img.rotate(180)
-    inky_display.set_image(flipped)
-    inky_display.show()
-
-def bye(msg = "", msg_smol = ""):
-    inky_display = InkyWHAT("yellow") # Colourful but slow (OK for production)
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
-    img_logo = Image.open(cur_dir + "/../lib/logo-boot.png")
-
-    if len(msg) or len(msg_smol):
-        draw = ImageDraw.Draw(img_logo)
-        if len(msg):
-            msg_font = ImageFont.truetype(SourceSansProSemibold, 30)
-            draw.multiline_text(((inky_display.width / 2) + 6, inky_display.height - 96), msg, fill=inky_display.BLACK, font=msg_font, align="left")
-        if len(msg_smol):
-            msg_font_smol = ImageFont.truetype(SourceSansProSemibold, 14)
-            w, h = getsize(msg_font_smol, msg_smol)
-            draw.multiline_text(((inky_display.width / 2) - (w / 2), inky_display.height - 30), msg_smol, fill=inky_display.BLACK, font=msg_font_smol, align="left")
-    
-    img_logo = img_logo.rotate(180)
-    inky_display.set_image(img_logo)
-    inky_display.show()
+        self.writes.append(now) # Failed attempts count too, retries stay within the budget
+        with self.lock:
+            text = json.dumps(self, indent=4)
+            changes = self.changes
+        try:
+            try:
+                write_atomic(file_settings_persistent, text)
+            except OSError as e:
+                if e.errno != errno.EROFS:
+                    raise
+
+                # Boot partition mounted read-only, remount it just for the write
+                mount = os.path.dirname(file_settings_persistent)
+                shell(tool("/usr/bin/mount") + " -o remount,rw " + mount)
+                try:
+                    write_atomic(file_settings_persistent, text)
+                finally:
+                    shell(tool("/usr/bin/mount") + " -o remount,ro " + mount)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log("Settings: unable to save " + file_settings_persistent + " (" + str(e) + "), trying again in a minute")
+            if not final and (self.retry is None or not self.retry.is_alive()):
+                self.retry = threading.Timer(60, self.poke)
+                self.retry.daemon = True
+                self.retry.start()
+            return
+
+        with self.lock:
+            if self.changes == changes: # Else saved again meanwhile, the flusher is poked
+                self.dirty = False
 
 def settings_get():
-    settings = {}
-
-    if os.path.exists(file_settings):
-        with open(file_settings, "r") as file:
-            settings = json.load(file)
-
-    return settings
-
-def settings_set(settings):
-    with open(file_settings, "w") as file:
-        file.write(json.dumps(settings, indent=4))
-
-def audio_volume(vol = -1, dev = None, type = None):
-
-    vol = int(vol)
-
-    if dev is None:
-        aud = audio_devices()
-        device = aud["output"]
-        type = "sink"
-    else:
-        device = dev
-        if type is None:
-            type = "source"
-
-    if vol > -1:
-        vol = 0 if vol < 0 else vol
-        vol = 100 if vol > 100 else vol
-        cmd = "/usr/bin/sudo -u pulse /usr/bin/pactl set-" + type + "-volume " + str(device) + " " + str(vol) + "%"
-    else:
-        cmd = "/usr/bin/sudo -u pulse /usr/bin/pactl get-" + type + "-volume " + str(device)
-
-    output = subprocess.check_output(cmd, shell=True).decode()
-
-    if vol > -1:
-        return vol
-    else:
-        match = re.search(r' (\d+)% ', output)
-        if match:
-            return int(match.group(1))
-        else:
-            return 0
-
-def audio():
-    devices_config = audio_devices()
-    sinkId = devices_config["output"]
-    for sourceId, sourceName in devices_config["source"].items():
-        piped = False
-        for pipe in devices_config["pipe"]:
-            if pipe["source"] == sourceId and pipe["sink"] == sinkId:
-                piped = True
-                break
-
-        if piped:
-            continue
-
-        piped_audio = subprocess.check_output("/usr/bin/sudo -u pulse /usr/bin/pactl load-module module-loopback source=" + sourceId + " sink=" + sinkId, shell=True).decode()
-
-def audio_devices():
-    """
-    Returns a list of audio devices.
-    """
-
-    data = {
-        "source": {}, # Audio input devices
-        "sink": {}, # Audio output devices
-        "output": "", # Audio output device that is preferred
-        "pipe": [], # Audio devices that are currently piped (source -> sink)
-        "detail": [], # Audio device friendly names
-    }
-
-    output = subprocess.check_output("/usr/bin/sudo -u pulse /usr/bin/pactl list", shell=True).decode()
-
-    patterns = {
-        "module": re.compile(r'Module #(\d+)'),
-        "source": re.compile(r'Source #(\d+)'),
-        "sink": re.compile(r'Sink #(\d+)'),
-        "argument": re.compile(r'Argument: source=(\d+) sink=(\d+)'),
-        "name": re.compile(r'Name: (.+)'),
-        "name_has_input": re.compile(r'Name: alsa_input\.usb-(.+)'),
-        "desc": re.compile(r'Description: (.+)'),
-    }
-
-    if "sink_preference" in settings and settings["sink_preference"] is not None:
-        sink_preference = settings["sink_preference"]
-    else:
-        settings["sink_preference"] = "alsa_output.platform-bcm2835_audio.analog-stereo"
-        sink_preference = settings["sink_preference"]
-        settings_set(settings)
-
-    def clear_values():
-        return {
-            "type": "",
-            "id": "",
-            "name": "",
-            "name_has_input": "",
-            "desc": "",
-            "pipe_source": "",
-            "pipe_sink": "",
-        }
-
-    values = clear_values()
-
-    for ptn in patterns:
-        values[ptn] = ""
-
-    for line in output.split('\n'):
-        matches = {}
-
-        for ptn in patterns:
-            matches[ptn] = patterns[ptn].search(line)
-        
-        if matches["module"]:
-            values = clear_values()
-            values["type"] = "pipe"
-            values["id"] = matches["module"].group(1)
-
-        if matches["source"]:
-            values = clear_values()
-            values["type"] = "source"
-            values["id"] = matches["source"].group(1)
-
-        if matches["sink"]:
-            values = clear_values()
-            values["type"] = "sink"
-            values["id"] = matches["sink"].group(1)
-
-        if matches["argument"]:
-            values["pipe_source"] = matches["argument"].group(1)
-            values["pipe_sink"] = matches["argument"].group(2)
-
-        if matches["name"]:
-            values["name"] = matches["name"].group(1)
-
-        if matches["name_has_input"]:
-            values["name_has_input"] = matches["name_has_input"].group(1)
-
-        if matches["desc"]:
-            values["desc"] = matches["desc"].group(1)
-
-        if len(values["pipe_source"]) and len(values["pipe_sink"]):
-            data["pipe"].append({"source": values["pipe_source"], "sink": values["pipe_sink"]})
-            values = clear_values()
-            continue
-
-        if len(values["name"]) and len(values["desc"]):
-            if values["type"] == "sink" and values["name"] == sink_preference:
-                data["output"] = values["id"]
-            
-            if values["type"] == "source" and len(values["name_has_input"]):
-                vol = audio_volume(-1, values["id"], "source")
-                data["detail"].append({"type": values["type"], "id": values["id"], "name": values["name"], "desc": values["desc"], "vol": vol})
-                data[values["type"]][values["id"]] = values["name"]
-            
-            if values["type"] == "sink":
-                vol = audio_volume(-1, values["id"], "sink")
-                data["detail"].append({"type": values["type"], "id": values["id"], "name": values["name"], "desc": values["desc"], "vol": vol})
-                data[values["type"]][values["id"]] = values["name"]
-
-            values = clear_values()
-            continue
-
-    return data
+    """
+    Returns the settings store (loaded).
+    """
+    store = Settings()
+    store.load()
+    return store
+
+def settings_set(values):
+    """
+    Saves the settings (see Settings.save()).
+    """
+    settings.save(values)
 
 settings = settings_get()
+logger = Logger(settings["log_keep"], settings["log_max_kb"] * 1024)
+state = State(settings["state_ttl"])
+metrics.gauges.append(lambda: [("cache_" + key, {}, value) for key, value in state.stats().items() if key in ("hits", "misses", "invalidations")])
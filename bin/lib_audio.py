@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_audio.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Audio routing for MIDI Pipes (PulseAudio)
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import shlex
+from dataclasses import dataclass, field, asdict
+from collections import deque
+
+from lib import *
+from lib_devices import devices, pulse_key
+from lib_parse import pactl_sections, pactl_volume, module_args, pulse_cli_volume
+
+file_pulse_cli = "/var/run/pulse/cli" # module-cli-protocol-unix socket
+
+def pactl(args):
+    """
+    Returns the shell command running pactl (as the pulse user) with the given arguments.
+    """
+    return tool("/usr/bin/sudo") + " -u pulse " + tool("/usr/bin/pactl") + " " + args
+
+class Pulse:
+    """
+    Long-lived PulseAudio client.
+
+    Commands go over one persistent connection to the PulseAudio CLI protocol
+    socket (module-cli-protocol-unix), change events come from one resident
+    `pactl subscribe` process. Any server speaking the same command set on a
+    unix socket can stand in for PulseAudio (see dev/bench/fake_pulse.py).
+    """
+
+    PROMPT = b">>> "
+    VOLUME_NORM = 65536
+
+    def __init__(self, path=None, events_cmd=None):
+        self.path = path or file_pulse_cli
+        self.events_cmd = events_cmd or pactl("subscribe")
+        self.sock = None
+        self.lock = threading.Lock()
+        self.handlers = []
+        self.events = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self._read() # Welcome banner
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _read(self):
+        data = b""
+        while not data.endswith(self.PROMPT):
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("PulseAudio closed the CLI connection")
+            data += chunk
+        return data[:-len(self.PROMPT)].decode(errors="replace")
+
+    def command(self, cmd):
+        """
+        Sends one CLI command and returns its output (empty on success for set/load commands).
+
+        Reconnects once if the connection was dropped (e.g. PulseAudio restarted).
+        """
+        with self.lock, metrics.timer("pulse_command", command=cmd.split(" ", 1)[0]):
+            for attempt in (0, 1):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(cmd.encode() + b"\n")
+                    return self._read()
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+    def _check(self, cmd):
+        output = self.command(cmd).strip()
+        if len(output):
+            log("Audio: '" + cmd + "' failed: " + output)
+            return False
+        return True
+
+    def volume(self, type, device, vol=-1):
+        """
+        Gets (vol < 0) or sets the volume of a sink or source.
+
+        Args:
+            type (str): "sink" or "source".
+            device (str): PulseAudio index or name.
+            vol (int): Volume in percent (0-100), -1 to read it.
+
+        Returns:
+            int: The volume in percent.
+        """
+        if vol > -1:
+            self._check("set-" + type + "-volume " + str(device) + " " + str(round(vol * self.VOLUME_NORM / 100)))
+            return vol
+
+        return pulse_cli_volume(self.command("list-" + type + "s"), device) or 0
+
+    def load_module(self, name, args=""):
+        return self._check("load-module " + name + " " + args)
+
+    def unload_module(self, index):
+        return self._check("unload-module " + str(index))
+
+    def default_sink(self, name):
+        return self._check("set-default-sink " + name)
+
+    def subscribe(self, handler):
+        """
+        Registers handler(event, facility, index) for sink, source and module events,
+        e.g. ("change", "sink", "1"). Starts the event reader on first use.
+        """
+        self.handlers.append(handler)
+
+        if self.events is None:
+            self.events = threading.Thread(target=self._events, daemon=True)
+            self.events.start()
+
+    def _events(self):
+        pattern = re.compile(r"Event '(\w+)' on ([\w-]+) #(\d+)")
+
+        while True:
+            try:
+                proc = subprocess.Popen(self.events_cmd, shell=True, stdout=subprocess.PIPE, text=True, env=tool_env())
+                for line in proc.stdout:
+                    match = pattern.search(line)
+                    if match and match.group(2) in ("sink", "source", "module"):
+                        for handler in list(self.handlers):
+                            try:
+                                handler(match.group(1), match.group(2), match.group(3))
+                            except Exception as e: # One failing handler must not end the subscription
+                                log("Audio: event handler failed (" + repr(e) + ")")
+                proc.wait()
+            except Exception as e:
+                log("Audio: event subscription failed (" + repr(e) + ")")
+
+            time.sleep(5)
+
+_pulse = None
+
+def pulse():
+    """
+    Returns the shared Pulse client (created on first use).
+    """
+    global _pulse
+
+    if _pulse is None:
+        _pulse = Pulse()
+
+    return _pulse
+
+def audio_device_valid(type, device):
+    """
+    Returns True if device is a sink / source: a PulseAudio index, or the name of one present now.
+    """
+    if type not in ("sink", "source"):
+        return False
+    if re.fullmatch(r"\d{1,10}", str(device)):
+        return True
+
+    snapshot = state.get("audio")
+    names = [detail.name for detail in snapshot.detail if detail.type == type]
+    names += list(snapshot.sink.values()) + [snapshot.output] if type == "sink" else list(snapshot.sources.values())
+    return device in names
+
+def audio_volume(vol = -1, dev = None, type = None):
+
+    vol = int(vol)
+
+    if dev is None:
+        device = state.get("audio").output
+        type = "sink"
+    else:
+        device = dev
+        if type is None:
+            type = "source"
+
+    if not audio_device_valid(type, device):
+        raise ValueError("Unknown " + str(type) + " " + repr(device))
+
+    if vol > -1:
+        vol = 0 if vol < 0 else vol
+        vol = 100 if vol > 100 else vol
+
+    if vol > -1:
+        devices.remember(devices.lookup(type, str(device)), vol=vol) # Volume preset, set again after a replug
+
+    try:
+        vol = pulse().volume(type, device, vol)
+        if vol > -1:
+            state.invalidate("audio")
+        return vol
+    except OSError:
+        pass # No CLI socket, fall back to pactl
+
+    if vol > -1:
+        cmd = pactl("set-" + type + "-volume " + shlex.quote(str(device)) + " " + str(vol) + "%")
+    else:
+        cmd = pactl("get-" + type + "-volume " + shlex.quote(str(device)))
+
+    output = shell(cmd)
+
+    if vol > -1:
+        state.invalidate("audio")
+        return vol
+    else:
+        match = re.search(r' (\d+)% ', output)
+        if match:
+            return int(match.group(1))
+        else:
+            return 0
+
+class Mixer:
+    """
+    Applies volume changes at a bounded rate.
+
+    Changes are queued per device, a newer value replaces one that has not been
+    applied yet, and the pending changes are applied together at most once per
+    `interval` seconds on a worker thread.
+    """
+
+    def __init__(self, interval = 0.1):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.merged = 0
+        self.applied = 0
+        self.timings = deque(maxlen=20)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set(self, type, device, vol):
+        with self.cond:
+            if (type, device) in self.pending:
+                self.merged += 1
+            self.pending[(type, device)] = vol
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                pending = self.pending
+                self.pending = {}
+
+            started = time.monotonic()
+            for (type, device), vol in pending.items():
+                applied = time.monotonic()
+                try:
+                    audio_volume(vol, device, type)
+                except Exception as e:
+                    log("Audio: volume change failed (" + repr(e) + ")")
+                with self.cond:
+                    self.applied += 1
+                    self.timings.append({"type": type, "id": device, "vol": vol, "ms": round((time.monotonic() - applied) * 1000, 2)})
+
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def stats(self):
+        with self.cond:
+            return {
+                "interval_ms": round(self.interval * 1000),
+                "pending": len(self.pending),
+                "merged": self.merged,
+                "applied": self.applied,
+                "recent": list(self.timings),
+            }
+
+_mixer = None
+
+def mixer():
+    """
+    Returns the shared Mixer (created on first use).
+    """
+    global _mixer
+
+    if _mixer is None:
+        _mixer = Mixer(settings["mixer_interval"])
+
+    return _mixer
+
+def audio_load_module(name, args):
+    """
+    Loads a PulseAudio module, over the CLI socket if available (pactl otherwise).
+    """
+    try:
+        return pulse().load_module(name, args)
+    except OSError:
+        shell(pactl("load-module " + name + " " + args))
+        return True
+
+pipe_options = ("latency_msec", "max_latency_msec", "resample_method", "adjust_time") # module-loopback arguments
+
+pipe_modes = {
+    "default": {},
+    "low-latency": {"latency_msec": "10"}, # Monitoring while playing
+    "low-cpu": {"latency_msec": "200", "resample_method": "trivial"}, # Background / many devices
+}
+
+def pipe_config(source_name):
+    """
+    Returns the module-loopback options for a source.
+
+    Configured with the "pipes" setting, keyed by source name (or "default"),
+    e.g. {"default": {"mode": "low-cpu"}, "alsa_input.usb-...": {"mode": "low-latency", "latency_msec": "5"}}.
+    """
+    pipes = settings.get("pipes", {})
+    config = pipes.get(source_name, pipes.get("default", {}))
+
+    options = dict(pipe_modes.get(config.get("mode", "default"), {}))
+    for key in pipe_options:
+        if key in config:
+            options[key] = str(config[key])
+
+    return options
+
+def audio_unload_module(index):
+    """
+    Unloads a PulseAudio module, over the CLI socket if available (pactl otherwise).
+    """
+    try:
+        return pulse().unload_module(index)
+    except OSError:
+        shell(pactl("unload-module " + str(index)))
+        return True
+
+def audio_pipes(snapshot):
+    """
+    Works out the loopback changes needed: every USB input piped to the preferred output,
+    with its configured options, and nothing else.
+
+    Returns:
+        tuple: (module ids to unload, [(source id, sink id, options)] to load).
+    """
+    wanted = {}
+    if len(snapshot.output):
+        for sourceId, sourceName in snapshot.source.items():
+            options = pipe_config(sourceName)
+            wanted[(sourceId, snapshot.output, tuple(sorted(options.items())))] = options
+
+    unload = []
+    kept = set()
+    for pipe in snapshot.pipe:
+        # Loopbacks from other (non USB input) sources are not ours to manage, those
+        # from a source that is gone are stale (unloaded, in case the server kept them)
+        if pipe["source"] not in snapshot.source and pipe["source"] in snapshot.sources and pipe["sink"] in snapshot.sink:
+            continue
+
+        options = tuple(sorted((key, value) for key, value in pipe["args"].items() if key in pipe_options))
+        key = (pipe["source"], pipe["sink"], options)
+        if key in wanted and key not in kept:
+            kept.add(key)
+        else:
+            unload.append(pipe["module"])
+
+    load = [(key[0], key[1], options) for key, options in wanted.items() if key not in kept]
+
+    return unload, load
+
+def audio():
+    """
+    Reconciles audio loopbacks from one snapshot: unloads stale ones (old output,
+    gone devices, changed options, duplicates) and loads only the missing ones.
+    """
+    started = time.monotonic()
+
+    with lock():
+        snapshot = audio_snapshot()
+        unload, load = audio_pipes(snapshot)
+
+        # Devices plugged in since the last pass get their volume preset back
+        restore = []
+        for type in ("sink", "source"):
+            added, removed = devices.update(type, getattr(snapshot, type), lambda index, name: pulse_key(name))
+            restore += [(type, devices.get(id)["handle"], devices.state(id)["vol"]) for id in added if "vol" in devices.state(id)]
+        for type, index, vol in restore:
+            audio_volume(vol, index, type)
+
+        for module in unload:
+            audio_unload_module(module)
+
+        for sourceId, sinkId, options in load:
+            args = "source=" + sourceId + " sink=" + sinkId
+            for key, value in sorted(options.items()):
+                args += " " + key + "=" + value
+            audio_load_module("module-loopback", args)
+
+    metrics.observe("reconcile", time.monotonic() - started, kind="audio")
+    metrics.count("audio_loopbacks_loaded", len(load))
+    metrics.count("audio_loopbacks_unloaded", len(unload))
+
+    if unload or load:
+        log("Audio: +" + str(len(load)) + " -" + str(len(unload)) + " loopbacks")
+    if restore:
+        log("Audio: " + str(len(restore)) + " volume preset(s) restored")
+
+    state.invalidate("audio")
+
+@dataclass
+class AudioDevice:
+    type: str # "sink" or "source"
+    id: str # PulseAudio index
+    name: str
+    desc: str
+    vol: int # Percent
+    device: str = "" # Stable id (see lib_devices), the same after a replug
+
+@dataclass
+class AudioSnapshot:
+    source: dict = field(default_factory=dict) # Audio input devices {id: name}
+    sink: dict = field(default_factory=dict) # Audio output devices {id: name}
+    output: str = "" # Audio output device that is preferred
+    pipe: list = field(default_factory=list) # Audio devices that are currently piped [{"source": id, "sink": id, "module": id, "args": {...}}]
+    sources: dict = field(default_factory=dict) # Every source {id: name} (monitors and other non USB inputs too)
+    detail: list = field(default_factory=list) # Audio devices with friendly names and volumes [AudioDevice]
+
+    def as_dict(self):
+        """
+        Returns the snapshot in the JSON shape used by the web interface.
+        """
+        return {
+            "source": self.source,
+            "sink": self.sink,
+            "output": self.output,
+            "pipe": self.pipe,
+            "detail": [asdict(device) for device in self.detail],
+        }
+
+def audio_snapshot_parse(output, sink_preference):
+    """
+    Builds an AudioSnapshot from `pactl list` output, volumes included.
+    """
+    snapshot = AudioSnapshot()
+
+    indexes = {} # Sink / source names to indexes, for loopbacks loaded by name
+
+    for head, index, fields in pactl_sections(output):
+        if head == "Module":
+            if fields.get("Name") == "module-loopback":
+                args = module_args(fields.get("Argument", ""))
+                if "source" in args and "sink" in args:
+                    snapshot.pipe.append({"source": args["source"], "sink": args["sink"], "module": index, "args": args})
+            continue
+
+        if head in ("Sink", "Source"):
+            indexes[(head.lower(), fields.get("Name", ""))] = index
+        if head == "Source":
+            snapshot.sources[index] = fields.get("Name", "")
+
+        if head == "Sink":
+            type = "sink"
+        elif head == "Source" and fields.get("Name", "").startswith("alsa_input.usb-"):
+            type = "source"
+        else:
+            continue
+
+        name = fields.get("Name", "")
+        desc = fields.get("Description", "")
+        if not len(name) or not len(desc):
+            continue
+
+        if type == "sink" and name == sink_preference:
+            snapshot.output = index
+
+        snapshot.detail.append(AudioDevice(type, index, name, desc, pactl_volume(fields.get("Volume", "")), type + ":" + pulse_key(name)))
+        getattr(snapshot, type)[index] = name
+
+    for pipe in snapshot.pipe:
+        for type in ("source", "sink"):
+            if not pipe[type].isdigit():
+                pipe[type] = indexes.get((type, pipe[type]), pipe[type])
+
+    return snapshot
+
+def audio_snapshot():
+    """
+    Returns the current audio state (devices, volumes, pipes) from a single pactl call.
+    """
+    sink_preference = settings["sink_preference"]
+
+    output = shell(pactl("list"))
+
+    return audio_snapshot_parse(output, sink_preference)
+
+def audio_devices():
+    """
+    Returns a list of audio devices (see AudioSnapshot.as_dict()).
+    """
+    return audio_snapshot().as_dict()
+
+state.register("audio", audio_snapshot)
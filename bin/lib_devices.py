@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_devices.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Stable device identities for MIDI Pipes (across replugs and renumbering)
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+from lib import *
+
+dir_sound = "/sys/class/sound" # ALSA cards in sysfs
+
+def pulse_key(name):
+    """
+    Returns the hardware identity in a PulseAudio (or PipeWire) sink / source name.
+
+    USB names carry the udev serial (vendor, model, serial number), interface
+    and profile (several sinks / sources of one card differ by profile only),
+    Bluetooth names the device address, e.g.
+    "alsa_output.usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00.analog-stereo" -> "usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00.analog-stereo",
+    "bluez_sink.00_1B_66_AA_BB_CC.a2dp_sink" -> "bt-00:1B:66:AA:BB:CC".
+    """
+    match = re.match(r'bluez_\w+\.((?:[0-9A-Fa-f]{2}_){5}[0-9A-Fa-f]{2})', name)
+    if match:
+        return "bt-" + match.group(1).replace("_", ":").upper()
+
+    match = re.match(r'alsa_\w+\.(.+?)(?:\.monitor)?$', name)
+    if match:
+        return match.group(1)
+
+    return name
+
+def card_key(card):
+    """
+    Returns the hardware identity of an ALSA card from sysfs: "usb-<product>_<serial>",
+    or "usb-<product>@<USB path>" for devices without a serial number (None if not USB).
+    """
+    if card is None or card < 0:
+        return None
+
+    interface = os.path.realpath(dir_sound + "/card" + str(card) + "/device")
+    usb = os.path.dirname(interface)
+
+    def read(name):
+        try:
+            with open(usb + "/" + name, "r") as file:
+                return file.read().strip()
+        except OSError:
+            return ""
+
+    product = read("product") or read("idVendor") + ":" + read("idProduct")
+    if product == ":":
+        return None
+
+    serial = read("serial")
+    product = re.sub(r'\s+', "_", product)
+    return "usb-" + (product + "_" + serial if serial else product + "@" + os.path.basename(usb))
+
+def midi_key(name, card=None, client=None):
+    """
+    Returns the hardware identity of a MIDI client: its USB device if it is a
+    card, its name otherwise (virtual, Bluetooth and network clients), with its
+    client number if given (clients sharing a name, e.g. two identical
+    Bluetooth devices, don't have one identity then).
+    """
+    key = card_key(card)
+    if key:
+        return key
+    return "seq-" + name + ("@" + str(client) if client is not None else "")
+
+class Devices:
+    """
+    Index of devices by stable id ("<kind>:<hardware identity>", e.g.
+    "sink:usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00") and by their current
+    handle (ALSA client number, PulseAudio index), which change on every replug.
+
+    The reconcile passes update it with the devices present, only new or
+    changed handles are identified (sysfs is read once per plug). Per device
+    state (e.g. volume presets) is kept in the "devices" setting by stable id,
+    so it applies again as soon as the device is back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {} # Stable id -> {"id", "kind", "name", "handle"}
+        self.handles = {} # (kind, handle) -> (name, stable id)
+
+    def update(self, kind, current, identify):
+        """
+        Applies the devices of one kind present now.
+
+        Args:
+            kind (str): "midi", "sink" or "source".
+            current (dict): {handle: name} of the devices present.
+            identify (function): identify(handle, name) -> hardware identity, called for new handles only.
+
+        Returns:
+            tuple: (stable ids added, stable ids removed).
+        """
+        added = []
+        removed = []
+
+        with self.lock:
+            for handle, name in current.items():
+                entry = self.handles.get((kind, handle))
+                if entry is None or entry[0] != name: # New, or a number reused by another device
+                    id = kind + ":" + identify(handle, name)
+                    if entry is not None and entry[1] != id and self.devices.get(entry[1], {}).get("handle") == handle:
+                        del self.devices[entry[1]]
+                        removed.append(entry[1])
+                    self.handles[(kind, handle)] = (name, id)
+                    if id not in self.devices or self.devices[id]["handle"] not in current:
+                        added.append(id) # Plugged in (or replugged since the last pass)
+                    self.devices[id] = {"id": id, "kind": kind, "name": name, "handle": handle}
+
+            for (handle_kind, handle), (name, id) in list(self.handles.items()):
+                if handle_kind == kind and handle not in current:
+                    del self.handles[(kind, handle)]
+                    if self.devices.get(id, {}).get("handle") == handle:
+                        del self.devices[id]
+                        removed.append(id)
+
+        return added, removed
+
+    def lookup(self, kind, handle):
+        """
+        Returns the stable id of a device by its current handle (None if unknown).
+        """
+        entry = self.handles.get((kind, handle))
+        return entry[1] if entry is not None else None
+
+    def get(self, id):
+        """
+        Returns a present device by stable id (None if it is not plugged in).
+        """
+        return self.devices.get(id)
+
+    def state(self, id):
+        """
+        Returns the saved state of a device, e.g. {"vol": 60}.
+        """
+        return settings.get("devices", {}).get(id, {})
+
+    def remember(self, id, **values):
+        """
+        Saves state for a device (only written if it changed).
+        """
+        if id is None or all(self.state(id).get(key) == value for key, value in values.items()):
+            return
+
+        saved = dict(settings.get("devices", {}))
+        saved[id] = dict(saved.get(id, {}), **values)
+        settings_set({"devices": saved})
+
+    def list(self):
+        """
+        Returns the present devices with their saved state, for the web interface.
+        """
+        with self.lock:
+            return [dict(device, state=self.state(id)) for id, device in sorted(self.devices.items())]
+
+devices = Devices()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_display.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Display support for MIDI Pipes (Inky wHAT)
+
+The display libraries (inky, PIL, qrcode, psutil) are only imported when rendering
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+from lib import *
+from lib_midi import midi_devices
+from lib_audio import audio_snapshot
+
+import hashlib
+import struct
+from functools import lru_cache
+
+display_title = "MIDI Pipes"
+file_last = "/tmp/midi-last.txt"
+file_display_png = "/tmp/midi-display.png"
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+
+class InkyBackend:
+    """
+    Inky wHAT e-ink display (the panel is created once and reused).
+    """
+
+    WHITE = 0
+    BLACK = 1
+    RED = 2
+
+    def __init__(self, mode = None):
+        self.mode = mode or settings["display_mode"] # "fast" or "colourful" (slower)
+        self.panel = None
+        self.width = 400
+        self.height = 300
+
+    def open(self):
+        if self.panel is None:
+            from inky import InkyWHAT
+            if self.mode == "colourful":
+                self.panel = InkyWHAT("yellow") # Colourful but slow (OK for production)
+            else:
+                self.panel = InkyWHAT("black") # Dull but fast (maintain sanity during development!)
+            self.width = self.panel.width
+            self.height = self.panel.height
+        return self
+
+    def show(self, img, fast = False):
+        """
+        Shows an image, with the black and white waveform if fast (a few seconds
+        instead of many on a colour panel, the image is black and white then).
+        """
+        self.open()
+        lut = getattr(self.panel, "lut", None)
+        if fast and lut is not None:
+            self.panel.lut = "black"
+        try:
+            self.panel.set_border(self.panel.WHITE)
+            self.panel.set_image(img.rotate(180))
+            self.panel.show()
+        finally:
+            if lut is not None:
+                self.panel.lut = lut
+
+class PngBackend:
+    """
+    Headless backend, writes the rendered image to a PNG file (e.g. for benchmarks).
+    """
+
+    WHITE = 0
+    BLACK = 1
+    RED = 2
+
+    def __init__(self, path = file_display_png, width = 400, height = 300):
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def open(self):
+        return self
+
+    def show(self, img, fast = False):
+        img = img.copy()
+        img.putpalette((255, 255, 255, 0, 0, 0, 255, 0, 0) + (0, 0, 0) * 253)
+        img.save(self.path)
+
+display_backends = {
+    "inky": InkyBackend,
+    "png": PngBackend,
+}
+
+_backend = None
+
+def backend():
+    """
+    Returns the display backend selected by the "display_backend" setting (default "inky").
+    """
+    global _backend
+
+    if _backend is None:
+        _backend = display_backends[settings["display_backend"]]()
+
+    return _backend.open()
+
+def getsize(font, text):
+    _, _, right, bottom = font.getbbox(text)
+    return (right, bottom)
+
+@lru_cache(maxsize=None)
+def font(face, size):
+    from PIL import ImageFont
+    import font_source_sans_pro
+    return ImageFont.truetype(getattr(font_source_sans_pro, face), size)
+
+@lru_cache(maxsize=None)
+def image(name):
+    from PIL import Image
+    img = Image.open(cur_dir + "/../lib/" + name)
+    img.load()
+    return img
+
+@lru_cache(maxsize=4)
+def qr_image(url):
+    """
+    Returns the QR code for a URL, quantized to the display palette.
+    """
+    from PIL import Image
+    import qrcode
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=2,
+        border=0,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    # Create display-compatible palette
+    pal_img = Image.new("P", (1, 1))
+    pal_img.putpalette((255, 255, 255, 0, 0, 0, 255, 0, 0) + (0, 0, 0) * 252)
+    # Quantize the barcode image to the palette
+    return img.convert("RGB").quantize(palette=pal_img)
+
+@lru_cache(maxsize=4)
+def hostname(ip_address):
+    try:
+        return socket.gethostbyaddr(ip_address)[0]
+    except OSError:
+        return ""
+
+def network():
+    """
+    Returns (interface, IPv4 address) of the first non-loopback interface with an address.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, interface in socket.if_nameindex():
+            if interface == "lo":
+                continue
+            try:
+                ifreq = fcntl.ioctl(sock.fileno(), 0x8915, struct.pack("256s", interface[:15].encode())) # SIOCGIFADDR
+            except OSError:
+                continue
+            return interface, socket.inet_ntoa(ifreq[20:24])
+
+    return "", ""
+
+def display_state(names_mid = None, names_aud = None):
+    """
+    Gathers what the display shows (reusing an already gathered MIDI / audio state if given).
+    """
+    if names_mid is None:
+        names_mid = midi_devices()
+    if names_aud is None:
+        names_aud = audio_snapshot()
+
+    ip_interface, ip_address = network()
+
+    return {
+        "midi": names_mid,
+        "audio": [(device.desc, device.vol, device.id == names_aud.output) for device in names_aud.detail if device.type == "sink"],
+        "interface": ip_interface,
+        "ip": ip_address,
+        "hostname": hostname(ip_address) if len(ip_address) else "",
+    }
+
+def display_fingerprint(state):
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+def display_render(state, out):
+    """
+    Renders the status screen for a display backend.
+
+    Returns:
+        Image: Palette image (white, black, red) the size of the display.
+    """
+    from PIL import Image, ImageDraw
+
+    WIDTH = out.width
+    HEIGHT = out.height
+
+    img = Image.new("P", (WIDTH, HEIGHT))
+    draw = ImageDraw.Draw(img)
+
+    # Draw the logo
+    img.paste(image("logo-bg.png"), (0, 0))
+
+    # Fonts
+    ts_font = font("SourceSansPro", 11)
+    info_font_size = 26
+    info_font = font("SourceSansProSemibold", info_font_size)
+    info2_font_size = 16
+    info2_font = font("SourceSansProLight", info2_font_size)
+    info2_font_b = font("SourceSansProBold", info2_font_size)
+
+    font_prehdr = font("SourceSansProBold", info_font_size)
+
+    y_running = 0
+    y_pad = 2
+    x_pad = 10
+
+    draw.text((x_pad, y_running), "MIDI", fill=out.BLACK, font=font_prehdr, align="left")
+    y_running += info_font_size + y_pad
+
+    for name1 in state["midi"]:
+        text = "• " + name1
+        draw.text((x_pad, y_running), text, fill=out.RED, font=info_font, align="left")
+        y_running += info_font_size
+
+    y_running += 10
+
+    draw.text((x_pad, y_running), "Audio", fill=out.BLACK, font=font_prehdr, align="left")
+    y_running += info_font_size + y_pad
+
+    for desc, vol, output in state["audio"]:
+        text = "• " + desc + " (" + str(vol) + "%)"
+        f = info2_font_b if output else info2_font
+        draw.text((x_pad, y_running), text, fill=out.BLACK, font=f, align="left")
+        y_running += info2_font_size + y_pad
+
+    # Draw the timestamp, IP address
+    now = datetime.now(timezone.utc)
+    msg_mini_bits = []
+    msg_mini_bits.append(now.strftime("%Y-%m-%d"))
+    msg_mini_bits.append(now.strftime("%H:%M:%S"))
+    if len(state["ip"]):
+        msg_mini_bits.append(state["interface"])
+        msg_mini_bits.append(state["ip"])
+        msg_mini_bits.append(state["hostname"])
+    draw.multiline_text((0, HEIGHT - 13), "  •  ".join(str(m) for m in msg_mini_bits if len(m)), fill=out.BLACK, font=ts_font, align="left")
+
+    if len(state["ip"]):
+        qr = qr_image("http://" + state["ip"])
+        qr_w, qr_h = qr.size
+        img.paste(qr, (WIDTH - qr_w - 5, HEIGHT - qr_h - 58))
+
+    return img
+
+_last = None
+_lock = threading.Lock() # One refresh at a time
+
+def display(names_mid = None, names_aud = None, force = False, fast = False):
+    """
+    Displays MIDI device information on the display.
+
+    Nothing is rendered (or refreshed, slow on tri-colour e-ink) unless the
+    visible content changed since the last update.
+
+    Args:
+        names_mid (list): MIDI device names, if already gathered.
+        names_aud (AudioSnapshot): Audio snapshot, if already gathered.
+        force (bool): Render and refresh even if nothing changed.
+        fast (bool): Black and white refresh (red drawn black).
+
+    Returns:
+        bool: True if the display was updated.
+    """
+    global _last
+
+    state = display_state(names_mid, names_aud)
+    fingerprint = display_fingerprint(state)
+
+    # Check if the last display update was the same, if so exit
+    if _last is None and os.path.exists(file_last):
+        with open(file_last, "r") as file:
+            _last = file.read()
+
+    if fingerprint == _last and not force:
+        metrics.count("display_unchanged")
+        return False
+
+    out = backend()
+    with metrics.timer("render"):
+        img = display_render(state, out)
+        if fast:
+            img = img.point(lambda index: out.BLACK if index == out.RED else index)
+    with _lock, metrics.timer("refresh", backend=type(out).__name__, kind="fast" if fast else "full"):
+        out.show(img, fast)
+
+    _last = fingerprint
+    with open(file_last, "w") as file:
+        file.write(fingerprint)
+
+    return True
+
+def bye(msg = "", msg_smol = ""):
+    from PIL import ImageDraw
+
+    out = backend()
+    img_logo = image("logo-boot.png").copy()
+
+    if len(msg) or len(msg_smol):
+        draw = ImageDraw.Draw(img_logo)
+        if len(msg):
+            msg_font = font("SourceSansProSemibold", 30)
+            draw.multiline_text(((out.width / 2) + 6, out.height - 96), msg, fill=out.BLACK, font=msg_font, align="left")
+        if len(msg_smol):
+            msg_font_smol = font("SourceSansProSemibold", 14)
+            w, h = getsize(msg_font_smol, msg_smol)
+            draw.multiline_text(((out.width / 2) - (w / 2), out.height - 30), msg_smol, fill=out.BLACK, font=msg_font_smol, align="left")
+
+    with _lock:
+        out.show(img_logo)
+
+class Refresher:
+    """
+    Display refresh scheduler, so callers (hotplug, web) never wait on the panel.
+
+    Requests are batched on a worker thread: the display updates once no new
+    request came for `settle` seconds (at most 5 x `settle` after the first).
+    With the "colourful" display_mode a full colour refresh happens at most
+    once per `full_interval` seconds, changes in between are shown at once
+    with a fast black and white refresh and a full colour refresh of the
+    current content follows when the interval is up (also clearing the
+    ghosting fast refreshes leave). The "fast" mode only does fast refreshes.
+    """
+
+    def __init__(self, settle = 2.0, full_interval = 180):
+        self.settle = settle
+        self.full_interval = full_interval
+        self.cond = threading.Condition()
+        self.pending = False
+        self.force = False
+        self.first = 0
+        self.last = 0
+        self.last_full = None
+        self.dirty = False # Fast refreshes since the last full one
+        self.counts = {"requests": 0, "full": 0, "fast": 0, "unchanged": 0}
+        self.thread = threading.Thread(target=self._run, name="display", daemon=True)
+        self.thread.start()
+
+    def request(self, force = False):
+        """
+        Asks for a display update (returns at once).
+        """
+        with self.cond:
+            now = time.monotonic()
+            if not self.pending:
+                self.first = now
+            self.pending = True
+            self.force = self.force or force
+            self.last = now
+            self.counts["requests"] += 1
+            self.cond.notify()
+
+    def _full_due(self, now):
+        return self.last_full is None or now - self.last_full >= self.full_interval
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    if self.pending:
+                        due = min(self.last + self.settle, self.first + self.settle * 5)
+                    elif self.dirty:
+                        due = self.last_full + self.full_interval
+                    else:
+                        due = None
+                    if due is not None and now >= due:
+                        break
+                    self.cond.wait(None if due is None else due - now)
+
+                requested = self.pending
+                force = self.force or not requested # Clean up: same content, full colour
+                self.pending = False
+                self.force = False
+
+            full = settings["display_mode"] == "colourful" and self._full_due(now)
+            if not full and not requested:
+                self.dirty = False # Mode switched to fast, nothing to clean up
+                continue
+
+            try:
+                changed = display(state.get("midi"), state.get("audio"), force, not full)
+            except Exception as e:
+                log("Display: refresh failed (" + repr(e) + ")")
+                continue
+
+            with self.cond:
+                if not changed:
+                    self.counts["unchanged"] += 1
+                elif full:
+                    self.counts["full"] += 1
+                    self.last_full = time.monotonic()
+                    self.dirty = False
+                else:
+                    self.counts["fast"] += 1
+                    self.dirty = settings["display_mode"] == "colourful"
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counts, mode=settings["display_mode"], pending=self.pending, cleanup_pending=self.dirty,
+                last_full_s=None if self.last_full is None else round(time.monotonic() - self.last_full, 1))
+
+_refresher = None
+
+def refresher():
+    """
+    Returns the shared display Refresher (started on first use).
+    """
+    global _refresher
+
+    if _refresher is None:
+        _refresher = Refresher(settings["display_settle"], settings["display_full_interval"])
+
+    return _refresher
@@ -0,0 +1,845 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_midi.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+MIDI routing for MIDI Pipes (ALSA sequencer, hotplug)
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import select
+import selectors
+from collections import deque
+
+from lib import *
+from lib_devices import devices, midi_key
+from lib_parse import aconnect_parse
+
+names = [] # Contains the list of MIDI devices found
+
+class _SeqAddr(ctypes.Structure):
+    _fields_ = [("client", ctypes.c_ubyte), ("port", ctypes.c_ubyte)]
+
+class _SeqEvent(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_ubyte),
+        ("flags", ctypes.c_ubyte),
+        ("tag", ctypes.c_byte),
+        ("queue", ctypes.c_ubyte),
+        ("time", ctypes.c_uint * 2),
+        ("source", _SeqAddr),
+        ("dest", _SeqAddr),
+        ("data", ctypes.c_ubyte * 12),
+    ]
+
+class _PollFd(ctypes.Structure):
+    _fields_ = [("fd", ctypes.c_int), ("events", ctypes.c_short), ("revents", ctypes.c_short)]
+
+class Seq:
+    """
+    Minimal ctypes binding to the ALSA sequencer (libasound).
+
+    Reads the client, port and subscription graph and adds or removes single
+    subscriptions without forking aconnect.
+    """
+
+    OPEN_DUPLEX = 3
+    QUERY_SUBS_READ = 0
+    CAP_READ = 1 << 0
+    CAP_WRITE = 1 << 1
+    CAP_SUBS_READ = 1 << 5
+    CAP_SUBS_WRITE = 1 << 6
+    CAP_NO_EXPORT = 1 << 7
+    PORT_TYPE_APPLICATION = 1 << 20
+    EVENT_CLIENT_START = 60
+    EVENT_CLIENT_EXIT = 61
+    EVENT_PORT_START = 63
+    EVENT_PORT_EXIT = 64
+
+    _lib = None
+    _cards = False # snd_seq_client_info_get_card() available (alsa-lib 1.1.5+)
+
+    @classmethod
+    def library(cls):
+        if cls._lib is None:
+            path = ctypes.util.find_library("asound")
+            if path is None:
+                raise OSError("libasound not found")
+            lib = ctypes.CDLL(path)
+            lib.snd_seq_client_info_get_name.restype = ctypes.c_char_p
+            lib.snd_seq_port_info_get_name.restype = ctypes.c_char_p
+            lib.snd_seq_query_subscribe_get_addr.restype = ctypes.POINTER(_SeqAddr)
+            lib.snd_seq_port_info_get_capability.restype = ctypes.c_uint
+            lib.snd_strerror.restype = ctypes.c_char_p
+            lib.snd_seq_event_input.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.POINTER(_SeqEvent))]
+            lib.snd_seq_event_output.argtypes = [ctypes.c_void_p, ctypes.POINTER(_SeqEvent)]
+            cls._cards = hasattr(lib, "snd_seq_client_info_get_card")
+            cls._lib = lib
+        return cls._lib
+
+    def __init__(self, name="MIDI Pipes"):
+        self.lib = self.library()
+        self.handle = ctypes.c_void_p()
+        err = self.lib.snd_seq_open(ctypes.byref(self.handle), b"default", self.OPEN_DUPLEX, 0)
+        if err < 0:
+            raise OSError("snd_seq_open: " + self.lib.snd_strerror(err).decode())
+        self.lib.snd_seq_set_client_name(self.handle, name.encode())
+        self.client = self.lib.snd_seq_client_id(self.handle)
+        self.lock = threading.Lock() # Queries and subscriptions over one handle (shared by threads)
+
+    def close(self):
+        if self.handle:
+            self.lib.snd_seq_close(self.handle)
+            self.handle = ctypes.c_void_p()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def graph(self):
+        """
+        Returns the current sequencer graph.
+
+        Returns:
+            dict: "clients" {id: name}, "cards" {id: ALSA card number} (kernel
+            clients), "ports" {(client, port): caps} and "edges" {((client, port), (client, port))}.
+        """
+        with self.lock:
+            return self._graph()
+
+    def _graph(self):
+        lib = self.lib
+        graph = {"clients": {}, "cards": {}, "ports": {}, "edges": set()}
+
+        cinfo = ctypes.c_void_p()
+        pinfo = ctypes.c_void_p()
+        query = ctypes.c_void_p()
+        lib.snd_seq_client_info_malloc(ctypes.byref(cinfo))
+        lib.snd_seq_port_info_malloc(ctypes.byref(pinfo))
+        lib.snd_seq_query_subscribe_malloc(ctypes.byref(query))
+
+        try:
+            lib.snd_seq_client_info_set_client(cinfo, -1)
+            while lib.snd_seq_query_next_client(self.handle, cinfo) >= 0:
+                client = lib.snd_seq_client_info_get_client(cinfo)
+                graph["clients"][client] = lib.snd_seq_client_info_get_name(cinfo).decode(errors="replace")
+                if self._cards and lib.snd_seq_client_info_get_card(cinfo) >= 0:
+                    graph["cards"][client] = lib.snd_seq_client_info_get_card(cinfo)
+
+                lib.snd_seq_port_info_set_client(pinfo, client)
+                lib.snd_seq_port_info_set_port(pinfo, -1)
+                while lib.snd_seq_query_next_port(self.handle, pinfo) >= 0:
+                    port = lib.snd_seq_port_info_get_port(pinfo)
+                    caps = lib.snd_seq_port_info_get_capability(pinfo)
+                    graph["ports"][(client, port)] = caps
+
+                    if not caps & self.CAP_READ:
+                        continue
+
+                    root = _SeqAddr(client, port)
+                    lib.snd_seq_query_subscribe_set_root(query, ctypes.byref(root))
+                    lib.snd_seq_query_subscribe_set_type(query, self.QUERY_SUBS_READ)
+                    lib.snd_seq_query_subscribe_set_index(query, 0)
+                    while lib.snd_seq_query_port_subscribers(self.handle, query) >= 0:
+                        addr = lib.snd_seq_query_subscribe_get_addr(query).contents
+                        graph["edges"].add(((client, port), (addr.client, addr.port)))
+                        lib.snd_seq_query_subscribe_set_index(query, lib.snd_seq_query_subscribe_get_index(query) + 1)
+        finally:
+            lib.snd_seq_query_subscribe_free(query)
+            lib.snd_seq_port_info_free(pinfo)
+            lib.snd_seq_client_info_free(cinfo)
+
+        return graph
+
+    def subscribe(self, src, dst, connect=True):
+        """
+        Adds (or removes) a single subscription between two ports.
+
+        Args:
+            src (tuple): Sender (client, port).
+            dst (tuple): Destination (client, port).
+            connect (bool): False to remove the subscription instead.
+
+        Returns:
+            bool: True if the change was applied.
+        """
+        lib = self.lib
+        sub = ctypes.c_void_p()
+        sender = _SeqAddr(*src)
+        dest = _SeqAddr(*dst)
+        lib.snd_seq_port_subscribe_malloc(ctypes.byref(sub))
+        try:
+            lib.snd_seq_port_subscribe_set_sender(sub, ctypes.byref(sender))
+            lib.snd_seq_port_subscribe_set_dest(sub, ctypes.byref(dest))
+            with self.lock:
+                if connect:
+                    err = lib.snd_seq_subscribe_port(self.handle, sub)
+                else:
+                    err = lib.snd_seq_unsubscribe_port(self.handle, sub)
+        finally:
+            lib.snd_seq_port_subscribe_free(sub)
+
+        return err >= 0
+
+    def announce(self):
+        """
+        Subscribes to the System Announce port and switches to non-blocking input.
+
+        The receiving port is write-only and not exported, so it is never routed.
+
+        Returns:
+            int: File descriptor to poll for announcements (see events()).
+        """
+        lib = self.lib
+        port = lib.snd_seq_create_simple_port(self.handle, b"Announce", self.CAP_WRITE | self.CAP_NO_EXPORT, self.PORT_TYPE_APPLICATION)
+        if port < 0 or lib.snd_seq_connect_from(self.handle, port, 0, 1) < 0:
+            raise OSError("Unable to subscribe to the ALSA sequencer announce port")
+
+        lib.snd_seq_nonblock(self.handle, 1)
+        pfd = _PollFd()
+        lib.snd_seq_poll_descriptors(self.handle, ctypes.byref(pfd), 1, select.POLLIN)
+
+        return pfd.fd
+
+    def events(self):
+        """
+        Drains pending announcements.
+
+        Returns:
+            list: (type, client, port) of the client / port start and exit events
+                of other clients (subscription changes are ignored).
+        """
+        hotplug = (self.EVENT_CLIENT_START, self.EVENT_CLIENT_EXIT, self.EVENT_PORT_START, self.EVENT_PORT_EXIT)
+        event = ctypes.POINTER(_SeqEvent)()
+        events = []
+
+        while self.lib.snd_seq_event_input(self.handle, ctypes.byref(event)) >= 0:
+            ev = event.contents
+            if ev.type in hotplug and ev.data[0] != self.client:
+                events.append((ev.type, ev.data[0], ev.data[1]))
+
+        return events
+
+def seq_open(name="MIDI Pipes"):
+    """
+    Opens an ALSA sequencer client, or returns None so callers fall back to aconnect.
+    """
+    try:
+        return Seq(name)
+    except (OSError, AttributeError) as e:
+        log("MIDI: ALSA sequencer unavailable (" + str(e) + "), using aconnect")
+        return None
+
+_seq = None
+_seq_opened = False
+_seq_lock = threading.Lock()
+
+def seq_resident():
+    """
+    Returns the process's resident sequencer client (opened once, on first use) for
+    reading the graph and changing subscriptions, or None if the ALSA sequencer is
+    unavailable (aconnect fallback). One client for the life of the process, so
+    reads don't announce a new client (a hotplug event) each time.
+    """
+    global _seq, _seq_opened
+
+    with _seq_lock:
+        if not _seq_opened:
+            _seq = seq_open()
+            _seq_opened = True
+
+    return _seq
+
+def midi_graph(seq=None):
+    """
+    Reads the current MIDI graph once (ALSA sequencer, or aconnect if unavailable).
+
+    Managed clients are the real devices: not System, Midi Through or MIDI Pipes itself,
+    with a subscribable port 0.
+    """
+    if seq is not None:
+        graph = seq.graph()
+        own = seq.client
+    else:
+        graph = {"clients": {}, "cards": {}, "ports": {}, "edges": set()}
+        own = None
+        output = shell(tool("/usr/bin/aconnect") + " -i -l")
+        aconnect_parse(output, Seq.CAP_READ | Seq.CAP_SUBS_READ, graph)
+        output = shell(tool("/usr/bin/aconnect") + " -o -l")
+        aconnect_parse(output, Seq.CAP_WRITE | Seq.CAP_SUBS_WRITE, graph)
+
+    routable = Seq.CAP_SUBS_READ | Seq.CAP_SUBS_WRITE
+    graph["managed"] = set()
+    for (client, port), caps in graph["ports"].items():
+        if client != 0 and client != own and 'Through' not in graph["clients"].get(client, "") and caps & routable and not caps & Seq.CAP_NO_EXPORT:
+            graph["managed"].add(client)
+
+    return graph
+
+routes_default = [{"from": "*", "to": "*"}] # Port 0 of every device to port 0 of every other device
+
+class Routes:
+    """
+    MIDI routing matrix, compiled from declarative rules (the "routes" setting).
+
+    Each rule matches client names with shell style patterns, e.g.
+    {"from": "Arturia KeyStep*", "to": "*", "from_port": 0, "to_port": 1}
+    or {"from": "*", "to": "MIDI Pipes Bluetooth*", "exclude": true}.
+    For each source / destination pair the first matching rule decides: an
+    "exclude" rule means no connection, otherwise from_port -> to_port (both
+    default to 0), or every [from_port, to_port] mapping in "ports", e.g.
+    {"from": "Keystep*", "to": "Digitakt*", "ports": [[0, 0], [1, 1]]}.
+    Devices are never connected to themselves.
+
+    Patterns are matched once per client name and the connections of each
+    client pair are kept between passes: a pass works out the connections of
+    the clients that appeared, went or changed (name or ports) only, i.e.
+    O(changed clients x managed clients). The graph itself is still read in
+    full and diffed against the wanted set by midi().
+    """
+
+    readable = Seq.CAP_READ | Seq.CAP_SUBS_READ
+    writable = Seq.CAP_WRITE | Seq.CAP_SUBS_WRITE
+
+    def __init__(self, rules=None):
+        self.rules = routes_check(routes_default if rules is None else rules)
+        self.patterns = [(re.compile(fnmatch.translate(rule.get("from", "*"))), re.compile(fnmatch.translate(rule.get("to", "*")))) for rule in self.rules]
+        self.table = {} # Client name -> (rules it is a source for, rules it is a destination for)
+        self.lock = threading.Lock()
+        self.clients = {} # Managed client -> (name, {port: caps}) as of the last pass
+        self.connections = {} # (source client, destination client) -> ((source, destination, rule), ...)
+
+    def match(self, name):
+        if name not in self.table:
+            self.table[name] = (
+                frozenset(i for i, (src, dst) in enumerate(self.patterns) if src.match(name)),
+                frozenset(i for i, (src, dst) in enumerate(self.patterns) if dst.match(name)),
+            )
+        return self.table[name]
+
+    def route(self, src_name, dst_name):
+        """
+        Returns the rule connecting two clients, or None if they are not connected.
+        """
+        matched = self.match(src_name)[0] & self.match(dst_name)[1]
+        if not matched:
+            return None
+
+        rule = self.rules[min(matched)]
+        return None if rule.get("exclude") else rule
+
+    def connect(self, src, dst):
+        """
+        Returns the connections between two managed clients ((source, destination, rule), ...).
+        """
+        (src_name, src_ports), (dst_name, dst_ports) = self.clients[src], self.clients[dst]
+        rule = self.route(src_name, dst_name)
+        if rule is None:
+            return ()
+
+        found = []
+        for from_port, to_port in rule.get("ports", [[rule.get("from_port", 0), rule.get("to_port", 0)]]):
+            if src_ports.get(from_port, 0) & self.readable == self.readable and dst_ports.get(to_port, 0) & self.writable == self.writable:
+                found.append(((src, from_port), (dst, to_port), rule))
+        return tuple(found)
+
+    def pairs(self, graph):
+        """
+        Returns [(source (client, port), destination (client, port), rule)] for every connection between managed clients.
+        """
+        clients = {client: (graph["clients"][client], {}) for client in graph["managed"]}
+        for (client, port), caps in graph["ports"].items():
+            if client in clients:
+                clients[client][1][port] = caps
+
+        with self.lock:
+            changed = {client for client in clients.keys() | self.clients.keys() if clients.get(client) != self.clients.get(client)}
+            if changed:
+                self.connections = {pair: found for pair, found in self.connections.items() if pair[0] not in changed and pair[1] not in changed}
+                self.clients = clients
+                for client in changed & clients.keys():
+                    for other in clients:
+                        if other != client:
+                            self.connections[(client, other)] = self.connect(client, other)
+                            self.connections[(other, client)] = self.connect(other, client)
+
+            return [connection for found in self.connections.values() for connection in found]
+
+    def wanted(self, graph, direct=False):
+        """
+        Returns the wanted subscriptions {((client, port), (client, port))} between managed clients.
+
+        Args:
+            graph (dict): Graph as returned by midi_graph().
+            direct (bool): Leave out the connections going through the processor.
+        """
+        return {(src, dst) for src, dst, rule in self.pairs(graph) if not (direct and "process" in rule)}
+
+    def processed(self, graph):
+        """
+        Returns the connections going through the processor {(source, destination): process options}.
+        """
+        return {(src, dst): rule["process"] for src, dst, rule in self.pairs(graph) if "process" in rule}
+
+    def matrix(self, graph):
+        """
+        Returns the routing matrix for the web interface: {source name: {destination name: "from_port:to_port"}},
+        with " (processed)" added to connections going through the processor.
+        """
+        matrix = {}
+        for (src, src_port), (dst, dst_port), rule in self.pairs(graph):
+            row = matrix.setdefault(graph["clients"][src], {})
+            route = str(src_port) + ":" + str(dst_port) + (" (processed)" if "process" in rule else "")
+            row[graph["clients"][dst]] = row[graph["clients"][dst]] + ", " + route if graph["clients"][dst] in row else route
+        return matrix
+
+def routes_check(rules):
+    """
+    Validates routing rules.
+
+    Raises:
+        ValueError: If a rule is not a dict with string patterns and integer ports.
+    """
+    if not isinstance(rules, list):
+        raise ValueError("Routes must be a list of rules")
+
+    for rule in rules:
+        if not isinstance(rule, dict) or set(rule) - {"from", "to", "from_port", "to_port", "ports", "exclude", "process"}:
+            raise ValueError("Invalid route: " + json.dumps(rule))
+        if not isinstance(rule.get("from", ""), str) or not isinstance(rule.get("to", ""), str):
+            raise ValueError("Route patterns must be strings: " + json.dumps(rule))
+        ports = [rule.get("from_port", 0), rule.get("to_port", 0)]
+        if "ports" in rule:
+            if not isinstance(rule["ports"], list) or not all(isinstance(pair, list) and len(pair) == 2 for pair in rule["ports"]):
+                raise ValueError("Route ports must be a list of [from_port, to_port]: " + json.dumps(rule))
+            ports = [port for pair in rule["ports"] for port in pair]
+        if not all(type(port) is int and 0 <= port < 256 for port in ports): # Not bool
+            raise ValueError("Route ports must be 0-255: " + json.dumps(rule))
+        if "process" in rule:
+            process_check(rule["process"])
+
+    return rules
+
+def process_check(options):
+    """
+    Validates the processing options of a route.
+
+    Raises:
+        ValueError: On unknown options, message types or channels.
+    """
+    if not isinstance(options, dict) or set(options) - {"drop", "channels", "clock_divide", "rate"}:
+        raise ValueError("Invalid process options: " + json.dumps(options))
+    if not isinstance(options.get("drop", []), list):
+        raise ValueError("'drop' must be a list of message types: " + json.dumps(options["drop"]))
+    for kind in options.get("drop", []):
+        if not isinstance(kind, str) or kind not in Processor.TYPES:
+            raise ValueError("Unknown message type '" + str(kind) + "', use: " + ", ".join(Processor.TYPES))
+    if not isinstance(options.get("channels", {}), dict):
+        raise ValueError("'channels' must map channels to channels, e.g. {\"1\": 10}: " + json.dumps(options["channels"]))
+    for src, dst in options.get("channels", {}).items():
+        if not re.fullmatch(r"\d{1,2}", str(src)) or not 1 <= int(src) <= 16 or type(dst) is not int or not 1 <= dst <= 16:
+            raise ValueError("Channels must be 1-16: " + json.dumps(options["channels"]))
+    for key in ("clock_divide", "rate"):
+        if type(options.get(key, 0)) is not int or options.get(key, 0) < 0:
+            raise ValueError("'" + key + "' must be a positive integer")
+
+_routes = None
+
+def routes():
+    """
+    Returns the compiled routing rules (compiled again only when the "routes" setting changes).
+    """
+    global _routes
+
+    rules = settings.get("routes", routes_default)
+    if _routes is None or _routes.rules != rules:
+        _routes = Routes(rules)
+
+    return _routes
+
+def routes_set(rules):
+    """
+    Validates, saves and compiles new routing rules (apply them with midi()).
+    """
+    routes_check(rules)
+    settings["routes"] = rules
+    settings_set(settings)
+
+    return routes()
+
+def midi_wanted(graph):
+    """
+    Returns the wanted subscriptions according to the routing rules. Processed
+    routes are connected directly only while no processor runs, in this process
+    or another one (e.g. midi.py or web.py next to the daemon's processor, whose
+    direct connections would deliver the events twice).
+    """
+    running = processor is not None or Processor.NAME in graph["clients"].values()
+    return routes().wanted(graph, running)
+
+class _Route:
+    """
+    One processed source -> destination connection and its filter state.
+    """
+
+    __slots__ = ("client", "port", "allow", "channels", "divide", "ticks", "rate", "tokens", "last")
+
+    def __init__(self, dst, options):
+        self.client, self.port = dst
+        self.allow = bytearray(b"\1" * 256) # By event type
+        for kind in options.get("drop", []):
+            for value in Processor.TYPES[kind]:
+                self.allow[value] = 0
+
+        self.channels = None
+        if options.get("channels"):
+            self.channels = bytearray(range(16))
+            for src, ch in options["channels"].items():
+                self.channels[int(src) - 1] = ch - 1
+
+        self.divide = options.get("clock_divide", 0)
+        self.ticks = 0
+        self.rate = options.get("rate", 0)
+        self.tokens = float(self.rate)
+        self.last = time.perf_counter()
+
+class Processor:
+    """
+    Optional in-process MIDI processing stage, for routes with a "process" entry, e.g.
+    {"from": "*", "to": "BLE*", "process": {"drop": ["sensing"], "channels": {"1": 10}, "clock_divide": 2, "rate": 200}}
+
+    Processed routes are not subscribed device to device: the sources are
+    subscribed to the processor's input port and a dedicated thread (real-time
+    priority when allowed) forwards each event to its destinations, dropping
+    message types, remapping channels, passing every Nth clock tick and limiting
+    continuous data (control, pressure, pitch bend) to "rate" events per second.
+
+    Events are read in batches straight from the libasound input buffer and edited
+    in place, filter state is precompiled per route and the output is drained once
+    per batch.
+    """
+
+    TYPES = {
+        "note": (6, 7, 8),
+        "control": (10, 14, 15, 16),
+        "program": (11,),
+        "pressure": (12,),
+        "pitchbend": (13,),
+        "transport": (20, 21, 30, 31, 32),
+        "clock": (36,),
+        "sensing": (42,),
+        "sysex": (130,),
+    }
+    CHANNEL_EVENTS = range(6, 17) # Events with the channel in their first data byte
+    RATED_EVENTS = (10, 12, 13, 14)
+    EVENT_START = 30
+    EVENT_CLOCK = 36
+    QUEUE_DIRECT = 253
+    BATCH = 64
+    NAME = "MIDI Pipes Processor" # Sequencer client name (other processes look for it)
+
+    def __init__(self, name=NAME):
+        self.seq = Seq(name)
+        lib = self.seq.lib
+        self.in_port = lib.snd_seq_create_simple_port(self.seq.handle, b"In", Seq.CAP_WRITE | Seq.CAP_NO_EXPORT, Seq.PORT_TYPE_APPLICATION)
+        self.out_port = lib.snd_seq_create_simple_port(self.seq.handle, b"Out", Seq.CAP_READ | Seq.CAP_NO_EXPORT, Seq.PORT_TYPE_APPLICATION)
+        if self.in_port < 0 or self.out_port < 0:
+            raise OSError("Unable to create the MIDI processor ports")
+
+        lib.snd_seq_nonblock(self.seq.handle, 1)
+        pfd = _PollFd()
+        lib.snd_seq_poll_descriptors(self.seq.handle, ctypes.byref(pfd), 1, select.POLLIN)
+        self.fd = pfd.fd
+
+        self.lock = threading.Lock()
+        self.table = {} # Source (client, port) -> [_Route], replaced (never changed) by update()
+        self.inputs = set()
+        self.running = False
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.processing = deque(maxlen=1000) # Seconds from wake up to the batch being sent (kernel delivery not included)
+        self.last_stats = (time.monotonic(), 0)
+
+    def update(self, processed):
+        """
+        Applies the processed connections (as returned by Routes.processed()).
+        """
+        lib = self.seq.lib
+        table = {}
+        for (src, dst), options in sorted(processed.items()):
+            table.setdefault(src, []).append(_Route(dst, options))
+
+        with self.lock:
+            inputs = {src for src, dst in processed}
+            for client, port in self.inputs - inputs:
+                lib.snd_seq_disconnect_from(self.seq.handle, self.in_port, client, port)
+            for client, port in inputs - self.inputs:
+                if lib.snd_seq_connect_from(self.seq.handle, self.in_port, client, port) < 0:
+                    log("MIDI: processor could not subscribe to " + str(client) + ":" + str(port))
+            self.inputs = inputs
+            self.table = table
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name="midi-processor", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(settings.get("midi_processor_priority", 50)))
+        except (AttributeError, OSError) as e:
+            log("MIDI: processor running without real-time priority (" + str(e) + ")")
+
+        lib = self.seq.lib
+        handle = self.seq.handle
+        event = ctypes.POINTER(_SeqEvent)()
+        event_ref = ctypes.byref(event)
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        clock = time.perf_counter
+
+        while self.running:
+            if lib.snd_seq_event_input_pending(handle, 0) == 0:
+                poller.poll(1000)
+            woke = clock()
+
+            count = 0
+            while count < self.BATCH and lib.snd_seq_event_input(handle, event_ref) >= 0:
+                count += 1
+                source = event.contents.source
+                routes = self.table.get((source.client, source.port))
+                if routes is not None:
+                    self.forward(lib, handle, event, routes, woke)
+
+            if count:
+                lib.snd_seq_drain_output(handle)
+                self.received += count
+                self.processing.append(clock() - woke)
+
+    def forward(self, lib, handle, event, routes, now):
+        """
+        Queues one input event for each of its routes (sent by the caller's drain).
+        """
+        ev = event.contents
+        type = ev.type
+        channel = ev.data[0]
+        ev.source.port = self.out_port
+        ev.queue = self.QUEUE_DIRECT
+
+        for route in routes:
+            if not route.allow[type]:
+                self.dropped += 1
+                continue
+
+            if route.divide > 1:
+                if type == self.EVENT_START:
+                    route.ticks = 0
+                elif type == self.EVENT_CLOCK:
+                    route.ticks += 1
+                    if (route.ticks - 1) % route.divide:
+                        continue
+
+            if route.rate and type in self.RATED_EVENTS:
+                route.tokens = min(route.rate, route.tokens + (now - route.last) * route.rate)
+                route.last = now
+                if route.tokens < 1:
+                    self.dropped += 1
+                    continue
+                route.tokens -= 1
+
+            if type in self.CHANNEL_EVENTS:
+                ev.data[0] = channel if route.channels is None else route.channels[channel & 15]
+
+            ev.dest.client = route.client
+            ev.dest.port = route.port
+            if lib.snd_seq_event_output(handle, event) < 0:
+                self.dropped += 1
+            else:
+                self.sent += 1
+
+    def stats(self):
+        """
+        Returns the event counts, events per second (since the previous call) and the processing
+        time per batch (end to end latency, kernel delivery included: dev/bench/bench_midi.py --processed).
+        """
+        now = time.monotonic()
+        then, received = self.last_stats
+        self.last_stats = (now, self.received)
+
+        processing = sorted(self.processing)
+        def percentile(p):
+            return round(processing[min(len(processing) - 1, int(len(processing) * p))] * 1000, 3) if processing else 0
+
+        return {
+            "routes": sum(len(routes) for routes in self.table.values()),
+            "inputs": len(self.inputs),
+            "received": self.received,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "events_per_s": round((self.received - received) / max(now - then, 0.001), 1),
+            "processing_ms": {"p50": percentile(0.5), "p99": percentile(0.99), "max": percentile(1)},
+        }
+
+processor = None # Running Processor, see processor_start()
+
+def processor_wanted():
+    """
+    Returns True if the processor should run: the "midi_processor" setting, or
+    by default whether any routing rule has processing options.
+    """
+    return settings.get("midi_processor", any("process" in rule for rule in routes().rules))
+
+def processor_start():
+    """
+    Starts the MIDI processor (processed routes are connected directly until it runs).
+
+    Returns:
+        Processor: The running processor, or None if the ALSA sequencer is unavailable.
+    """
+    global processor
+
+    if processor is None:
+        try:
+            processor = Processor()
+        except (OSError, AttributeError) as e:
+            log("MIDI: processor unavailable (" + str(e) + ")")
+            return None
+        processor.start()
+        log("MIDI: processor started")
+
+    return processor
+
+def midi_devices(seq=None):
+    graph = midi_graph(seq or seq_resident())
+    names = [graph["clients"][client] for client in graph["managed"]]
+
+    return sorted(list(set(names)))
+
+def midi_routes(seq=None):
+    """
+    Returns the routing rules and the connections they result in, for the web interface.
+    """
+    graph = midi_graph(seq or seq_resident())
+
+    return {"rules": routes().rules, "devices": sorted(set(graph["clients"][client] for client in graph["managed"])), "matrix": routes().matrix(graph)}
+
+def midi(seq=None):
+    """
+    Connects MIDI devices, only adding or removing the connections that differ.
+
+    Connections that are already in place are never touched, so notes that are
+    playing are not cut off when a device is plugged in or removed.
+
+    Args:
+        seq (Seq): Open sequencer client to use, the resident one (see seq_resident()) by default.
+    """
+    global names
+
+    started = time.monotonic()
+    if seq is None:
+        seq = seq_resident()
+
+    with lock():
+        graph = midi_graph(seq)
+        wanted = midi_wanted(graph)
+        current = {edge for edge in graph["edges"] if edge[0][0] in graph["managed"] and edge[1][0] in graph["managed"]}
+
+        removed = current - wanted
+        added = wanted - current
+
+        for src, dst in sorted(removed):
+            if seq is not None:
+                seq.subscribe(src, dst, False)
+            else:
+                shell(f"{tool('/usr/bin/aconnect')} -d {src[0]}:{src[1]} {dst[0]}:{dst[1]}", False)
+
+        for src, dst in sorted(added):
+            if seq is not None:
+                seq.subscribe(src, dst)
+            else:
+                shell(f"{tool('/usr/bin/aconnect')} {src[0]}:{src[1]} {dst[0]}:{dst[1]}", False)
+
+        if processor is not None:
+            processor.update(routes().processed(graph))
+
+    names = sorted(graph["clients"][client] for client in graph["managed"])
+    shared = {name for name in names if names.count(name) > 1} # Told apart by client number
+    devices.update("midi", {client: graph["clients"][client] for client in graph["managed"]},
+        lambda client, name: midi_key(name, graph["cards"].get(client), client if name in shared else None))
+
+    if len(names) < 1:
+        log("Devices: None found")
+    else:
+        log("Devices: " + ", ".join(str(name) for name in names))
+
+    state.invalidate("midi")
+
+    metrics.observe("reconcile", time.monotonic() - started, kind="midi")
+    metrics.count("midi_connections_added", len(added))
+    metrics.count("midi_connections_removed", len(removed))
+
+    log("MIDI: +" + str(len(added)) + " -" + str(len(removed)) + " connections in " + str(round((time.monotonic() - started) * 1000, 1)) + "ms")
+
+def uevent_socket():
+    """
+    Opens a netlink socket receiving kernel uevents (what udev listens to).
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 15) # NETLINK_KOBJECT_UEVENT
+    sock.bind((0, 1)) # Kernel multicast group
+    return sock
+
+def uevent_relevant(data):
+    """
+    Returns True for USB, sound and Bluetooth add / remove uevents.
+    """
+    fields = {}
+    for item in data.split(b"\0")[1:]:
+        key, _, value = item.partition(b"=")
+        fields[key] = value
+
+    return fields.get(b"ACTION") in (b"add", b"remove") and fields.get(b"SUBSYSTEM") in (b"usb", b"sound", b"bluetooth")
+
+def hotplug_watch(callback):
+    """
+    Watches udev (netlink) and the ALSA sequencer announce port and calls
+    callback(source, count) for relevant events ("udev" or "seq"). Never returns.
+    """
+    sel = selectors.DefaultSelector()
+    uevents = uevent_socket()
+    sel.register(uevents, selectors.EVENT_READ, "udev")
+
+    watcher = seq_open("MIDI Pipes Hotplug")
+    if watcher is not None:
+        sel.register(watcher.announce(), selectors.EVENT_READ, "seq")
+
+    while True:
+        for key, _ in sel.select():
+            if key.data == "udev":
+                if uevent_relevant(uevents.recv(65536)):
+                    callback("udev", 1)
+            else:
+                count = len(watcher.events())
+                if count:
+                    callback("seq", count)
+
+state.register("midi", midi_devices)
@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_net.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Network MIDI between MIDI Pipes boxes (UDP transport, ALSA sequencer client)
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import ctypes
+import heapq
+import random
+import select
+import selectors
+import struct
+
+from lib import *
+from lib_midi import Seq, _SeqEvent, _PollFd
+
+net_port = 5008 # UDP port for MIDI data (the "net_port" setting)
+net_group = ("239.255.77.77", 5009) # Multicast group and port for peer discovery
+
+_HEADER = struct.Struct("!2sBBI") # Magic, version, message type, sender session
+_HELLO = struct.Struct("!H") # Data port, followed by the name
+_PING = struct.Struct("!Q") # Sender time (us)
+_PONG = struct.Struct("!QQQ") # Ping sender time, receive time, reply time (us)
+_ACK = struct.Struct("!Q") # Next sequence number expected (everything before it received or given up)
+_ENTRY = struct.Struct("!QQH") # Sequence number, sender time (us), MIDI length, followed by the MIDI bytes
+
+MAGIC = b"MP"
+VERSION = 1
+HELLO, BYE, PING, PONG, ACK, DATA = range(1, 7)
+
+def midi_split(midi, size):
+    """
+    Splits MIDI bytes into chunks of at most `size` bytes, at message boundaries
+    (a status byte other than the SysEx end). A message longer than `size` (i.e.
+    SysEx) is cut into pieces, played out in order they make up the message again.
+    """
+    if len(midi) <= size:
+        return [midi]
+
+    chunks = []
+    start = 0
+    boundary = 0 # Last message start in the current chunk
+    for index, byte in enumerate(midi):
+        if byte & 0x80 and byte != 0xF7:
+            boundary = index
+        if index - start >= size:
+            cut = boundary if boundary > start else index
+            chunks.append(midi[start:cut])
+            start = cut
+    chunks.append(midi[start:])
+    return chunks
+
+class _Peer:
+    """
+    Another MIDI Pipes box: address, clock estimate and receive state.
+    """
+
+    __slots__ = ("session", "name", "addr", "seen", "samples", "offset", "delay", "transit", "jitter", "next", "highest", "received",
+        "acked", "ack_sent", "last_data", "last_ping", "pings", "count", "recovered", "lost", "late", "duplicates")
+
+    def __init__(self, session, name, addr, acked):
+        self.session = session
+        self.name = name
+        self.addr = addr
+        self.seen = time.monotonic()
+        self.samples = deque(maxlen=8) # (round trip delay, clock offset) of the last pings, us
+        self.offset = None # Peer clock - our clock, us (from the fastest recent ping)
+        self.delay = None # Round trip network delay, us
+        self.transit = None
+        self.jitter = 0.0 # Interarrival jitter, us (RFC 3550)
+        self.next = None # Next sequence number expected from the peer
+        self.highest = 0
+        self.received = set() # Sequence numbers received after a gap
+        self.acked = acked # Next sequence number the peer expects from us
+        self.ack_sent = None
+        self.last_data = 0.0
+        self.last_ping = 0.0
+        self.pings = 0
+        self.count = 0
+        self.recovered = 0
+        self.lost = 0
+        self.late = 0
+        self.duplicates = 0
+
+class Transport:
+    """
+    Compact UDP transport for MIDI between MIDI Pipes boxes.
+
+    Peers find each other with multicast beacons on the local network (and/or
+    a list of static "host:port" peers), ping each other to estimate the clock
+    offset and network latency, and send each chunk of MIDI bytes to every peer
+    with a sequence number and a timestamp.
+
+    Lost packets are recovered from a journal: until a peer acknowledges them,
+    the most recent chunks are repeated in the following packets (and resent
+    while the sender is idle), so a lost note off still arrives. Received
+    chunks are played out in order, `buffer_ms` after their send time (in our
+    clock), which absorbs network jitter at a constant added latency.
+
+    Everything runs in one thread (run()), other file descriptors (e.g. the
+    ALSA sequencer) can be handled by the same loop with register().
+    """
+
+    JOURNAL = 8 # Unacknowledged chunks repeated per packet
+    JOURNAL_KEEP = 64 # Chunks kept for recovery, older gaps are given up
+    JOURNAL_AGE = 1.0 # Seconds before a chunk is too old to resend
+    RESEND = 0.02 # Seconds idle before unacknowledged chunks are resent
+    BEACON = 2.0 # Seconds between discovery beacons
+    PING = 1.0 # Seconds between pings (faster for the first few)
+    TIMEOUT = 10.0 # Seconds without packets before a peer is gone
+    MTU = 1400 # Largest datagram sent
+    CHUNK = MTU - _HEADER.size - 1 - _ENTRY.size # Most MIDI bytes per chunk, one always fits a datagram
+    RECEIVE = 65535 # Receive buffer, fits any UDP datagram (peers with a larger MTU too)
+
+    def __init__(self, name, port=net_port, peers=(), buffer_ms=5, discovery=True):
+        self.name = name
+        self.session = random.randint(1, 0xffffffff)
+        self.buffer = int(buffer_ms * 1000)
+        self.callback = None # callback(midi bytes, peer) for every chunk received, in order
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("", port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.static = []
+        for peer in peers:
+            host, _, peer_port = peer.rpartition(":")
+            self.static.append((socket.gethostbyname(host), int(peer_port)))
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self.handle)
+        self.discovery = self.discovery_socket() if discovery else None
+        if self.discovery is not None:
+            self.selector.register(self.discovery, selectors.EVENT_READ, self.handle)
+
+        self.lock = threading.Lock()
+        self.peers = {} # Session -> _Peer
+        self.journal = deque(maxlen=self.JOURNAL_KEEP) # (sequence, time us, MIDI bytes) sent
+        self.sequence = 0 # Of the last chunk sent
+        self.pending = [] # Heap of (play out time us, order, MIDI bytes, peer)
+        self.order = 0
+        self.running = False
+        self.thread = None
+        self.last_beacon = 0.0
+        self.sent = 0
+        self.send_errors = 0
+
+    def discovery_socket(self):
+        """
+        Opens the socket receiving discovery beacons, or returns None without multicast.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Several instances on one host
+            sock.bind(("", net_group[1]))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(net_group[0]) + socket.inet_aton("0.0.0.0"))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        except OSError as e:
+            sock.close()
+            log("Network: discovery unavailable (" + str(e) + "), static peers only")
+            return None
+        sock.setblocking(False)
+        return sock
+
+    def register(self, fd, callback):
+        """
+        Calls callback(fd) from the transport thread when fd is readable.
+        """
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def now(self):
+        return int(time.monotonic() * 1000000)
+
+    def send_packet(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+            self.sent += 1
+        except OSError:
+            self.send_errors += 1
+
+    def header(self, type):
+        return _HEADER.pack(MAGIC, VERSION, type, self.session)
+
+    def hello(self, addr):
+        self.send_packet(self.header(HELLO) + _HELLO.pack(self.port) + self.name.encode()[:200], addr)
+
+    def send(self, midi):
+        """
+        Sends MIDI (complete messages, no running status) to every peer, in
+        chunks that fit a datagram.
+        """
+        with self.lock:
+            for chunk in midi_split(midi, self.CHUNK):
+                self.sequence += 1
+                self.journal.append((self.sequence, self.now(), chunk))
+                for peer in list(self.peers.values()):
+                    self.send_data(peer)
+
+    def send_data(self, peer):
+        """
+        Sends the chunks a peer has not acknowledged yet, newest first (the latest
+        chunk and the journal).
+        """
+        entries = []
+        size = _HEADER.size + 1
+        oldest = self.now() - int(self.JOURNAL_AGE * 1000000)
+        for seq, sent, midi in reversed(self.journal):
+            if seq < peer.acked or sent < oldest or len(entries) > self.JOURNAL or (entries and size + _ENTRY.size + len(midi) > self.MTU):
+                break
+            entries.append(_ENTRY.pack(seq, sent, len(midi)) + midi)
+            size += _ENTRY.size + len(midi)
+
+        if entries:
+            self.send_packet(self.header(DATA) + bytes([len(entries)]) + b"".join(entries), peer.addr)
+            peer.last_data = time.monotonic()
+
+    def handle(self, sock):
+        """
+        Handles every datagram waiting on a socket.
+        """
+        while True:
+            try:
+                data, addr = sock.recvfrom(self.RECEIVE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(data) < _HEADER.size:
+                continue
+            magic, version, type, session = _HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION or session == self.session:
+                continue
+
+            try:
+                with self.lock:
+                    self.message(type, session, data[_HEADER.size:], addr)
+            except struct.error:
+                log("Network: malformed packet from " + addr[0])
+
+    def message(self, type, session, body, addr):
+        now = self.now()
+        peer = self.peers.get(session)
+
+        if type == HELLO:
+            port = _HELLO.unpack_from(body)[0]
+            name = body[_HELLO.size:].decode(errors="replace")
+            if peer is None:
+                # A box that restarted has a new session, forget the old one
+                for old in [old for old in self.peers.values() if old.addr == (addr[0], port)]:
+                    del self.peers[old.session]
+                peer = _Peer(session, name, (addr[0], port), self.sequence + 1)
+                self.peers[session] = peer
+                log("Network: peer " + name + " at " + addr[0] + ":" + str(port))
+                self.hello(peer.addr)
+                self.ping(peer)
+            peer.seen = time.monotonic()
+            return
+
+        if peer is None:
+            return
+        peer.seen = time.monotonic()
+
+        if type == PING:
+            self.send_packet(self.header(PONG) + _PONG.pack(_PING.unpack_from(body)[0], now, self.now()), peer.addr)
+
+        elif type == PONG:
+            sent, received, replied = _PONG.unpack_from(body)
+            peer.samples.append((now - sent - (replied - received), ((received - sent) + (replied - now)) / 2))
+            peer.delay, peer.offset = min(peer.samples) # The fastest round trip has the least asymmetry
+
+        elif type == ACK:
+            peer.acked = max(peer.acked, _ACK.unpack_from(body)[0])
+
+        elif type == DATA:
+            entries = []
+            pos = 1
+            for _ in range(body[0]):
+                seq, sent, length = _ENTRY.unpack_from(body, pos)
+                pos += _ENTRY.size
+                entries.append((seq, sent, body[pos:pos + length]))
+                pos += length
+            if not entries:
+                return
+            latest = entries[0][0]
+            entries.sort(key=lambda entry: entry[0]) # Sent newest first, played out in order
+            if peer.next is None:
+                peer.next = entries[0][0]
+            for seq, sent, midi in entries:
+                self.receive(peer, seq, sent, midi, seq != latest or seq < peer.highest, now)
+
+        elif type == BYE:
+            del self.peers[session]
+            log("Network: peer " + peer.name + " left")
+
+    def receive(self, peer, seq, sent, midi, journal, now):
+        """
+        Queues a received chunk for play out, unless it is a duplicate.
+        """
+        if seq < peer.next or seq in peer.received:
+            peer.duplicates += 1
+            return
+
+        peer.count += 1
+        if journal:
+            peer.recovered += 1
+        else:
+            transit = now - sent
+            if peer.transit is not None:
+                peer.jitter += (abs(transit - peer.transit) - peer.jitter) / 16
+            peer.transit = transit
+
+        peer.highest = max(peer.highest, seq)
+        peer.received.add(seq)
+        while peer.next in peer.received:
+            peer.received.discard(peer.next)
+            peer.next += 1
+
+        # Gaps the sender's journal can no longer fill
+        while peer.highest - peer.next >= self.JOURNAL_KEEP:
+            if peer.next in peer.received:
+                peer.received.discard(peer.next)
+            else:
+                peer.lost += 1
+            peer.next += 1
+
+        if peer.offset is None:
+            due = now
+        else:
+            due = sent - peer.offset + peer.delay // 2 + self.buffer
+            if due < now:
+                peer.late += 1
+        self.order += 1
+        heapq.heappush(self.pending, (due, self.order, midi, peer))
+
+    def ping(self, peer):
+        peer.pings += 1
+        peer.last_ping = time.monotonic()
+        self.send_packet(self.header(PING) + _PING.pack(self.now()), peer.addr)
+
+    def deliver(self):
+        """
+        Plays out the chunks that are due, returns the seconds until the next one (or None).
+        """
+        while self.pending:
+            due = self.pending[0][0]
+            now = self.now()
+            if due > now:
+                return (due - now) / 1000000
+            due, order, midi, peer = heapq.heappop(self.pending)
+            if self.callback is not None:
+                self.callback(midi, peer)
+
+        return None
+
+    def tick(self):
+        """
+        Sends beacons, pings, acknowledgements and resends, expires silent peers.
+
+        Returns:
+            float: Seconds until tick() has something to do again.
+        """
+        now = time.monotonic()
+        wait = 0.25
+
+        with self.lock:
+            if now - self.last_beacon >= self.BEACON:
+                self.last_beacon = now
+                for addr in self.static + ([net_group] if self.discovery is not None else []):
+                    self.hello(addr)
+
+            for peer in list(self.peers.values()):
+                if now - peer.seen > self.TIMEOUT:
+                    del self.peers[peer.session]
+                    log("Network: peer " + peer.name + " timed out")
+                    continue
+
+                if now - peer.last_ping >= (self.PING if peer.pings >= 4 else self.PING / 10):
+                    self.ping(peer)
+                wait = min(wait, max(0.0, peer.last_ping + self.PING - now))
+
+                if peer.next is not None and peer.ack_sent != peer.next:
+                    peer.ack_sent = peer.next
+                    self.send_packet(self.header(ACK) + _ACK.pack(peer.next), peer.addr)
+
+                seq, sent, midi = self.journal[-1] if self.journal else (0, 0, b"")
+                if seq >= peer.acked and now - sent / 1000000 < self.JOURNAL_AGE:
+                    if now - peer.last_data >= self.RESEND:
+                        self.send_data(peer)
+                    wait = min(wait, self.RESEND)
+
+        return wait
+
+    def run(self):
+        while self.running:
+            timeout = min(wait for wait in (self.deliver(), self.tick()) if wait is not None)
+            for key, _ in self.selector.select(timeout):
+                key.data(key.fileobj)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="midi-net", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            for peer in self.peers.values():
+                self.send_packet(self.header(BYE), peer.addr)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1) # Out of select() (at most 0.25s) before the sockets are closed
+
+    def close(self):
+        """
+        Closes the sockets (of a transport not running).
+        """
+        self.selector.close()
+        self.sock.close()
+        if self.discovery is not None:
+            self.discovery.close()
+
+    def stats(self):
+        """
+        Returns the transport state and, per peer, the clock and latency estimates and receive counts.
+        """
+        def ms(us):
+            return None if us is None else round(us / 1000, 3)
+
+        with self.lock:
+            peers = [{
+                "name": peer.name,
+                "address": peer.addr[0] + ":" + str(peer.addr[1]),
+                "rtt_ms": ms(peer.delay),
+                "offset_ms": ms(peer.offset),
+                "latency_ms": ms(None if peer.delay is None else peer.delay // 2 + self.buffer),
+                "jitter_ms": ms(peer.jitter),
+                "received": peer.count,
+                "recovered": peer.recovered,
+                "lost": peer.lost,
+                "late": peer.late,
+                "duplicates": peer.duplicates,
+            } for peer in self.peers.values()]
+
+        return {"name": self.name, "port": self.port, "discovery": self.discovery is not None, "buffer_ms": self.buffer / 1000,
+            "sent": self.sequence, "packets": self.sent, "send_errors": self.send_errors, "peers": peers}
+
+class NetMidi(Transport):
+    """
+    Network MIDI as an ALSA sequencer client ("MIDI Pipes Network", one port).
+
+    The port is routed by midi() like any device: MIDI sent to it goes to every
+    peer, MIDI from the peers comes out of it. All peers share the one port, so
+    with the default routes nothing received from the network is sent back out.
+    """
+
+    ADDRESS_SUBSCRIBERS = 254
+    ADDRESS_UNKNOWN = 253
+    QUEUE_DIRECT = 253
+    BUFFER = 65536 # Longest MIDI message (e.g. sysex) converted in one piece, send() splits it to fit datagrams
+
+    def __init__(self, name, **options):
+        super().__init__(name, **options)
+        self.seq = None
+        try:
+            self.open_port()
+        except Exception:
+            if self.seq is not None:
+                self.seq.close()
+            self.close()
+            raise
+
+        self.buf = ctypes.create_string_buffer(self.BUFFER)
+        self.event = _SeqEvent()
+        self.callback = self.write
+
+    def open_port(self):
+        """
+        Opens the sequencer client and its port, registers it with the transport.
+        """
+        self.seq = Seq("MIDI Pipes Network")
+        lib = self.seq.lib
+        lib.snd_midi_event_decode.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_long, ctypes.POINTER(_SeqEvent)]
+        lib.snd_midi_event_decode.restype = ctypes.c_long
+        lib.snd_midi_event_encode_byte.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(_SeqEvent)]
+        lib.snd_seq_event_output_direct.argtypes = [ctypes.c_void_p, ctypes.POINTER(_SeqEvent)]
+
+        caps = Seq.CAP_READ | Seq.CAP_WRITE | Seq.CAP_SUBS_READ | Seq.CAP_SUBS_WRITE
+        self.midi_port = lib.snd_seq_create_simple_port(self.seq.handle, b"Network", caps, Seq.PORT_TYPE_APPLICATION)
+        self.encoder = ctypes.c_void_p()
+        self.decoder = ctypes.c_void_p()
+        if self.midi_port < 0 or lib.snd_midi_event_new(self.BUFFER, ctypes.byref(self.encoder)) < 0 or lib.snd_midi_event_new(self.BUFFER, ctypes.byref(self.decoder)) < 0:
+            raise OSError("Unable to create the network MIDI port")
+        lib.snd_midi_event_no_status(self.decoder, 1) # Every message complete, chunks stand alone
+
+        lib.snd_seq_nonblock(self.seq.handle, 1)
+        pfd = _PollFd()
+        lib.snd_seq_poll_descriptors(self.seq.handle, ctypes.byref(pfd), 1, select.POLLIN)
+        self.register(pfd.fd, self.read)
+
+    def read(self, fd):
+        """
+        Sends the MIDI routed to the port to the peers, batched per read (send()
+        splits it into chunks that fit a datagram).
+        """
+        lib = self.seq.lib
+        event = ctypes.POINTER(_SeqEvent)()
+        chunks = []
+
+        while lib.snd_seq_event_input(self.seq.handle, ctypes.byref(event)) >= 0:
+            count = lib.snd_midi_event_decode(self.decoder, self.buf, self.BUFFER, event)
+            if count > 0: # Not MIDI (e.g. subscription notices) otherwise
+                chunks.append(ctypes.string_at(self.buf, count))
+
+        if chunks:
+            self.send(b"".join(chunks))
+
+    def write(self, midi, peer):
+        """
+        Sends MIDI received from a peer to the port's subscribers.
+        """
+        lib = self.seq.lib
+        ev = self.event
+
+        for byte in midi:
+            if lib.snd_midi_event_encode_byte(self.encoder, byte, ctypes.byref(ev)) == 1:
+                ev.source.port = self.midi_port
+                ev.dest.client = self.ADDRESS_SUBSCRIBERS
+                ev.dest.port = self.ADDRESS_UNKNOWN
+                ev.queue = self.QUEUE_DIRECT
+                lib.snd_seq_event_output_direct(self.seq.handle, ctypes.byref(ev))
+                ctypes.memset(ctypes.byref(ev), 0, ctypes.sizeof(ev))
+
+    def stop(self):
+        super().stop()
+        self.seq.close()
+
+net = None # Running NetMidi, see net_start()
+
+def net_start():
+    """
+    Starts network MIDI with the "net_*" settings.
+
+    Returns:
+        NetMidi: The running bridge, or None if the ALSA sequencer or the UDP port is unavailable.
+    """
+    global net
+
+    if net is None:
+        try:
+            net = NetMidi(settings.get("net_name", socket.gethostname()), port=settings.get("net_port", net_port), peers=settings.get("net_peers", []),
+                buffer_ms=settings.get("net_buffer_ms", 5), discovery=settings.get("net_discovery", True))
+        except (OSError, AttributeError) as e:
+            log("Network: MIDI unavailable (" + str(e) + ")")
+            return None
+        net.start()
+        metrics.gauges.append(net_gauges)
+        log("Network: MIDI on UDP port " + str(net.port))
+
+    return net
+
+def net_gauges():
+    """
+    Per peer round trip time, jitter and loss for /metrics.
+    """
+    gauges = []
+    for peer in net.stats()["peers"]:
+        labels = {"peer": peer["name"]}
+        gauges += [("net_rtt_ms", labels, peer["rtt_ms"] or 0), ("net_jitter_ms", labels, peer["jitter_ms"]),
+            ("net_recovered", labels, peer["recovered"]), ("net_lost", labels, peer["lost"])]
+    return gauges
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_parse.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Parsing of the system tools' output for MIDI Pipes (aconnect, pactl, PulseAudio CLI)
+
+The tools run with LC_ALL=C (see shell()), the parsers are checked against
+regression snapshots of a synthetic corpus written after the formats of
+several tool versions (dev/bench/fixtures/corpus, dev/bench/check_parsers.py).
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import re
+
+# Names are quoted with single quotes but not escaped, so a name runs to the
+# last quote before the "[type=...]" attributes (names can contain quotes)
+_aconnect_client = re.compile(r"client (\d+): '(.*)'(?: \[([^\]]*)\])?\s*$")
+_aconnect_port = re.compile(r"\s+(\d+) '")
+_aconnect_to = re.compile(r"\s+Connecting To: (.*)")
+_aconnect_address = re.compile(r"(\d+):(\d+)")
+_aconnect_card = re.compile(r"(?:^|,)card=(\d+)")
+
+def aconnect_parse(output, caps, graph):
+    """
+    Adds the clients, ports and subscriptions from `aconnect -l` style output to a graph.
+
+    Args:
+        output (str): Output of `aconnect -i -l` or `aconnect -o -l`.
+        caps (int): Capability bits to record for the listed ports.
+        graph (dict): Graph as returned by Seq.graph(), updated in place.
+    """
+    client = None
+    port = None
+
+    for line in output.splitlines():
+        if line.startswith("client "):
+            match = _aconnect_client.match(line)
+            if match:
+                client = int(match.group(1))
+                port = None
+                graph["clients"][client] = match.group(2)
+                card = _aconnect_card.search(match.group(3) or "")
+                if card:
+                    graph["cards"][client] = int(card.group(1))
+            continue
+
+        if client is None:
+            continue
+
+        match = _aconnect_port.match(line)
+        if match:
+            port = (client, int(match.group(1)))
+            graph["ports"][port] = graph["ports"].get(port, 0) | caps
+            continue
+
+        match = _aconnect_to.match(line)
+        if match and port is not None:
+            for dst in _aconnect_address.findall(match.group(1)):
+                graph["edges"].add((port, (int(dst[0]), int(dst[1]))))
+
+def pactl_sections(output):
+    """
+    Splits `pactl list` output into sections in a single pass.
+
+    Returns:
+        list: (type, id, fields) tuples, e.g. ("Sink", "1", {"Name": ..., "Volume": ...}).
+            Only the top level "Key: value" fields of each section are kept.
+    """
+    sections = []
+    fields = None
+
+    for line in output.splitlines():
+        if not line:
+            continue
+
+        if line[0] != "\t":
+            head, _, index = line.partition(" #")
+            fields = {}
+            sections.append((head, index, fields))
+            continue
+
+        if fields is None or line[1:2] in ("\t", " "):
+            continue
+
+        key, sep, value = line[1:].partition(": ")
+        if sep:
+            fields[key] = value
+        elif key.endswith(":"):
+            fields[key[:-1]] = ""
+
+    return sections
+
+def pactl_volume(value):
+    """
+    Returns the first channel volume (percent) from a pactl "Volume:" field.
+    """
+    match = re.search(r'(\d+)%', value)
+    if match:
+        return int(match.group(1))
+    else:
+        return 0
+
+def module_args(argument):
+    """
+    Parses a module argument string (e.g. 'source=2 sink=0 latency_msec=20') into a dict.
+
+    Values can be double or single quoted, e.g. sink_properties='device.description="My Sink"'.
+    """
+    args = {}
+    for key, double, single, value in re.findall(r'([\w.-]+)=(?:"([^"]*)"|\'([^\']*)\'|(\S*))', argument):
+        args[key] = double or single or value
+    return args
+
+def pulse_cli_volume(output, device):
+    """
+    Returns a device's volume (percent) from PulseAudio CLI `list-sinks` / `list-sources`
+    output, by index or name (None if not listed).
+    """
+    for block in re.split(r'\n(?=\s+\*? ?index: )', output):
+        match = re.search(r'index: (\d+)', block)
+        if match and match.group(1) == str(device) or re.search(r'\tname: <' + re.escape(str(device)) + '>', block):
+            match = re.search(r'\tvolume: (.*)', block)
+            if match:
+                return pactl_volume(match.group(1))
+
+    return None
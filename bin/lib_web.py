@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+lib_web.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Web interface request handling for MIDI Pipes
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from collections import deque
+
+try:
+    import brotli # Optional, gzip only without it
+except ImportError:
+    brotli = None
+
+from lib import *
+from lib_midi import *
+import lib_midi
+import lib_net
+from lib_audio import *
+from lib_devices import devices
+from lib_display import bye, refresher
+
+jobs = Jobs()
+
+def state_deltas(last, current):
+    """
+    Returns the (event, data) changes between two {"midi": [...], "audio": {...}} states.
+    """
+    deltas = []
+
+    added = [name for name in current["midi"] if name not in last["midi"]]
+    removed = [name for name in last["midi"] if name not in current["midi"]]
+    if added or removed:
+        deltas.append(("midi", {"added": added, "removed": removed}))
+
+    last_devices = {(device["type"], device["id"]): device for device in last["audio"]["detail"]}
+    devices = {(device["type"], device["id"]): device for device in current["audio"]["detail"]}
+
+    audio = {
+        "added": [device for key, device in devices.items() if key not in last_devices],
+        "removed": [{"type": key[0], "id": key[1]} for key in last_devices if key not in devices],
+    }
+    if last["audio"]["output"] != current["audio"]["output"]:
+        audio["output"] = current["audio"]["output"]
+    if audio["added"] or audio["removed"] or "output" in audio:
+        deltas.append(("audio", audio))
+
+    for key, device in devices.items():
+        if key in last_devices and last_devices[key]["vol"] != device["vol"]:
+            deltas.append(("volume", {"type": device["type"], "id": device["id"], "vol": device["vol"]}))
+
+    return deltas
+
+class Push:
+    """
+    Server-sent events: pushes state deltas to connected clients (/events).
+
+    State invalidations are coalesced into one refresh (only while clients are
+    connected), the changes found are sent as "midi", "audio" and "volume" events.
+    """
+
+    def __init__(self, keep = 100, keepalive = 15):
+        self.keepalive = keepalive
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=keep)
+        self.next_id = 1
+        self.clients = 0
+        self.last = None
+        self.coalescer = Coalescer(self.refresh, 0.2, 1.0)
+        state.listeners.append(self.changed)
+
+    def changed(self, keys):
+        if self.clients:
+            self.coalescer.poke()
+
+    def current(self):
+        return {"midi": state.get("midi"), "audio": state.get("audio").as_dict()}
+
+    def refresh(self, count):
+        with self.cond:
+            self.advance(self.current())
+
+    def advance(self, current):
+        """
+        Publishes the changes since the last state seen and makes `current` the
+        base of the next deltas (call with self.cond held).
+        """
+        if self.last is not None:
+            for event, data in state_deltas(self.last, current):
+                self.publish(event, data)
+        self.last = current
+
+    def publish(self, event, data):
+        with self.cond:
+            self.events.append((self.next_id, event, json.dumps(data)))
+            self.next_id += 1
+            self.cond.notify_all()
+
+    def stream(self, wfile):
+        """
+        Writes the full state, then events as they happen, until the client goes away.
+        """
+        with self.cond:
+            # The client starts from the current state: deltas from here on are computed
+            # against it (the base is stale after a quiet period without clients), clients
+            # already connected get the changes up to it first
+            self.clients += 1
+            current = self.current()
+            self.advance(current)
+            last_id = self.next_id - 1
+
+        try:
+            wfile.write(("retry: 3000\nevent: state\ndata: " + json.dumps(current) + "\n\n").encode('utf-8'))
+            wfile.flush()
+
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.next_id - 1 > last_id, self.keepalive)
+                    pending = [event for event in self.events if event[0] > last_id]
+                    behind = len(pending) and pending[0][0] > last_id + 1
+
+                if behind: # Missed events (client too slow), send everything again
+                    last_id = pending[-1][0]
+                    pending = [(last_id, "state", json.dumps(self.current()))]
+
+                if not pending:
+                    wfile.write(b": keepalive\n\n")
+
+                for id, event, data in pending:
+                    wfile.write(("id: " + str(id) + "\nevent: " + event + "\ndata: " + data + "\n\n").encode('utf-8'))
+                    last_id = id
+
+                wfile.flush()
+        except OSError:
+            pass # Client went away
+        finally:
+            with self.cond:
+                self.clients -= 1
+
+push = Push()
+
+def watch():
+    """
+    Invalidates the cached state on hotplug and PulseAudio events.
+    """
+    try:
+        pulse().subscribe(lambda event, facility, index: state.invalidate("audio"))
+        hotplug_watch(lambda source, count: state.invalidate("midi", "audio"))
+    except OSError as e:
+        log("Web: hotplug watch unavailable (" + str(e) + "), state refreshes every " + str(state.ttl) + "s")
+
+def shutdown(reboot = False):
+    bye()
+    if reboot:
+        subprocess.run(["/usr/bin/sudo", "/usr/sbin/halt", "--reboot", "-f"])
+    else:
+        subprocess.run(["/usr/bin/sudo", "/usr/sbin/halt", "-p", "-f"])
+
+class Asset:
+    """
+    Static file served from memory: read and compressed once, with an ETag per
+    encoding so repeat visits get a 304 instead of the file.
+
+    Args:
+        path (str): File to serve.
+        type (str): Content type.
+        cache (str): Cache-Control header ("no-cache" revalidates every time).
+    """
+
+    def __init__(self, path, type, cache = "no-cache"):
+        with open(path, "rb") as file:
+            body = file.read()
+
+        self.type = type
+        self.cache = cache
+        tag = hashlib.sha1(body).hexdigest()[:16]
+        self.variants = {"identity": body}
+        if type.startswith("text/"): # Images are compressed already
+            self.variants["gzip"] = gzip.compress(body, 9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(body)
+        self.etags = {encoding: '"' + tag + ("" if encoding == "identity" else "-" + encoding) + '"' for encoding in self.variants}
+
+    def encoding(self, accept):
+        """
+        Returns the smallest variant the client accepts (Accept-Encoding header).
+        """
+        accepted = set()
+        for item in accept.split(","):
+            name, _, params = item.strip().partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip().lower())
+
+        return min((encoding for encoding in self.variants if encoding in accepted or encoding == "identity" or "*" in accepted), key=lambda encoding: len(self.variants[encoding]))
+
+    def matches(self, none_match):
+        """
+        Returns True if an If-None-Match header names any variant (the client's copy is current).
+        """
+        tags = {tag.strip().replace("W/", "", 1) for tag in none_match.split(",")}
+        return "*" in tags or not tags.isdisjoint(self.etags.values())
+
+_assets = None
+
+def assets():
+    """
+    Returns the static assets by path, loaded once.
+    """
+    global _assets
+
+    if _assets is None:
+        cur_dir = os.path.dirname(os.path.abspath(__file__))
+        _assets = {
+            "/": Asset(cur_dir + "/../lib/web.html", "text/html; charset=utf-8"),
+            "/img-logo": Asset(cur_dir + "/../lib/logo-web.png", "image/png", "public, max-age=86400"),
+        }
+
+    return _assets
+
+routes_web = ('/midi-update', '/midi-view', '/midi-routes', '/midi-processor', '/midi-net', '/devices', '/audio-update', '/audio-vol', '/audio-vols', '/audio-out',
+    '/display', '/shutdown', '/restart', '/events', '/cache', '/metrics', '/profile', '/job', '/logs', '/logs-stream', '/config', '/img-logo')
+routes_streaming = ('/events', '/logs-stream') # Open as long as the client stays, not timed
+
+class SimpleWebServer(BaseHTTPRequestHandler):
+    def send_json(self, data, status = 200):
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+
+        self.wfile.write(json.dumps(data, indent=4).encode('utf-8'))
+
+    def query_int(self, query, name, default, low = None, high = None):
+        """
+        Returns an integer query parameter (default if absent) clamped to low / high,
+        or None after replying 400 if it is not an integer.
+        """
+        if name not in query:
+            return default
+        if not re.fullmatch(r"-?\d{1,9}", query[name][0]):
+            self.send_json({"error": "'" + name + "' must be an integer"}, 400)
+            return None
+        value = int(query[name][0])
+        value = value if low is None else max(low, value)
+        return value if high is None else min(high, value)
+
+    def send_asset(self, asset):
+        encoding = asset.encoding(self.headers.get('Accept-Encoding', ''))
+        modified = not asset.matches(self.headers.get('If-None-Match', ''))
+
+        self.send_response(200 if modified else 304)
+        self.send_header('ETag', asset.etags[encoding])
+        self.send_header('Cache-Control', asset.cache)
+        self.send_header('Vary', 'Accept-Encoding')
+        if modified:
+            self.send_header('Content-type', asset.type)
+            self.send_header('Content-Length', str(len(asset.variants[encoding])))
+            if encoding != "identity":
+                self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+
+        if modified:
+            self.wfile.write(asset.variants[encoding])
+
+    def send_job(self, name, func, *args):
+        """
+        Queues a slow action and responds with its job id (poll /job?id=N).
+        """
+        id = jobs.submit(name, func, *args)
+        self.send_json(jobs.get(id))
+
+    def do_GET(self):
+
+        uriPath = urlparse(self.path).path
+        uriQuery = parse_qs(urlparse(self.path).query)
+
+        if uriPath in routes_streaming:
+            metrics.count("http_streams", path=uriPath)
+            self.route(uriPath, uriQuery)
+            return
+
+        # Unknown paths serve the page, time them together
+        with metrics.timer("http", path=uriPath if uriPath in routes_web else "/"):
+            self.route(uriPath, uriQuery)
+
+    def route(self, uriPath, uriQuery):
+
+        if uriPath == '/midi-update':
+            self.send_job("midi", midi, seq_resident()) # The process's client (the daemon's), a new one would announce itself as a hotplug event
+
+        elif uriPath == '/midi-view':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+
+            self.wfile.write(json.dumps(state.get("midi")).encode('utf-8'))
+
+        elif uriPath == '/midi-routes':
+            # View the routing matrix, or replace the rules with /midi-routes?rules=[...] (JSON)
+            if 'rules' in uriQuery:
+                try:
+                    routes_set(json.loads(uriQuery['rules'][0]))
+                except ValueError as e:
+                    self.send_response(400)
+                    self.send_header('Content-type', 'application/json')
+                    self.end_headers()
+                    self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
+                    return
+                if processor_wanted():
+                    processor_start()
+                jobs.submit("midi", midi, seq_resident())
+
+            self.send_json(midi_routes())
+
+        elif uriPath == '/midi-processor':
+            running = lib_midi.processor # Set once started, not at import
+            self.send_json(running.stats() if running is not None else {"running": False})
+
+        elif uriPath == '/midi-net':
+            running = lib_net.net
+            self.send_json(running.stats() if running is not None else {"running": False})
+
+        elif uriPath == '/devices':
+            self.send_json(devices.list())
+
+        elif uriPath == '/audio-update':
+            self.send_job("audio", audio)
+
+        elif uriPath == '/audio-vol':
+            vol = -1
+            dev = None
+            typ = None
+
+            if uriQuery:
+                if 'vol' in uriQuery:
+                    if not re.fullmatch(r"\d{1,3}", uriQuery['vol'][0]) or int(uriQuery['vol'][0]) > 100:
+                        self.send_json({"error": "Volume must be 0-100"}, 400)
+                        return
+                    vol = int(uriQuery['vol'][0])
+                if 'dev' in uriQuery:
+                    dev = str(uriQuery['dev'][0])
+                if 'typ' in uriQuery:
+                    typ = str(uriQuery['typ'][0])
+
+            try:
+                vol = audio_volume(vol, dev, typ)
+            except ValueError as e:
+                self.send_json({"error": str(e)}, 400)
+                return
+
+            self.send_json(vol)
+
+        elif uriPath == '/audio-vols':
+            # Batch of volume changes, e.g. /audio-vols?sink:1=50&source:3=20
+            changes = []
+            for key, values in uriQuery.items():
+                typ, _, dev = key.partition(":")
+                if not audio_device_valid(typ, dev):
+                    self.send_json({"error": "Unknown device " + key + ", use sink:<index> or source:<index>"}, 400)
+                    return
+                if not re.fullmatch(r"\d{1,3}", values[-1]) or int(values[-1]) > 100:
+                    self.send_json({"error": "Volume for " + key + " must be 0-100"}, 400)
+                    return
+                changes.append((typ, dev, int(values[-1])))
+
+            for typ, dev, vol in changes:
+                mixer().set(typ, dev, vol)
+            queued = len(changes)
+
+            stats = mixer().stats()
+            stats["queued"] = queued
+            self.send_json(stats)
+
+        elif uriPath == '/audio-out':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+
+            current = state.get("audio")
+
+            if uriQuery:
+                if 'out' in uriQuery:
+                    out = str(uriQuery['out'][0])
+                    for device in current.detail:
+                        if device.type == "sink" and device.name == out:
+                            settings["sink_preference"] = device.name
+                            settings_set(settings)
+                            state.invalidate("audio")
+                            current = state.get("audio")
+                            jobs.submit("audio", audio)
+                            break
+
+            self.wfile.write(json.dumps(current.as_dict(), indent=4).encode('utf-8'))
+
+        elif uriPath == '/display':
+            refresher().request(force=True)
+            self.send_json(refresher().stats())
+
+        elif uriPath == '/shutdown':
+            self.send_job("shutdown", shutdown)
+
+        elif uriPath == '/restart':
+            self.send_job("restart", shutdown, True)
+
+        elif uriPath == '/events':
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            push.stream(self.wfile)
+
+        elif uriPath == '/cache':
+            self.send_json(state.stats())
+
+        elif uriPath == '/metrics':
+            if uriQuery.get('format', [''])[0] == 'json':
+                self.send_json(metrics.snapshot())
+            else:
+                self.send_response(200)
+                self.send_header('Content-type', 'text/plain; version=0.0.4')
+                self.end_headers()
+                self.wfile.write(metrics.prometheus().encode('utf-8'))
+
+        elif uriPath == '/profile':
+            # Sampling profiler toggle: /profile?action=start, then /profile?action=stop returns the collapsed stacks
+            action = uriQuery.get('action', [''])[0]
+            if action == 'start':
+                profiler.start()
+            if action == 'stop':
+                self.send_response(200)
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(profiler.stop().encode('utf-8'))
+            else:
+                self.send_json({"running": profiler.running(), "file": file_profile})
+
+        elif uriPath == '/job':
+            id = self.query_int(uriQuery, 'id', None)
+            if id is None:
+                if 'id' not in uriQuery:
+                    self.send_json({"error": "'id' is required"}, 400)
+                return
+            job = jobs.get(id)
+            if job is None:
+                self.send_json({"error": "Unknown job " + str(id)}, 404)
+                return
+            self.send_json(job)
+
+        elif uriPath == '/logs':
+            # Recent log entries from memory: /logs?tail=N (text, or ?format=json)
+            tail = self.query_int(uriQuery, 'tail', 200, 0)
+            if tail is None:
+                return
+            entries = logger.tail(tail)
+
+            if uriQuery.get('format', [''])[0] == 'json':
+                self.send_json(entries)
+            else:
+                self.send_response(200)
+                self.send_header('Content-type', 'text/plain')
+                self.end_headers()
+                self.wfile.write("".join(entry["time"] + "\t" + entry["msg"] + "\n" for entry in entries).encode('utf-8'))
+
+        elif uriPath == '/logs-stream':
+            # Server-sent events: the last ?tail=N entries, then new ones as they are logged
+            tail = self.query_int(uriQuery, 'tail', 20, 0)
+            if tail is None:
+                return
+
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            try:
+                entries = logger.tail(tail)
+                last_id = entries[-1]["id"] if entries else logger.next_id - 1
+                while True:
+                    for entry in entries:
+                        self.wfile.write(("id: " + str(entry["id"]) + "\nevent: log\ndata: " + json.dumps(entry) + "\n\n").encode('utf-8'))
+                        last_id = entry["id"]
+                    if not entries:
+                        self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    entries = logger.follow(last_id)
+            except OSError:
+                pass # Client went away
+        
+        elif uriPath == '/config':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+
+            self.wfile.write(json.dumps(state.get("audio").as_dict(), indent=4).encode('utf-8'))
+        
+        elif uriPath == '/img-logo':
+            self.send_asset(assets()['/img-logo'])
+
+        else:
+            self.send_asset(assets()['/'])
+
+def serve(port = 80, watching = True):
+    """
+    Runs the web interface (forever).
+
+    Args:
+        port (int): TCP port.
+        watching (bool): Watch hotplug / PulseAudio events to invalidate the
+            cached state (False when the caller already does, e.g. the daemon).
+    """
+    if watching:
+        threading.Thread(target=watch, daemon=True).start()
+
+    assets() # Load (and compress) the page and logo before the first visit
+
+    server_address = ('', port)
+    httpd = ThreadingHTTPServer(server_address, SimpleWebServer)
+    httpd.daemon_threads = True
+    httpd.serve_forever()
@@ -19,6 +19,6 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 For more details, see the LICENSE file.
 """
 
-from lib import *
+from lib_midi import *
 
 midi()
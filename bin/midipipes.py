@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+midipipes.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+MIDI Pipes daemon, one resident process for MIDI routing, audio routing,
+display updates and the web interface, driven by hotplug and PulseAudio events
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+from lib_midi import *
+from lib_audio import *
+from lib_display import refresher
+from lib_net import net_start
+import lib_web
+
+bus = Bus()
+seq = seq_resident() # Shared with the state loaders (device list, routes)
+
+def reconcile_midi(count):
+    started = time.monotonic()
+    midi(seq)
+    log("Daemon: MIDI reconciled (" + str(count) + " event(s) absorbed) in " + str(round((time.monotonic() - started) * 1000, 1)) + "ms")
+
+def reconcile_audio(count):
+    started = time.monotonic()
+    audio()
+    log("Daemon: audio reconciled (" + str(count) + " event(s) absorbed) in " + str(round((time.monotonic() - started) * 1000, 1)) + "ms")
+
+midi_pass = Coalescer(reconcile_midi, 0.5, 3.0)
+audio_pass = Coalescer(reconcile_audio, 1.0, 5.0)
+
+def on_hotplug(source, count):
+    state.invalidate("midi", "audio")
+    bus.publish("hotplug", {"source": source, "count": count})
+
+def on_pulse(event, facility, index):
+    state.invalidate("audio")
+    bus.publish("pulse", {"event": event, "facility": facility, "index": index})
+
+# Reconcilers
+bus.subscribe("hotplug", lambda data: midi_pass.poke(data["count"]))
+bus.subscribe("hotplug", lambda data: audio_pass.poke(data["count"]))
+bus.subscribe("pulse", lambda data: audio_pass.poke() if data["event"] in ("new", "remove") and data["facility"] in ("sink", "source") else None)
+bus.subscribe("state", lambda keys: refresher().request()) # Batched, fast / full colour refreshes (see Refresher)
+bus.subscribe("tick", lambda data: refresher().request()) # e.g. IP address changes
+
+# Event sources
+state.listeners.append(lambda keys: bus.publish("state", keys))
+pulse().subscribe(on_pulse)
+supervise("hotplug", hotplug_watch, on_hotplug)
+supervise("web", lib_web.serve, 80, False)
+
+if processor_wanted():
+    processor_start()
+
+if settings.get("net", False):
+    net_start() # Its sequencer client shows up as a hotplug event and gets routed
+
+log("Daemon: started")
+midi_pass.poke()
+audio_pass.poke()
+refresher().request()
+
+while True:
+    time.sleep(300)
+    bus.publish("tick")
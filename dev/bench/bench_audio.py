@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_audio.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Benchmarks the audio state snapshot against the previous line-by-line parser
+using generated `pactl list` fixtures (dev/bench/fixtures/pactl-list-*.txt)
+
+The previous parser spawned one `sudo pactl get-*-volume` per device, those
+spawns are simulated with /bin/true (use --no-spawn to time parsing only).
+
+Usage: python3 dev/bench/bench_audio.py [--no-spawn] [fixture ...]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import glob
+import os
+import re
+import subprocess
+import sys
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+from cli import flag, parse
+from lib_audio import audio_snapshot_parse
+
+sink_preference = "alsa_output.platform-bcm2835_audio.analog-stereo"
+
+def legacy_parse(output, spawn):
+    """
+    The previous audio_devices() parser, volumes fetched with one process each.
+    """
+    data = {"source": {}, "sink": {}, "output": "", "pipe": [], "detail": []}
+    spawns = 0
+
+    patterns = {
+        "module": re.compile(r'Module #(\d+)'),
+        "source": re.compile(r'Source #(\d+)'),
+        "sink": re.compile(r'Sink #(\d+)'),
+        "argument": re.compile(r'Argument: source=(\d+) sink=(\d+)'),
+        "name": re.compile(r'Name: (.+)'),
+        "name_has_input": re.compile(r'Name: alsa_input\.usb-(.+)'),
+        "desc": re.compile(r'Description: (.+)'),
+    }
+
+    def clear_values():
+        return {"type": "", "id": "", "name": "", "name_has_input": "", "desc": "", "pipe_source": "", "pipe_sink": ""}
+
+    def volume():
+        if spawn:
+            subprocess.run(["/bin/true"])
+        return 0
+
+    values = clear_values()
+
+    for line in output.split('\n'):
+        matches = {}
+
+        for ptn in patterns:
+            matches[ptn] = patterns[ptn].search(line)
+
+        if matches["module"]:
+            values = clear_values()
+            values["type"] = "pipe"
+            values["id"] = matches["module"].group(1)
+
+        if matches["source"]:
+            values = clear_values()
+            values["type"] = "source"
+            values["id"] = matches["source"].group(1)
+
+        if matches["sink"]:
+            values = clear_values()
+            values["type"] = "sink"
+            values["id"] = matches["sink"].group(1)
+
+        if matches["argument"]:
+            values["pipe_source"] = matches["argument"].group(1)
+            values["pipe_sink"] = matches["argument"].group(2)
+
+        if matches["name"]:
+            values["name"] = matches["name"].group(1)
+
+        if matches["name_has_input"]:
+            values["name_has_input"] = matches["name_has_input"].group(1)
+
+        if matches["desc"]:
+            values["desc"] = matches["desc"].group(1)
+
+        if len(values["pipe_source"]) and len(values["pipe_sink"]):
+            data["pipe"].append({"source": values["pipe_source"], "sink": values["pipe_sink"]})
+            values = clear_values()
+            continue
+
+        if len(values["name"]) and len(values["desc"]):
+            if values["type"] == "sink" and values["name"] == sink_preference:
+                data["output"] = values["id"]
+
+            if (values["type"] == "source" and len(values["name_has_input"])) or values["type"] == "sink":
+                spawns += 1
+                data["detail"].append({"type": values["type"], "id": values["id"], "name": values["name"], "desc": values["desc"], "vol": volume()})
+                data[values["type"]][values["id"]] = values["name"]
+
+            values = clear_values()
+            continue
+
+    return data, spawns
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+def main():
+    fixtures = parse(__doc__, flags=("--no-spawn",), positional=None)
+    spawn = not flag("--no-spawn")
+    fixtures = fixtures or sorted(glob.glob(cur_dir + "/fixtures/pactl-list-*.txt"))
+
+    print("fixture".ljust(24) + "devices".rjust(8) + "legacy ms".rjust(12) + "spawns".rjust(8) + "snapshot ms".rjust(13) + "speedup".rjust(9))
+
+    for fixture in fixtures:
+        with open(fixture, "r") as file:
+            output = file.read()
+
+        legacy_time, (legacy, spawns) = timed(lambda: legacy_parse(output, spawn), 3)
+        snapshot_time, snapshot = timed(lambda: audio_snapshot_parse(output, sink_preference), 20)
+
+        # Both parsers must agree on what they found (volumes aside)
+        assert [(d["type"], d["id"], d["name"]) for d in legacy["detail"]] == [(d.type, d.id, d.name) for d in snapshot.detail]
+        assert legacy["pipe"] == [{"source": pipe["source"], "sink": pipe["sink"]} for pipe in snapshot.pipe] and legacy["output"] == snapshot.output
+
+        print(os.path.basename(fixture).ljust(24)
+            + str(len(snapshot.detail)).rjust(8)
+            + ("%.2f" % (legacy_time * 1000)).rjust(12)
+            + str(1 + spawns).rjust(8)
+            + ("%.2f" % (snapshot_time * 1000)).rjust(13)
+            + ("%.0fx" % (legacy_time / snapshot_time)).rjust(9))
+
+main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_control.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Hermetic benchmark of the control plane hot paths (no MIDI / audio hardware)
+
+Runs the lib functions against the stand-in executables in dev/bench/standins
+(aconnect, pactl, sudo, see lib.tool()) serving the fixtures for 1, 8 and 32
+devices (dev/bench/make_fixtures.py). MIDI goes through the aconnect fallback
+and audio through pactl (no ALSA sequencer or PulseAudio CLI socket).
+
+For each function: best time over the rounds, subprocesses spawned per call
+and peak Python memory allocated during the call. --delay S makes every tool
+call sleep S seconds first, to simulate a slow device (e.g. 0.02).
+
+Usage: python3 dev/bench/bench_control.py [--rounds N] [--delay S] [count ...]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+os.environ["MIDIPIPES_TOOLS"] = cur_dir + "/standins"
+os.environ["MIDIPIPES_STATE"] = "/tmp/midi-bench-aconnect.txt"
+
+import lib
+import lib_midi
+import lib_audio
+from cli import arg, parse
+
+spawns = 0
+popen_init = subprocess.Popen.__init__
+
+def counting_init(self, *args, **kwargs):
+    global spawns
+    spawns += 1
+    popen_init(self, *args, **kwargs)
+
+def measure(func, rounds):
+    """
+    Returns (best seconds, spawns per call, peak KB allocated) of func() over rounds.
+    """
+    global spawns
+
+    best = None
+    peak = 0
+    spawned = 0
+    for _ in range(rounds):
+        spawns = 0
+        tracemalloc.start()
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        spawned = spawns
+        best = elapsed if best is None or elapsed < best else best
+
+    return best, spawned, peak / 1024
+
+def display_func():
+    """
+    Returns a function rendering the display to a PNG, or None without the display libraries.
+    """
+    try:
+        import lib_display
+    except ImportError:
+        return None
+
+    lib_display.file_last = "/tmp/midi-bench-last.txt"
+    lib_display._backend = lib_display.PngBackend("/tmp/midi-bench-control.png")
+
+    return lambda: lib_display.display(lib_midi.midi_devices(), lib_audio.audio_snapshot(), force=True)
+
+def main():
+    counts = parse(__doc__, ("--rounds", "--delay"), positional=None, kind=int) or [1, 8, 32]
+    rounds = arg("--rounds", 3)
+    if arg("--delay", 0.0):
+        os.environ["MIDIPIPES_DELAY"] = str(arg("--delay", 0.0))
+
+    # Keep the bench away from the real runtime files, no sequencer or PulseAudio socket
+    lib.file_log = "/tmp/midi-bench-log.txt"
+    lib.file_lock = "/tmp/midi-bench-lock.txt"
+    lib.file_settings = "/tmp/midi-bench-settings.json"
+    lib.file_settings_persistent = None
+    lib_audio.file_pulse_cli = "/tmp/midi-bench-no-pulse.sock"
+    lib_midi.seq_open = lambda name="MIDI Pipes": None
+    subprocess.Popen.__init__ = counting_init
+
+    def midi_first():
+        if os.path.exists(os.environ["MIDIPIPES_STATE"]):
+            os.unlink(os.environ["MIDIPIPES_STATE"])
+        lib_midi.midi()
+
+    funcs = [
+        ("midi_devices()", lib_midi.midi_devices),
+        ("midi() first pass", midi_first),
+        ("midi() steady", lib_midi.midi),
+        ("audio_snapshot()", lib_audio.audio_snapshot),
+        ("audio_devices()", lib_audio.audio_devices),
+        ("audio_volume() get", lambda: lib_audio.audio_volume(-1, "1", "sink")),
+        ("audio_volume() set", lambda: lib_audio.audio_volume(50, "1", "sink")),
+        ("audio() steady", lib_audio.audio),
+    ]
+    display = display_func()
+    if display is not None:
+        funcs.append(("display() (PNG)", display))
+
+    print("function".ljust(22) + "devices".rjust(8) + "best ms".rjust(10) + "spawns".rjust(8) + "peak KB".rjust(10))
+
+    for count in counts:
+        os.environ["MIDIPIPES_DEVICES"] = str(count)
+        for name, func in funcs:
+            best, spawned, peak = measure(func, rounds)
+            print(name.ljust(22) + str(count).rjust(8) + ("%.2f" % (best * 1000)).rjust(10) + str(spawned).rjust(8) + ("%.0f" % peak).rjust(10))
+
+    print("max RSS:   %d KB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    subprocess.Popen.__init__ = popen_init
+    for path in (os.environ["MIDIPIPES_STATE"], "/tmp/midi-bench-lock.txt"):
+        if os.path.exists(path):
+            os.unlink(path)
+
+main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_display.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Benchmarks the display render pipeline headless (PNG backend, no Inky needed)
+
+Times a cold render (fonts, background and QR code loaded), a warm render
+(everything cached) and an unchanged update (fingerprint match, no render).
+
+Usage: python3 dev/bench/bench_display.py [fixture] [output.png]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import os
+import sys
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+import lib_display
+from cli import parse
+from lib_audio import audio_snapshot_parse
+
+def main():
+    args = parse(__doc__, positional=2)
+    fixture = args[0] if len(args) > 0 else cur_dir + "/fixtures/pactl-list-8.txt"
+    path = args[1] if len(args) > 1 else "/tmp/midi-bench-display.png"
+
+    with open(fixture, "r") as file:
+        names_aud = audio_snapshot_parse(file.read(), "alsa_output.platform-bcm2835_audio.analog-stereo")
+    names_mid = ["Arturia KeyStep Pro", "Korg minilogue xd", "MIDI Pipes Bluetooth"]
+
+    lib_display.file_last = "/tmp/midi-bench-last.txt"
+    lib_display._backend = lib_display.PngBackend(path)
+    if os.path.exists(lib_display.file_last):
+        os.unlink(lib_display.file_last)
+
+    started = time.perf_counter()
+    assert lib_display.display(names_mid, names_aud)
+    cold = time.perf_counter() - started
+
+    rounds = 20
+    started = time.perf_counter()
+    for _ in range(rounds):
+        lib_display.display(names_mid, names_aud, force=True)
+    warm = (time.perf_counter() - started) / rounds
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        assert not lib_display.display(names_mid, names_aud)
+    unchanged = (time.perf_counter() - started) / rounds
+
+    print("cold render:       %8.2f ms" % (cold * 1000))
+    print("warm render:       %8.2f ms (fonts, background, QR cached)" % (warm * 1000))
+    print("unchanged update:  %8.2f ms (fingerprint match, nothing rendered)" % (unchanged * 1000))
+    print("image:             " + path)
+
+    os.unlink(lib_display.file_last)
+
+main()
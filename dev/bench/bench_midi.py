@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_midi.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+MIDI latency and throughput benchmark on virtual ALSA sequencer clients
+
+Creates a "Bench Source" and a "Bench Sink" client, connects them with the
+same routing code as midi() (lib_midi routing rules, optionally through the
+processor) and sends timestamped controller events from one to the other:
+
+* bursts: events sent in bursts, reports p50 / p99 / max latency and jitter
+* rates: paced sending at increasing rates, reports the highest rate sustained
+  (every event delivered, p99 latency under --max-p99 ms)
+
+Needs the ALSA sequencer (snd-seq kernel module, /dev/snd/seq) but no MIDI
+hardware, e.g. `sudo modprobe snd-seq` on a plain Linux box.
+
+Usage: python3 dev/bench/bench_midi.py [--processed] [--bursts N] [--burst-size N] [--max-p99 MS]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import ctypes
+import os
+import select
+import sys
+import threading
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+import lib_midi
+from cli import arg, flag, parse
+from lib_midi import Seq, _SeqEvent, _PollFd
+
+EVENT_CONTROLLER = 10
+ADDRESS_SUBSCRIBERS = 254
+ADDRESS_UNKNOWN = 253
+QUEUE_DIRECT = 253
+
+rates = [1000, 2000, 5000, 10000, 20000, 50000] # Events per second
+
+class Endpoint:
+    """
+    Virtual device: a sequencer client with one port (readable source or writable sink).
+    """
+
+    def __init__(self, name, caps):
+        self.seq = Seq(name)
+        self.lib = self.seq.lib
+        self.lib.snd_seq_event_output_direct.argtypes = [ctypes.c_void_p, ctypes.POINTER(_SeqEvent)]
+        self.port = self.lib.snd_seq_create_simple_port(self.seq.handle, name.encode(), caps, Seq.PORT_TYPE_APPLICATION)
+        if self.port < 0:
+            raise OSError("Unable to create port for " + name)
+
+class Source(Endpoint):
+
+    def __init__(self):
+        super().__init__("Bench Source", Seq.CAP_READ | Seq.CAP_SUBS_READ)
+        self.event = _SeqEvent()
+        self.event.type = EVENT_CONTROLLER
+        self.event.queue = QUEUE_DIRECT
+        self.event.source.port = self.port
+        self.event.dest.client = ADDRESS_SUBSCRIBERS
+        self.event.dest.port = ADDRESS_UNKNOWN
+        self.pointer = ctypes.pointer(self.event)
+
+    def send(self, index):
+        """
+        Sends a controller event carrying its index (in the value field) to the subscribers.
+        """
+        self.event.data[8:12] = list(index.to_bytes(4, "little"))
+        return self.lib.snd_seq_event_output_direct(self.seq.handle, self.pointer) >= 0
+
+class Sink(Endpoint):
+
+    def __init__(self):
+        super().__init__("Bench Sink", Seq.CAP_WRITE | Seq.CAP_SUBS_WRITE)
+        self.lib.snd_seq_nonblock(self.seq.handle, 1)
+        pfd = _PollFd()
+        self.lib.snd_seq_poll_descriptors(self.seq.handle, ctypes.byref(pfd), 1, select.POLLIN)
+        self.fd = pfd.fd
+        self.received = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        event = ctypes.POINTER(_SeqEvent)()
+        event_ref = ctypes.byref(event)
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        clock = time.perf_counter
+
+        while self.running:
+            if self.lib.snd_seq_event_input_pending(self.seq.handle, 0) == 0:
+                poller.poll(100)
+            while self.lib.snd_seq_event_input(self.seq.handle, event_ref) >= 0:
+                ev = event.contents
+                if ev.type == EVENT_CONTROLLER:
+                    self.received.append((int.from_bytes(bytes(ev.data[8:12]), "little"), clock()))
+
+    def reset(self):
+        self.received = []
+
+    def wait(self, count, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while len(self.received) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+def latencies(sent, received):
+    """
+    Returns the latency (seconds) of every event received, in sending order.
+    """
+    return [at - sent[index] for index, at in sorted(received) if index < len(sent)]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def jitter(values):
+    """
+    Mean absolute difference between the latencies of consecutive events.
+    """
+    if len(values) < 2:
+        return 0
+    return sum(abs(values[i] - values[i - 1]) for i in range(1, len(values))) / (len(values) - 1)
+
+def bursts(source, sink, count, size):
+    sink.reset()
+    sent = []
+    clock = time.perf_counter
+
+    for _ in range(count):
+        for _ in range(size):
+            sent.append(clock())
+            source.send(len(sent) - 1)
+        time.sleep(0.01)
+
+    sink.wait(len(sent))
+    values = latencies(sent, sink.received)
+
+    return {
+        "sent": len(sent),
+        "received": len(values),
+        "p50": percentile(values, 0.5),
+        "p99": percentile(values, 0.99),
+        "max": max(values, default=0),
+        "jitter": jitter(values),
+    }
+
+def paced(source, sink, rate, seconds=1.0):
+    sink.reset()
+    count = int(rate * seconds)
+    sent = [0.0] * count
+    clock = time.perf_counter
+    started = clock()
+
+    for index in range(count):
+        due = started + index / rate
+        while clock() < due:
+            pass
+        sent[index] = clock()
+        source.send(index)
+
+    sink.wait(count)
+    values = latencies(sent, sink.received)
+
+    return {"rate": rate, "sent": count, "received": len(values), "p99": percentile(values, 0.99)}
+
+def main():
+    parse(__doc__, ("--bursts", "--burst-size", "--max-p99"), ("--processed",))
+    processed = flag("--processed")
+    max_p99 = arg("--max-p99", 5.0) / 1000
+
+    try:
+        source = Source()
+        sink = Sink()
+        router = Seq("MIDI Pipes")
+    except OSError as e:
+        print("ALSA sequencer unavailable (" + str(e) + "), try: sudo modprobe snd-seq")
+        sys.exit(2)
+
+    # Route only the bench clients, with the routing code midi() uses (the
+    # configured routes are put back afterwards)
+    configured = lib_midi.settings.get("routes")
+    rule = {"from": "Bench Source", "to": "Bench Sink"}
+    if processed:
+        rule["process"] = {"drop": ["sensing"]}
+        lib_midi.processor_start()
+    lib_midi.settings["routes"] = [rule]
+    lib_midi.midi(router)
+
+    print("route:            " + ("processed" if processed else "direct subscription"))
+
+    result = bursts(source, sink, arg("--bursts", 200), arg("--burst-size", 16))
+    print("bursts:           %d sent, %d received" % (result["sent"], result["received"]))
+    print("latency p50:      %8.3f ms" % (result["p50"] * 1000))
+    print("latency p99:      %8.3f ms" % (result["p99"] * 1000))
+    print("latency max:      %8.3f ms" % (result["max"] * 1000))
+    print("jitter:           %8.3f ms" % (result["jitter"] * 1000))
+
+    sustained = 0
+    for rate in rates:
+        result = paced(source, sink, rate)
+        ok = result["received"] == result["sent"] and result["p99"] <= max_p99
+        print("rate %6d ev/s:  %6d/%d received, p99 %8.3f ms%s" % (rate, result["received"], result["sent"], result["p99"] * 1000, "" if ok else "  NOT SUSTAINED"))
+        if not ok:
+            break
+        sustained = rate
+
+    print("max sustained:    %d ev/s" % sustained)
+
+    if lib_midi.processor is not None:
+        print("processor:        " + str(lib_midi.processor.stats()))
+
+    sink.running = False
+    sink.thread.join()
+    for client in (source, sink):
+        client.seq.close()
+
+    if configured is None:
+        del lib_midi.settings["routes"]
+    else:
+        lib_midi.settings["routes"] = configured
+    lib_midi.midi(router)
+    router.close()
+
+main()
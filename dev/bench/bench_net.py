@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_net.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Network MIDI transport check with two instances on localhost
+
+Starts two lib_net transports ("Box A" and "Box B") on free UDP ports, lets
+them find each other (static peers, or multicast discovery with --discovery)
+and sends note messages from A to B at a steady rate. --loss drops that
+fraction of A's data packets to exercise the journal.
+
+Reports the discovery time, B's clock offset / round trip estimates of A,
+messages delivered in order, recovered and lost, and the end to end latency
+(send to play out, including the jitter buffer).
+
+No ALSA sequencer or MIDI hardware needed.
+
+Usage: python3 dev/bench/bench_net.py [--count N] [--rate N] [--loss F] [--buffer-ms MS] [--discovery]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import os
+import random
+import socket
+import sys
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+import lib
+import lib_net
+from cli import arg, flag, parse
+
+class Lossy(lib_net.Transport):
+    """
+    Transport dropping a fraction of its outgoing data packets.
+    """
+
+    loss = 0.0
+    dropped = 0
+
+    def send_packet(self, data, addr):
+        if data[3] == lib_net.DATA and random.random() < self.loss:
+            self.dropped += 1
+            return
+        super().send_packet(data, addr)
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def main():
+    parse(__doc__, ("--count", "--rate", "--loss", "--buffer-ms"), ("--discovery",))
+    count = arg("--count", 2000)
+    rate = arg("--rate", 1000)
+    discovery = flag("--discovery")
+    lib.file_log = "/tmp/midi-bench-log.txt"
+
+    port_a = free_port()
+    port_b = free_port()
+    a = Lossy("Box A", port=port_a, peers=[] if discovery else ["127.0.0.1:" + str(port_b)], buffer_ms=arg("--buffer-ms", 5), discovery=discovery)
+    b = lib_net.Transport("Box B", port=port_b, peers=[] if discovery else ["127.0.0.1:" + str(port_a)], buffer_ms=arg("--buffer-ms", 5), discovery=discovery)
+    a.loss = arg("--loss", 0.0)
+
+    received = []
+    b.callback = lambda midi, peer: received.append((int.from_bytes(midi[3:7], "big"), time.monotonic()))
+
+    started = time.monotonic()
+    a.start()
+    b.start()
+    while not (a.peers and b.peers and all(peer.pings >= 4 for peer in b.peers.values())):
+        if time.monotonic() - started > 10:
+            print("peers not found (discovery " + ("on" if discovery else "off") + ")")
+            sys.exit(1)
+        time.sleep(0.01)
+    print("discovery:        %8.1f ms (%s)" % ((time.monotonic() - started) * 1000, "multicast" if discovery else "static peers"))
+
+    # Note on with the message index in a sysex-free, 3 byte aligned payload
+    sent = []
+    begin = time.monotonic()
+    for index in range(count):
+        due = begin + index / rate
+        while time.monotonic() < due:
+            time.sleep(0.0002)
+        sent.append(time.monotonic())
+        a.send(bytes([0x90, 60, 100]) + index.to_bytes(4, "big"))
+
+    deadline = time.monotonic() + 2
+    while len(received) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    stats = b.stats()["peers"][0]
+    order = [index for index, at in received]
+    latencies = [at - sent[index] for index, at in received]
+
+    print("clock offset:     %8.3f ms" % stats["offset_ms"])
+    print("round trip:       %8.3f ms" % stats["rtt_ms"])
+    print("jitter:           %8.3f ms" % stats["jitter_ms"])
+    print("sent:             %8d (%d packets dropped)" % (count, a.dropped))
+    print("delivered:        %8d (%s)" % (len(received), "in order" if order == sorted(order) else "OUT OF ORDER"))
+    print("recovered:        %8d" % stats["recovered"])
+    print("lost:             %8d" % (count - len(set(order))))
+    print("late:             %8d" % stats["late"])
+    print("latency p50:      %8.3f ms" % (percentile(latencies, 0.5) * 1000))
+    print("latency p99:      %8.3f ms" % (percentile(latencies, 0.99) * 1000))
+    print("latency max:      %8.3f ms" % (max(latencies, default=0) * 1000))
+
+    a.stop()
+    b.stop()
+
+main()
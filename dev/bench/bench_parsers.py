@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_parsers.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Throughput of the tool output parsers (bin/lib_parse.py)
+
+Times parsing `aconnect -i -l` / `aconnect -o -l` output and full audio
+snapshots from `pactl list` output, for the synthetic corpus
+(dev/bench/fixtures/corpus, see check_parsers.py) and generated outputs of 32 to 256 USB devices
+(make_fixtures.py; 128 devices is over 250 modules), best of --repeat runs.
+
+Usage: python3 dev/bench/bench_parsers.py [--repeat N] [count ...]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import glob
+import os
+import sys
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+import make_fixtures
+from cli import arg, parse
+from lib_audio import audio_snapshot_parse
+from lib_midi import Seq
+from lib_parse import aconnect_parse
+
+sink_preference = "alsa_output.platform-bcm2835_audio.analog-stereo"
+
+def best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def parse_aconnect(outputs):
+    graph = {"clients": {}, "cards": {}, "ports": {}, "edges": set()}
+    for output, caps in outputs:
+        aconnect_parse(output, caps, graph)
+    return graph
+
+def row(name, size, unit, seconds):
+    print(name.ljust(44) + ("%d %s" % (size, unit)).rjust(14) + ("%.3f" % (seconds * 1000)).rjust(10) + ("%.0f" % (size / seconds if seconds else 0)).rjust(14))
+
+def main():
+    counts = parse(__doc__, ("--repeat",), positional=None, kind=int) or [32, 128, 256]
+    repeat = arg("--repeat", 50)
+    readable = Seq.CAP_READ | Seq.CAP_SUBS_READ
+    writable = Seq.CAP_WRITE | Seq.CAP_SUBS_WRITE
+
+    print("output".ljust(44) + "size".rjust(14) + "ms".rjust(10) + "per second".rjust(14))
+
+    for path in sorted(glob.glob(cur_dir + "/fixtures/corpus/*.txt")):
+        with open(path, "r") as file:
+            output = file.read()
+        name = os.path.basename(path)
+        if name.startswith("aconnect-"):
+            caps = writable if name.startswith("aconnect-o-") else readable
+            seconds = best(lambda: parse_aconnect([(output, caps)]), repeat)
+            row(name, output.count("\nclient ") + 1, "clients", seconds)
+        else:
+            seconds = best(lambda: audio_snapshot_parse(output, sink_preference), repeat)
+            row(name, output.count("Module #"), "modules", seconds)
+
+    for count in counts:
+        outputs = [(make_fixtures.aconnect_list(count, False), readable), (make_fixtures.aconnect_list(count, True), writable)]
+        seconds = best(lambda: parse_aconnect(outputs), repeat)
+        row("aconnect -i -l, -o -l (%d devices)" % count, len(parse_aconnect(outputs)["clients"]), "clients", seconds)
+
+        output = make_fixtures.pactl_list(count)
+        seconds = best(lambda: audio_snapshot_parse(output, sink_preference), repeat)
+        row("pactl list snapshot (%d devices)" % count, output.count("Module #"), "modules", seconds)
+
+main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_soak.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Hotplug stress / soak test against a simulated device topology
+
+Simulates a box with a pool of USB devices (each MIDI and audio capable) that
+are plugged in and out in randomized bursts. The aconnect / pactl stand-ins
+(dev/bench/standins) list the simulated topology and an in-process PulseAudio
+CLI stand-in (fake_pulse.py) keeps the modules loaded, so loopbacks that are
+never unloaded add up like on a real server.
+
+The routing and audio code runs as in the daemon: every change pokes the MIDI
+and audio Coalescers (shorter quiet / limit times than the daemon's, see
+--quiet and --limit), whose passes call midi() and audio().
+
+Every --report seconds prints, for the bursts since the last report:
+
+* settle p50 / p95 / p99 / max: last change of a burst to MIDI connections and
+  loopbacks matching the topology
+* midi / audio pass p95: reconcile pass durations
+* spawns per burst, RSS (and growth since the start), open fds, threads, log size
+* loopback modules loaded and leftover (more than the plugged inputs need)
+
+Exits with 1 if a burst did not settle within --timeout, a pass failed or
+loopbacks are left over at the end. --keep-loopbacks simulates a server that
+does not unload a loopback when its source or sink goes away.
+
+Usage: python3 dev/bench/bench_soak.py [--duration S] [--pool N] [--burst N] [--gap S] [--pause S]
+    [--quiet S] [--limit S] [--timeout S] [--report S] [--seed N] [--delay S] [--keep-loopbacks]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+from cli import arg, flag, parse
+
+# Before the work directory is made (--help and bad arguments exit here)
+parse(__doc__, ("--duration", "--pool", "--burst", "--gap", "--pause", "--quiet", "--limit", "--timeout", "--report", "--seed", "--delay"), ("--keep-loopbacks",))
+
+work = tempfile.mkdtemp(prefix="midi-soak-")
+
+os.environ["MIDIPIPES_TOOLS"] = cur_dir + "/standins"
+os.environ["MIDIPIPES_FIXTURES"] = work
+os.environ["MIDIPIPES_DEVICES"] = "soak"
+os.environ["MIDIPIPES_STATE"] = work + "/aconnect-state.txt"
+
+import lib
+import lib_midi
+import lib_audio
+import make_fixtures
+from fake_pulse import FakePulse, serve
+from lib_parse import module_args
+
+output = "alsa_output.platform-bcm2835_audio.analog-stereo" # Default sink_preference
+
+spawns = 0
+popen_init = subprocess.Popen.__init__
+
+def counting_init(self, *args, **kwargs):
+    global spawns
+    spawns += 1
+    popen_init(self, *args, **kwargs)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+def write(path, text):
+    with open(path + ".tmp", "w") as file:
+        file.write(text)
+    os.replace(path + ".tmp", path)
+
+class Box(FakePulse):
+    """
+    Simulated topology: the PulseAudio server state (see FakePulse) and the USB
+    devices plugged in, with the listings the stand-ins serve kept in step.
+
+    As on a real box, ALSA card numbers are reused lowest first (MIDI client
+    16 + 4 * card) while PulseAudio indexes never are, and unplugging a device
+    drops its MIDI connections and (unless keep_loopbacks) the loopbacks on
+    its sink or source.
+    """
+
+    def __init__(self, pool, keep_loopbacks=False):
+        write(work + "/pactl-list-soak.txt", "")
+        super().__init__(work + "/pactl-list-soak.txt")
+
+        self.pool = make_fixtures.devices(pool)
+        self.keep_loopbacks = keep_loopbacks
+        self.plugged = {} # Name -> {"card", "client", "module", "sink", "monitor", "source"}
+        self.info = {} # (type, index) -> (description, module, card, bus path, monitor of)
+        self.index = {"sink": 0, "source": 0}
+        self.next_module = 0
+
+        with self.lock:
+            for name in ("module-device-restore", "module-stream-restore", "module-card-restore", "module-udev-detect", "module-native-protocol-unix", "module-suspend-on-idle"):
+                self.load(name, "")
+            self.builtin = self.add_card(0, "platform-bcm2835_audio", "Built-in Audio", "platform-bcm2835_audio", False)
+            self.default["sink"] = output
+            self.render()
+
+    def load(self, name, argument):
+        self.modules[self.next_module] = (name, argument)
+        self.next_module += 1
+        return self.next_module - 1
+
+    def add(self, type, name, description, module, card, bus, monitor_of=None):
+        index = self.index[type]
+        self.index[type] += 1
+        self.devices[type][index] = {"name": name, "vol": 100 if monitor_of is not None else random.randrange(40, 100)}
+        self.info[(type, index)] = (description, module, card, bus, monitor_of)
+        return index
+
+    def add_card(self, card, id, description, bus, input=True):
+        entry = {"card": card, "client": 16 + 4 * card, "description": description}
+        entry["module"] = self.load("module-alsa-card", 'device_id="' + str(card) + '" name="' + id + '" card_name="alsa_card.' + id + '" namereg_fail=false tsched=no')
+        entry["sink"] = self.add("sink", "alsa_output." + id + ".analog-stereo", description + " Analog Stereo", entry["module"], card, bus)
+        entry["monitor"] = self.add("source", "alsa_output." + id + ".analog-stereo.monitor", "Monitor of " + description + " Analog Stereo", entry["module"], card, bus, entry["sink"])
+        if input:
+            entry["source"] = self.add("source", "alsa_input." + id + ".analog-stereo", description + " Analog Stereo", entry["module"], card, bus)
+        return entry
+
+    def toggle(self, name):
+        """
+        Plugs a device in if it is not, unplugs it otherwise.
+        """
+        with self.lock:
+            if name in self.plugged:
+                self.unplug(name)
+            else:
+                self.plug(name)
+            self.render()
+
+    def plug(self, name):
+        cards = {entry["card"] for entry in self.plugged.values()}
+        card = min(set(range(1, len(self.pool) + 2)) - cards)
+        bus = "platform-fd500000.pcie-pci-0000:01:00.0-usb-0:1." + str(self.pool.index(name) + 1) + ":1.0"
+        self.plugged[name] = self.add_card(card, "usb-" + name + "-00", name.replace("_", " "), bus)
+
+    def unplug(self, name):
+        entry = self.plugged.pop(name)
+        gone = set()
+        for type, key in (("sink", "sink"), ("source", "monitor"), ("source", "source")):
+            gone.add((type, str(entry[key])))
+            gone.add((type, self.devices[type].pop(entry[key])["name"]))
+            del self.info[(type, entry[key])]
+        del self.modules[entry["module"]]
+
+        if not self.keep_loopbacks:
+            for index, (module, argument) in list(self.modules.items()):
+                args = module_args(argument)
+                if module == "module-loopback" and (("source", args.get("source")) in gone or ("sink", args.get("sink")) in gone):
+                    del self.modules[index]
+
+        # The kernel drops the subscriptions of a client that goes away
+        client = str(entry["client"]) + ":"
+        with open(os.environ["MIDIPIPES_STATE"], "a+") as file:
+            file.seek(0)
+            edges = [line for line in file if not any(address.startswith(client) for address in line.split())]
+        write(os.environ["MIDIPIPES_STATE"], "".join(edges))
+
+    def render(self):
+        """
+        Writes the listings served by the stand-ins (`pactl list`, `aconnect -i -l` / `-o -l`).
+        """
+        out = "".join(make_fixtures.pactl_module(index, name, argument) for index, (name, argument) in sorted(self.modules.items()))
+        for type, render in (("sink", make_fixtures.pactl_sink), ("source", make_fixtures.pactl_source)):
+            for index, values in sorted(self.devices[type].items()):
+                description, module, card, bus, monitor_of = self.info[(type, index)]
+                args = (index, values["name"], description, module, card, values["vol"], bus)
+                out += render(*args) if type == "sink" else render(*args, monitor_of)
+        write(work + "/pactl-list-soak.txt", out)
+
+        clients = "client 14: 'Midi Through' [type=kernel]\n    0 'Midi Through Port-0'\n"
+        for entry in sorted(self.plugged.values(), key=lambda entry: entry["client"]):
+            clients += "client %d: '%s' [type=kernel,card=%d]\n    0 '%s MIDI 1'\n" % (entry["client"], entry["description"], entry["card"], entry["description"])
+        write(work + "/aconnect-i-soak.txt", "client 0: 'System' [type=kernel]\n    0 'Timer           '\n    1 'Announce        '\n" + clients)
+        write(work + "/aconnect-o-soak.txt", clients)
+
+    def execute(self, line):
+        cmd, _, args = line.strip().partition(" ")
+
+        if cmd == "load-module":
+            name, _, argument = args.partition(" ")
+            with self.lock:
+                if name == "module-loopback":
+                    args = module_args(argument)
+                    if self.find("source", args.get("source", "")) is None or self.find("sink", args.get("sink", "")) is None:
+                        return "Module load failed.\n" # Device gone
+                self.load(name, argument)
+                self.render()
+            return ""
+
+        out = super().execute(line)
+        if cmd in ("unload-module", "set-sink-volume", "set-source-volume"):
+            with self.lock:
+                self.render()
+        return out
+
+    def resolve(self, type, device):
+        for index, values in self.devices[type].items():
+            if str(index) == device or values["name"] == device:
+                return str(index)
+        return None # Gone
+
+    def check(self):
+        """
+        Compares the MIDI connections and loopbacks with what the topology needs.
+
+        Returns:
+            tuple: (settled, loopbacks loaded, loopbacks left over).
+        """
+        with self.lock:
+            caps = lib_midi.Seq.CAP_READ | lib_midi.Seq.CAP_SUBS_READ | lib_midi.Seq.CAP_WRITE | lib_midi.Seq.CAP_SUBS_WRITE
+            graph = {"clients": {}, "cards": {}, "ports": {}, "edges": set(), "managed": set()}
+            for entry in self.plugged.values():
+                graph["clients"][entry["client"]] = entry["description"]
+                graph["cards"][entry["client"]] = entry["card"]
+                graph["ports"][(entry["client"], 0)] = caps
+                graph["managed"].add(entry["client"])
+
+            wanted = sorted((str(entry["source"]), str(self.builtin["sink"])) for entry in self.plugged.values())
+            loopbacks = []
+            for name, argument in self.modules.values():
+                if name == "module-loopback":
+                    args = module_args(argument)
+                    loopbacks.append((self.resolve("source", args.get("source", "")), self.resolve("sink", args.get("sink", ""))))
+
+        edges = set()
+        with open(os.environ["MIDIPIPES_STATE"], "a+") as file:
+            file.seek(0)
+            for line in file:
+                src, dst = (tuple(int(part) for part in address.split(":")) for address in line.split())
+                edges.add((src, dst))
+
+        leftover = list(loopbacks)
+        for pipe in wanted:
+            if pipe in leftover:
+                leftover.remove(pipe)
+
+        # Loopbacks on devices that are gone are unloaded by the reconcile too, settled
+        # means exactly the loopbacks the plugged inputs need
+        settled = edges == lib_midi.midi_wanted(graph) and not leftover and len(loopbacks) == len(wanted)
+        return settled, len(loopbacks), len(leftover)
+
+def usage():
+    """
+    Returns (RSS KB, open fds, threads, log KB) of this process.
+    """
+    rss = 0
+    with open("/proc/self/status", "r") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+
+    log = sum(os.path.getsize(path) for path in (lib.file_log, lib.file_log + ".1") if os.path.exists(path))
+    return rss, len(os.listdir("/proc/self/fd")), threading.active_count(), log / 1024
+
+def main():
+    duration = arg("--duration", 60.0)
+    burst = arg("--burst", 6)
+    gap = arg("--gap", 0.02)
+    pause = arg("--pause", 0.2)
+    quiet = arg("--quiet", 0.05)
+    limit = arg("--limit", 0.5)
+    timeout = arg("--timeout", 10.0)
+    report = arg("--report", 10.0)
+    random.seed(arg("--seed", 1))
+    if arg("--delay", 0.0):
+        os.environ["MIDIPIPES_DELAY"] = str(arg("--delay", 0.0))
+
+    # Keep the soak away from the real runtime files, no sequencer, PulseAudio is the simulated box
+    lib.file_log = work + "/log.txt"
+    lib.file_lock = work + "/lock.txt"
+    lib.file_settings = work + "/settings.json"
+    lib.file_settings_persistent = None
+    lib_audio.file_pulse_cli = work + "/pulse.sock"
+    lib_midi.seq_open = lambda name="MIDI Pipes": None
+
+    box = Box(arg("--pool", 20), flag("--keep-loopbacks"))
+    server = serve(lib_audio.file_pulse_cli, None, box)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        soak(box, duration, burst, gap, pause, quiet, limit, timeout, report)
+    finally:
+        subprocess.Popen.__init__ = popen_init
+        server.shutdown()
+        shutil.rmtree(work, ignore_errors=True)
+
+def soak(box, duration, burst, gap, pause, quiet, limit, timeout, report):
+    passes = {"midi": [], "audio": []}
+    errors = []
+
+    def reconciler(kind, func):
+        def reconcile(count):
+            started = time.monotonic()
+            try:
+                func()
+            except Exception as e:
+                errors.append(kind + ": " + repr(e))
+                raise
+            finally:
+                passes[kind].append(time.monotonic() - started)
+        reconcile.__name__ = "reconcile_" + kind
+        return reconcile
+
+    midi_pass = lib.Coalescer(reconciler("midi", lib_midi.midi), quiet, limit)
+    audio_pass = lib.Coalescer(reconciler("audio", lib_audio.audio), quiet, limit)
+
+    subprocess.Popen.__init__ = counting_init
+
+    print("time s".rjust(7) + "bursts".rjust(7) + "plugged".rjust(8) + "p50 ms".rjust(8) + "p95 ms".rjust(8) + "p99 ms".rjust(8) + "max ms".rjust(8)
+        + "midi p95".rjust(9) + "audio p95".rjust(10) + "spawns".rjust(8) + "RSS KB".rjust(8) + "growth".rjust(8) + "fds".rjust(5) + "thr".rjust(5)
+        + "log KB".rjust(8) + "loops".rjust(6) + "left".rjust(5))
+
+    rss_start = usage()[0]
+    started = time.monotonic()
+    reported = started
+    settles = []
+    interval = []
+    interval_passes = {"midi": 0, "audio": 0}
+    interval_spawns = 0
+    stuck = 0
+    bursts = 0
+
+    def row(now, settles, midi, audio, spawned, count):
+        rss, fds, threads, log = usage()
+        settled, loaded, leftover = box.check()
+        print(("%.0f" % (now - started)).rjust(7) + str(count).rjust(7) + str(len(box.plugged)).rjust(8)
+            + "".join(("%.1f" % (value * 1000)).rjust(8) for value in (percentile(settles, 0.5), percentile(settles, 0.95), percentile(settles, 0.99), max(settles, default=0)))
+            + ("%.1f" % (percentile(midi, 0.95) * 1000)).rjust(9) + ("%.1f" % (percentile(audio, 0.95) * 1000)).rjust(10)
+            + ("%.1f" % (spawned / max(count, 1))).rjust(8) + str(rss).rjust(8) + ("%+d" % (rss - rss_start)).rjust(8) + str(fds).rjust(5) + str(threads).rjust(5)
+            + ("%.0f" % log).rjust(8) + str(loaded).rjust(6) + str(leftover).rjust(5))
+        return leftover
+
+    while time.monotonic() - started < duration:
+        for _ in range(random.randint(1, burst)):
+            with lib.lock(): # Changes land between passes (the stand-ins can't fail like a device vanishing mid-pass)
+                box.toggle(random.choice(box.pool))
+            lib.state.invalidate("midi", "audio")
+            midi_pass.poke()
+            audio_pass.poke()
+            time.sleep(random.uniform(0, gap))
+
+        last = time.monotonic()
+        while not box.check()[0]:
+            if time.monotonic() - last > timeout:
+                stuck += 1
+                break
+            time.sleep(0.005)
+        else:
+            interval.append(time.monotonic() - last)
+        bursts += 1
+
+        now = time.monotonic()
+        if now - reported >= report:
+            midi = passes["midi"][interval_passes["midi"]:]
+            audio = passes["audio"][interval_passes["audio"]:]
+            row(now, interval, midi, audio, spawns - interval_spawns, len(interval))
+            settles += interval
+            interval = []
+            interval_passes = {kind: len(values) for kind, values in passes.items()}
+            interval_spawns = spawns
+            reported = now
+
+        time.sleep(random.uniform(0, pause))
+
+    settles += interval
+    time.sleep(quiet + limit + 0.5) # Last passes
+    print("all:")
+    leftover = row(time.monotonic(), settles, passes["midi"], passes["audio"], spawns, bursts)
+    print("%d bursts, %d MIDI / %d audio passes, %d not settled within %.0fs, %d failed passes, %d spawns" % (bursts, len(passes["midi"]), len(passes["audio"]), stuck, timeout, len(errors), spawns))
+    for error in errors[:5]:
+        print("  " + error)
+
+    if stuck or errors or leftover:
+        sys.exit(1)
+
+main()
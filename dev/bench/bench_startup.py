@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_startup.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Startup (import time) benchmark for each entry point's library module
+
+Runs `python -X importtime` for each module, reports the cumulative import
+time and fails (exit code 1) if a module pulls in display libraries it does
+not need or goes over its time budget.
+
+Usage: python3 dev/bench/bench_startup.py [--budget-scale N]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import os
+import re
+import subprocess
+import sys
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+bin_dir = os.path.abspath(cur_dir + "/../../bin")
+
+from cli import arg, parse
+
+heavy = ["inky", "PIL", "font_source_sans_pro", "qrcode", "psutil", "numpy"]
+
+# Entry point (script) -> library module it imports and cumulative budget in ms (Pi Zero class hardware)
+entry_points = {
+    "midi.py": ("lib_midi", 250),
+    "audio.py": ("lib_audio", 250),
+    "display.py": ("lib_display", 300),
+    "web.py": ("lib_web", 400),
+    "midipipes.py": ("lib_web", 400),
+}
+
+def importtime(module):
+    """
+    Returns (cumulative us of the module, set of top level packages imported).
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=bin_dir, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+
+    cumulative = 0
+    imported = set()
+
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)', line)
+        if match:
+            imported.add(match.group(4).split(".")[0])
+            if match.group(4) == module:
+                cumulative = int(match.group(2))
+
+    return cumulative, imported
+
+def main():
+    parse(__doc__, ("--budget-scale",))
+    scale = arg("--budget-scale", 1.0)
+
+    failed = False
+    print("entry point".ljust(14) + "module".ljust(14) + "import ms".rjust(11) + "budget ms".rjust(11) + "  heavy imports")
+
+    for entry, (module, budget) in entry_points.items():
+        cumulative, imported = importtime(module)
+        loaded = [name for name in heavy if name in imported]
+        over = cumulative / 1000 > budget * scale
+
+        print(entry.ljust(14) + module.ljust(14) + ("%.1f" % (cumulative / 1000)).rjust(11) + ("%.0f" % (budget * scale)).rjust(11) + "  " + (", ".join(loaded) or "-") + ("  OVER BUDGET" if over else ""))
+
+        if loaded or over:
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+check_lib.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Checks of the lib functions that run without MIDI / audio hardware
+
+* routing rules: the examples in README.MD pass routes_check() (and compile
+  into processed routes), malformed rules and process options are refused
+  with ValueError
+* devices: sinks of one card (different profiles) keep stable ids of their
+  own, an unchanged set of devices adds / removes none
+* metrics: the /metrics text is grouped in one block per family and reads
+  back with the Prometheus parser (prometheus_client, from the wheel in bin/
+  if it is not installed)
+* network MIDI: MIDI larger than a datagram (SysEx) arrives whole between
+  two transports on localhost, every datagram fits the MTU, chunks are cut
+  at message boundaries
+* web interface: requests with malformed parameters get a 400 (a local
+  server on the stand-in tools of dev/bench/standins), nothing they carry
+  reaches a shell
+
+Prints one line per check and exits with 1 if any fails.
+
+Usage: python3 dev/bench/check_lib.py
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import http.client
+import glob
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+os.environ["MIDIPIPES_TOOLS"] = cur_dir + "/standins"
+os.environ["MIDIPIPES_STATE"] = "/tmp/midi-bench-aconnect.txt"
+
+import cli
+import lib
+import lib_audio
+import lib_devices
+import lib_midi
+import lib_net
+import lib_web
+
+failures = 0
+
+def check(name, result, expected):
+    global failures
+    if result == expected:
+        print("ok    " + name)
+    else:
+        failures += 1
+        print("FAIL  " + name)
+        print("      expected: " + repr(expected))
+        print("      got:      " + repr(result))
+
+def raises(function, *args):
+    """
+    Returns the name of the exception function(*args) raises (None if it returns).
+    """
+    try:
+        function(*args)
+    except Exception as e:
+        return type(e).__name__
+    return None
+
+def readme_rules():
+    """
+    Returns the routing rules of the JSON examples in README.MD.
+    """
+    with open(cur_dir + "/../../README.MD", "r") as file:
+        blocks = re.findall(r"```json\n(.*?)```", file.read(), re.S)
+    rules = []
+    for block in blocks:
+        value = json.loads(block)
+        rules += value if isinstance(value, list) else [value]
+    return rules
+
+def check_routes():
+    rules = readme_rules()
+    processed = [rule for rule in rules if "process" in rule]
+    check("README routing examples found", len(rules) > 1 and len(processed) > 0, True)
+    check("README routing examples valid", raises(lib_midi.routes_check, rules), None)
+    for rule in processed:
+        check("README process example valid", raises(lib_midi.process_check, rule["process"]), None)
+        route = lib_midi._Route((20, 0), rule["process"])
+        check("README process example compiles", (route.allow[lib_midi.Processor.TYPES["sysex"][0]], route.channels[0], route.divide), (0, 9, 2))
+
+    check("process without drop", raises(lib_midi.process_check, {"rate": 100}), None)
+    check("process with empty drop", raises(lib_midi.process_check, {"drop": []}), None)
+    for name, options in (
+        ("drop not a list", {"drop": "clock"}),
+        ("unknown drop type", {"drop": ["noise"]}),
+        ("unhashable drop type", {"drop": [["clock"]]}),
+        ("channels not a dict", {"channels": [1, 10]}),
+        ("channel out of range", {"channels": {"17": 1}}),
+        ("channel not a number", {"channels": {"²": 1}}),
+        ("channel mapped to a bool", {"channels": {"1": True}}),
+        ("negative rate", {"rate": -1}),
+        ("unknown option", {"transpose": 12}),
+    ):
+        check("process refuses " + name, raises(lib_midi.process_check, options), "ValueError")
+        check("routes refuse " + name, raises(lib_midi.routes_check, [{"from": "*", "to": "*", "process": options}]), "ValueError")
+
+    check("routes refuse bool port", raises(lib_midi.routes_check, [{"from": "*", "to": "*", "to_port": True}]), "ValueError")
+
+def get(server, path):
+    """
+    Returns the status and body of a GET request to the local server (None if
+    it dropped the connection).
+    """
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%d%s" % (server.server_address[1], path), timeout=10) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+    except (OSError, http.client.HTTPException):
+        return None, ""
+
+def check_devices():
+    index = lib_devices.Devices()
+    sinks = {1: "alsa_output.usb-MOTU_M4_M4MA0000-00.pro-output-0", 2: "alsa_output.usb-MOTU_M4_M4MA0000-00.pro-output-1",
+        3: "alsa_output.pci-0000_00_1f.3.analog-stereo", 4: "alsa_output.pci-0000_00_1f.3.iec958-stereo"}
+    identify = lambda handle, name: lib_devices.pulse_key(name)
+    added, removed = index.update("sink", sinks, identify)
+    check("sinks of one card get ids of their own", (len(added), len(set(added)), removed), (4, 4, []))
+    check("unchanged sinks keep their ids", index.update("sink", dict(sinks), identify), ([], []))
+
+def check_metrics():
+    metrics = lib.Metrics()
+    metrics.count("http_streams", path="/events")
+    metrics.observe("pass", 0.1, name="midi")
+    metrics.observe("pass", 0.3, name="audio")
+    metrics.observe("http", 0.2, path="/")
+    metrics.gauges.append(lambda: [("queue", {"kind": "midi"}, 3)])
+    metrics.gauges.append(lambda: [("peers", {}, 1), ("queue", {"kind": "audio"}, 4)])
+    text = metrics.prometheus()
+
+    family = None
+    typed = []
+    grouped = True
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            family = line.split()[2]
+            typed.append(family)
+        elif family is None or not line.startswith(family) or line[len(family)] not in " {_":
+            grouped = False
+    check("metrics grouped by family", grouped and len(typed) == len(set(typed)), True)
+
+    sys.path += glob.glob(cur_dir + "/../../bin/prometheus_client-*.whl")
+    try:
+        from prometheus_client.parser import text_string_to_metric_families
+    except ImportError:
+        print("skip  metrics parsed by prometheus_client (not available)")
+        return
+
+    families = {family.name: family for family in text_string_to_metric_families(text)}
+    check("metrics summary parsed", sorted((sample.name, sample.labels["name"], sample.value) for sample in families["midipipes_pass_seconds"].samples),
+        [("midipipes_pass_seconds_count", "audio", 1), ("midipipes_pass_seconds_count", "midi", 1), ("midipipes_pass_seconds_sum", "audio", 0.3), ("midipipes_pass_seconds_sum", "midi", 0.1)])
+    check("metrics types parsed", {name: family.type for name, family in families.items()}, {
+        "midipipes_uptime_seconds": "gauge", "midipipes_http_streams": "counter", "midipipes_pass_seconds": "summary", "midipipes_http_seconds": "summary",
+        "midipipes_pass_seconds_max": "gauge", "midipipes_http_seconds_max": "gauge", "midipipes_queue": "gauge", "midipipes_peers": "gauge"})
+
+class Recording(lib_net.Transport):
+    """
+    Transport keeping the sizes of the datagrams it sends.
+    """
+
+    def send_packet(self, data, addr):
+        self.sizes.append(len(data))
+        super().send_packet(data, addr)
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+def check_net():
+    notes = bytes([0x90, 60, 100, 0x80, 60, 0]) * 300
+    check("split keeps messages whole", all(len(chunk) % 3 == 0 for chunk in lib_net.midi_split(notes, 100)), True)
+    check("split into chunks that fit", max(len(chunk) for chunk in lib_net.midi_split(notes, 100)), 99)
+
+    port_a = free_port()
+    port_b = free_port()
+    a = Recording("Box A", port=port_a, peers=["127.0.0.1:" + str(port_b)], discovery=False)
+    b = lib_net.Transport("Box B", port=port_b, peers=["127.0.0.1:" + str(port_a)], discovery=False)
+    a.sizes = []
+    received = []
+    b.callback = lambda midi, peer: received.append(midi)
+    a.start()
+    b.start()
+    deadline = time.monotonic() + 10
+    while not (a.peers and b.peers) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    sysex = bytes([0xF0, 0x7D]) + bytes(index % 128 for index in range(3000)) + bytes([0xF7])
+    midi = bytes([0x90, 60, 100]) + sysex + bytes([0x80, 60, 0])
+    a.send(midi)
+    deadline = time.monotonic() + 2
+    while len(b"".join(received)) < len(midi) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    check("MIDI larger than a datagram arrives whole", b"".join(received) == midi, True)
+    check("datagrams fit the MTU", max(a.sizes) <= lib_net.Transport.MTU, True)
+    a.stop()
+    b.stop()
+    a.close()
+    b.close()
+
+class QuietServer(lib_web.SimpleWebServer):
+    def log_message(self, format, *args):
+        pass
+
+def check_web():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QuietServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    marker = "/tmp/midi-bench-injected.txt"
+    if os.path.exists(marker):
+        os.unlink(marker)
+
+    check("/audio-vols valid change", get(server, "/audio-vols?sink:1=50")[0], 200)
+    for name, query in (
+        ("shell in the device", "sink:1;touch%20" + marker + ";=50"),
+        ("unknown device name", "sink:nonexistent=50"),
+        ("unknown device type", "card:1=50"),
+        ("non-ASCII digit volume", "sink:1=%C2%B2"),
+        ("volume over 100", "sink:1=101"),
+    ):
+        check("/audio-vols refuses " + name, get(server, "/audio-vols?" + query)[0], 400)
+    check("/audio-vol refuses shell in the device", get(server, "/audio-vol?typ=sink&dev=1;touch%20" + marker + ";&vol=50")[0], 400)
+    check("/audio-vol refuses a bad volume", get(server, "/audio-vol?vol=abc")[0], 400)
+    check("/job refuses a bad id", get(server, "/job?id=x")[0], 400)
+    check("/job refuses a missing id", get(server, "/job")[0], 400)
+    check("/job unknown id", get(server, "/job?id=999999")[0], 404)
+    check("/logs tail", get(server, "/logs?tail=2&format=json")[0], 200)
+    check("/logs negative tail", get(server, "/logs?tail=-5&format=json"), (200, "[]"))
+    check("/logs refuses a bad tail", get(server, "/logs?tail=abc")[0], 400)
+    check("/logs-stream refuses a bad tail", get(server, "/logs-stream?tail=abc")[0], 400)
+    time.sleep(1) # Let the mixer apply what was queued
+    check("no shell command injected", os.path.exists(marker), False)
+
+    server.shutdown()
+
+def main():
+    cli.parse(__doc__)
+    # Keep the checks away from the real runtime files, no sequencer or PulseAudio socket
+    lib.file_log = "/tmp/midi-bench-log.txt"
+    lib.file_lock = "/tmp/midi-bench-lock.txt"
+    lib.file_settings = "/tmp/midi-bench-settings.json"
+    lib.file_settings_persistent = None
+    lib_audio.file_pulse_cli = "/tmp/midi-bench-no-pulse.sock"
+    lib_midi.seq_open = lambda name="MIDI Pipes": None
+
+    check_routes()
+    check_devices()
+    check_metrics()
+    check_net()
+    check_web()
+
+    print("%d failure(s)" % failures)
+    sys.exit(1 if failures else 0)
+
+main()
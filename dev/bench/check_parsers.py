@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+check_parsers.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Regression check of the tool output parsers (bin/lib_parse.py) on a synthetic corpus
+
+dev/bench/fixtures/corpus holds synthetic `aconnect -i -l` / `aconnect -o -l`
+and `pactl list` output, written by hand after the formats of different
+versions (alsa-utils 1.2.4 to 1.2.10, PulseAudio 14 and 16, PipeWire's
+pipewire-pulse), with Bluetooth devices and names with quotes. None of it is
+captured from a real system. Next to each file is a regression snapshot of
+the parsed result (.json):
+
+* aconnect-{i,o}-*.txt: the MIDI graph (clients, cards, ports, subscriptions)
+* pactl-*.txt: the audio snapshot (devices, volumes, stable ids, pipes)
+
+The snapshots are written by --update from the current parsers, so they catch
+changes in what the parsers make of the corpus, not formats they never handled
+right: review the diff of an update line by line, and replace a file with a
+real capture (and a hand-checked result) when one is available.
+
+Also checks the argument / volume helpers and that the tools run in the C locale.
+Prints one line per check and exits with 1 if any fails.
+
+Usage: python3 dev/bench/check_parsers.py [--update]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import glob
+import json
+import os
+import sys
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+import cli
+import lib
+from lib_audio import audio_snapshot_parse
+from lib_devices import pulse_key
+from lib_midi import Seq
+from lib_parse import aconnect_parse, module_args, pactl_volume, pulse_cli_volume
+
+sink_preference = "alsa_output.platform-bcm2835_audio.analog-stereo"
+
+failures = 0
+
+def check(name, result, expected):
+    global failures
+    if result == expected:
+        print("ok    " + name)
+    else:
+        failures += 1
+        print("FAIL  " + name)
+        print("      expected: " + json.dumps(expected, sort_keys=True))
+        print("      got:      " + json.dumps(result, sort_keys=True))
+
+def aconnect_result(output, writable):
+    """
+    Returns the graph parsed from aconnect output in JSON form.
+    """
+    graph = {"clients": {}, "cards": {}, "ports": {}, "edges": set()}
+    caps = Seq.CAP_WRITE | Seq.CAP_SUBS_WRITE if writable else Seq.CAP_READ | Seq.CAP_SUBS_READ
+    aconnect_parse(output, caps, graph)
+
+    address = lambda port: "%d:%d" % port
+    return {
+        "clients": {str(client): name for client, name in graph["clients"].items()},
+        "cards": {str(client): card for client, card in graph["cards"].items()},
+        "ports": {address(port): caps for port, caps in sorted(graph["ports"].items())},
+        "edges": sorted([address(src), address(dst)] for src, dst in graph["edges"]),
+    }
+
+def parse(path, output):
+    name = os.path.basename(path)
+    if name.startswith("aconnect-"):
+        return aconnect_result(output, name.startswith("aconnect-o-"))
+    return audio_snapshot_parse(output, sink_preference).as_dict()
+
+def main():
+    cli.parse(__doc__, flags=("--update",))
+    update = cli.flag("--update")
+    lib.file_log = "/tmp/midi-bench-log.txt"
+
+    for path in sorted(glob.glob(cur_dir + "/fixtures/corpus/*.txt")):
+        with open(path, "r") as file:
+            result = parse(path, file.read())
+
+        expected_path = path[:-len(".txt")] + ".json"
+        if update:
+            with open(expected_path, "w") as file:
+                json.dump(result, file, indent=2, sort_keys=True)
+                file.write("\n")
+            print("wrote " + os.path.basename(expected_path))
+            continue
+
+        with open(expected_path, "r") as file:
+            check(os.path.basename(path), json.loads(json.dumps(result)), json.load(file))
+
+    if update:
+        return
+
+    check("module_args plain", module_args("source=2 sink=0 latency_msec=20"), {"source": "2", "sink": "0", "latency_msec": "20"})
+    check("module_args double quotes", module_args('source="Bob\'s Mic" sink=0'), {"source": "Bob's Mic", "sink": "0"})
+    check("module_args single quotes", module_args("sink=0 sink_input_properties='media.name=\"Pipe A\"'"), {"sink": "0", "sink_input_properties": 'media.name="Pipe A"'})
+    check("module_args empty", module_args(""), {})
+    check("pactl_volume PulseAudio", pactl_volume("front-left: 45875 /  70% / -9.29 dB,   front-right: 45875 /  70% / -9.29 dB"), 70)
+    check("pactl_volume PipeWire mono", pactl_volume("mono: 6554 /  10% / -60.00 dB"), 10)
+    check("pactl_volume missing", pactl_volume(""), 0)
+
+    listing = ("2 sink(s) available.\n"
+        "    index: 0\n\tname: <alsa_output.platform-bcm2835_audio.analog-stereo>\n\tvolume: front-left: 65536 / 100% / 0.00 dB\n"
+        "  * index: 3\n\tname: <bluez_sink.00_1B_66_AA_BB_CC.a2dp_sink>\n\tvolume: front-left: 39321 /  60% / -13.31 dB\n")
+    check("pulse_cli_volume by index", pulse_cli_volume(listing, 3), 60)
+    check("pulse_cli_volume by name", pulse_cli_volume(listing, "alsa_output.platform-bcm2835_audio.analog-stereo"), 100)
+    check("pulse_cli_volume missing", pulse_cli_volume(listing, 7), None)
+
+    check("pulse_key USB", pulse_key("alsa_input.usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00.analog-stereo"), "usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00.analog-stereo")
+    check("pulse_key USB monitor", pulse_key("alsa_output.usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00.analog-stereo.monitor"), "usb-Focusrite_Scarlett_2i2_USB_Y8XXXX-00.analog-stereo")
+    check("pulse_key sinks of one card (pro audio)", len({pulse_key("alsa_output.usb-MOTU_M4_M4MA0000-00.pro-output-0"), pulse_key("alsa_output.usb-MOTU_M4_M4MA0000-00.pro-output-1")}), 2)
+    check("pulse_key sinks of one card (profiles)", len({pulse_key("alsa_output.pci-0000_00_1f.3.analog-stereo"), pulse_key("alsa_output.pci-0000_00_1f.3.iec958-stereo")}), 2)
+    check("pulse_key PulseAudio Bluetooth", pulse_key("bluez_sink.00_1B_66_AA_BB_CC.a2dp_sink"), "bt-00:1B:66:AA:BB:CC")
+    check("pulse_key PipeWire Bluetooth", pulse_key("bluez_output.00_1b_66_aa_bb_cc.1"), "bt-00:1B:66:AA:BB:CC")
+
+    os.environ["LANG"] = "de_DE.UTF-8"
+    os.environ["LC_ALL"] = "de_DE.UTF-8"
+    check("tools run in the C locale", lib.shell("echo $LC_ALL").strip(), "C")
+
+    print("%d failure(s)" % failures)
+    sys.exit(1 if failures else 0)
+
+main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cli.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Command line arguments of the benchmarks and checks in dev/bench
+
+Each script declares its options and calls parse() first: --help / -h prints
+the "Usage:" line of its docstring, unknown options, missing or invalid values
+and surplus arguments print it too and exit with 2 (before anything runs).
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import sys
+
+_usage = ""
+_values = {} # Option -> value (str), flag -> True
+
+def usage(error = None):
+    """
+    Prints the usage (and error, if any) and exits, with 2 on an error.
+    """
+    if error is not None:
+        print(error, file=sys.stderr)
+    print(_usage, file=sys.stderr if error is not None else sys.stdout)
+    sys.exit(2 if error is not None else 0)
+
+def parse(doc, options = (), flags = (), positional = 0, kind = str):
+    """
+    Parses sys.argv, exits with the usage on --help or invalid arguments.
+
+    Args:
+        doc (str): The script's docstring (its "Usage:" paragraph is printed).
+        options (tuple): Options taking a value, e.g. "--rounds".
+        flags (tuple): Options without a value, e.g. "--processed".
+        positional (int): Most positional arguments (None for any number).
+        kind (type): Type of the positional arguments.
+
+    Returns:
+        list: The positional arguments.
+    """
+    global _usage
+
+    lines = doc.split("Usage:", 1)[-1].split("\n\n", 1)[0]
+    _usage = "Usage:" + lines.rstrip()
+
+    args = []
+    argv = sys.argv[1:]
+    index = 0
+    while index < len(argv):
+        value = argv[index]
+        index += 1
+        if value in ("--help", "-h"):
+            usage()
+        elif value in options:
+            if index >= len(argv):
+                usage("Missing value for " + value)
+            _values[value] = argv[index]
+            index += 1
+        elif value in flags:
+            _values[value] = True
+        elif value.startswith("-") and value != "-":
+            usage("Unknown option " + value)
+        else:
+            try:
+                args.append(kind(value))
+            except ValueError:
+                usage("Invalid argument " + value)
+
+    if positional is not None and len(args) > positional:
+        usage("Unexpected argument " + str(args[positional]))
+    return args
+
+def arg(name, default):
+    """
+    Returns the value of an option, of the type of its default.
+    """
+    if name not in _values:
+        return default
+    try:
+        return type(default)(_values[name])
+    except ValueError:
+        usage("Invalid value for " + name + ": " + _values[name])
+
+def flag(name):
+    """
+    Returns True if a flag was given.
+    """
+    return name in _values
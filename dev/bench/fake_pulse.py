@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+fake_pulse.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Local stand-in for the PulseAudio CLI protocol socket (module-cli-protocol-unix)
+
+Speaks the subset of the command set used by lib_audio.Pulse, with state loaded from
+a generated `pactl list` fixture (make_fixtures.py). Run with --check to time a round trip of the
+lib_audio.Pulse client against it.
+
+Usage: python3 dev/bench/fake_pulse.py [--check] [socket] [fixture]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import os
+import socketserver
+import sys
+import threading
+import time
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, cur_dir + "/../../bin")
+
+from cli import flag, parse
+from lib_audio import Pulse, pactl_sections, pactl_volume
+
+PROMPT = ">>> "
+
+class FakePulse:
+    """
+    In-memory sinks, sources and modules, manipulated with CLI commands.
+    """
+
+    def __init__(self, fixture):
+        self.lock = threading.Lock()
+        self.devices = {"sink": {}, "source": {}}
+        self.modules = {}
+        self.default = {"sink": "", "source": ""}
+
+        with open(fixture, "r") as file:
+            output = file.read()
+
+        for head, index, fields in pactl_sections(output):
+            if head == "Module":
+                self.modules[int(index)] = (fields.get("Name", ""), fields.get("Argument", ""))
+            elif head in ("Sink", "Source"):
+                type = head.lower()
+                self.devices[type][int(index)] = {"name": fields.get("Name", ""), "vol": pactl_volume(fields.get("Volume", ""))}
+                if not self.default[type]:
+                    self.default[type] = fields.get("Name", "")
+
+    def find(self, type, device):
+        for index, values in self.devices[type].items():
+            if str(index) == device or values["name"] == device:
+                return values
+        return None
+
+    def execute(self, line):
+        cmd, _, args = line.strip().partition(" ")
+
+        with self.lock:
+            if cmd in ("list-sinks", "list-sources"):
+                type = cmd[5:-1]
+                out = str(len(self.devices[type])) + " " + type + "(s) available.\n"
+                for index, values in self.devices[type].items():
+                    raw = round(values["vol"] * Pulse.VOLUME_NORM / 100)
+                    out += "  " + ("*" if values["name"] == self.default[type] else " ") + " index: " + str(index) + "\n"
+                    out += "\tname: <" + values["name"] + ">\n"
+                    out += "\tvolume: front-left: %d / %3d%% / 0.00 dB,   front-right: %d / %3d%% / 0.00 dB\n" % (raw, values["vol"], raw, values["vol"])
+                return out
+
+            if cmd == "list-modules":
+                out = str(len(self.modules)) + " module(s) loaded.\n"
+                for index, (name, argument) in self.modules.items():
+                    out += "    index: " + str(index) + "\n\tname: <" + name + ">\n\targument: <" + argument + ">\n"
+                return out
+
+            if cmd in ("set-sink-volume", "set-source-volume"):
+                device, _, vol = args.partition(" ")
+                values = self.find(cmd[4:-7], device)
+                if values is None:
+                    return "No " + cmd[4:-7] + " found by this name or index.\n"
+                values["vol"] = round(int(vol) * 100 / Pulse.VOLUME_NORM)
+                return ""
+
+            if cmd == "load-module":
+                name, _, argument = args.partition(" ")
+                index = max(self.modules, default=-1) + 1
+                self.modules[index] = (name, argument)
+                return ""
+
+            if cmd == "unload-module":
+                if int(args) not in self.modules:
+                    return "Invalid module index.\n"
+                del self.modules[int(args)]
+                return ""
+
+            if cmd == "set-default-sink":
+                if self.find("sink", args) is None:
+                    return "Sink " + args + " does not exist.\n"
+                self.default["sink"] = self.find("sink", args)["name"]
+                return ""
+
+        return "Unknown command: " + cmd + "\n"
+
+def serve(path, fixture, state=None):
+    state = state or FakePulse(fixture)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(("Welcome to PulseAudio (MIDI Pipes stand-in)! Use \"help\" for usage information.\n" + PROMPT).encode())
+            for line in self.rfile:
+                self.wfile.write((state.execute(line.decode()) + PROMPT).encode())
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    return server
+
+def check(path, fixture):
+    server = serve(path, fixture)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client = Pulse(path)
+    rounds = 1000
+
+    started = time.perf_counter()
+    for i in range(rounds):
+        client.volume("sink", "0", i % 101)
+    elapsed = time.perf_counter() - started
+
+    assert client.volume("sink", "0") == (rounds - 1) % 101
+    assert client.load_module("module-loopback", "source=2 sink=0")
+    assert not client.unload_module(99999)
+
+    print("set-sink-volume: %.1f us per call over one connection" % (elapsed / rounds * 1000000))
+
+    client.close()
+    server.shutdown()
+    os.unlink(path)
+
+def main():
+    args = parse(__doc__, flags=("--check",), positional=2)
+    path = args[0] if len(args) > 0 else "/tmp/midi-fake-pulse.sock"
+    fixture = args[1] if len(args) > 1 else cur_dir + "/fixtures/pactl-list-8.txt"
+
+    if flag("--check"):
+        check(path, fixture)
+    else:
+        serve(path, fixture).serve_forever()
+
+if __name__ == "__main__": # Also imported by bench_soak.py
+    main()
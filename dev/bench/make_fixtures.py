@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+make_fixtures.py: MIDI Pipes - A standalone MIDI processing and routing system
+
+Writes the synthetic tool output fixtures used by the benchmarks
+
+For 1, 8 and 32 USB devices (each one MIDI and audio capable):
+
+* fixtures/pactl-list-N.txt: `pactl list` (Raspberry Pi, PulseAudio 16, loopbacks in place)
+* fixtures/aconnect-i-N.txt: `aconnect -i -l` (readable ports, no connections)
+* fixtures/aconnect-o-N.txt: `aconnect -o -l` (writable ports, no connections)
+
+Usage: python3 dev/bench/make_fixtures.py [count ...]
+
+Copyright (C) 2024 imprecision
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation; either version 3 of the License,
+or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+For more details, see the LICENSE file.
+"""
+
+import math
+import os
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+
+from cli import parse
+
+counts = [1, 8, 32]
+
+usb = [
+    "Focusrite_Scarlett_2i2_USB", "Roland_JD-Xi", "Korg_minilogue_xd", "Arturia_MiniFuse_2",
+    "Behringer_UMC204HD_192k", "Novation_Circuit_Tracks", "Elektron_Digitakt", "Teenage_Engineering_OP-1",
+    "Yamaha_reface_DX", "Native_Instruments_Komplete_Audio_6", "MOTU_M2", "Audient_iD4",
+    "PreSonus_AudioBox_USB_96", "Roland_TR-8S", "Korg_volca_sample", "Arturia_KeyStep_Pro",
+]
+
+def devices(count):
+    names = []
+    for i in range(count):
+        name = usb[i % len(usb)]
+        if i >= len(usb):
+            name += "_" + str(i // len(usb) + 1)
+        names.append(name)
+    return names
+
+def volume(percent):
+    raw = int(65536 * percent / 100)
+    db = "0.00" if percent == 100 else "%.2f" % (20 * math.log10(max(percent, 1) / 100) * 3)
+    return f"front-left: {raw} / {percent:3d}% / {db} dB,   front-right: {raw} / {percent:3d}% / {db} dB\n\t        balance 0.00"
+
+def pactl_module(index, name, argument):
+    description = "Loopback from source to sink" if name == "module-loopback" else "PulseAudio module"
+    return (f"Module #{index}\n\tName: {name}\n\tArgument: {argument}\n\tUsage counter: n/a\n\tProperties:\n"
+        + f'\t\tmodule.author = "Lennart Poettering"\n\t\tmodule.description = "{description}"\n\t\tmodule.version = "16.1"\n\n')
+
+def pactl_sink(index, name, desc, module, card, percent, bus):
+    return f"""Sink #{index}
+\tState: SUSPENDED
+\tName: {name}
+\tDescription: {desc}
+\tDriver: module-alsa-card.c
+\tSample Specification: s16le 2ch 48000Hz
+\tChannel Map: front-left,front-right
+\tOwner Module: {module}
+\tMute: no
+\tVolume: {volume(percent)}
+\tBase Volume: 65536 / 100% / 0.00 dB
+\tMonitor Source: {name}.monitor
+\tLatency: 0 usec, configured 0 usec
+\tFlags: HARDWARE HW_MUTE_CTRL HW_VOLUME_CTRL DECIBEL_VOLUME LATENCY 
+\tProperties:
+\t\talsa.resolution_bits = "16"
+\t\tdevice.api = "alsa"
+\t\tdevice.class = "sound"
+\t\talsa.class = "generic"
+\t\talsa.subclass = "generic-mix"
+\t\talsa.name = "USB Audio"
+\t\talsa.id = "USB Audio"
+\t\talsa.subdevice = "0"
+\t\talsa.subdevice_name = "subdevice #0"
+\t\talsa.device = "0"
+\t\talsa.card = "{card}"
+\t\talsa.card_name = "{desc}"
+\t\tdevice.bus_path = "{bus}"
+\t\tsysfs.path = "/devices/platform/scb/fd500000.pcie/pci0000:00/0000:00:00.0/0000:01:00.0/usb1/{bus.split(':')[-1]}/sound/card{card}"
+\t\tdevice.bus = "usb"
+\t\tdevice.string = "front:{card}"
+\t\tdevice.buffering.buffer_size = "96000"
+\t\tdevice.buffering.fragment_size = "48000"
+\t\tdevice.access_mode = "mmap+timer"
+\t\tdevice.profile.name = "analog-stereo"
+\t\tdevice.profile.description = "Analog Stereo"
+\t\tdevice.description = "{desc}"
+\t\tmodule-udev-detect.discovered = "1"
+\t\tdevice.icon_name = "audio-card-usb"
+\tPorts:
+\t\tanalog-output: Analog Output (type: Analog, priority: 9900, availability unknown)
+\tActive Port: analog-output
+\tFormats:
+\t\tpcm
+
+"""
+
+def pactl_source(index, name, desc, module, card, percent, bus, monitor_of=None):
+    out = f"""Source #{index}
+\tState: {"RUNNING" if monitor_of is None else "SUSPENDED"}
+\tName: {name}
+\tDescription: {desc}
+\tDriver: module-alsa-card.c
+\tSample Specification: s16le 2ch 48000Hz
+\tChannel Map: front-left,front-right
+\tOwner Module: {module}
+\tMute: no
+\tVolume: {volume(percent)}
+\tBase Volume: 65536 / 100% / 0.00 dB
+\tMonitor of Sink: {monitor_of if monitor_of else "n/a"}
+\tLatency: 0 usec, configured 0 usec
+\tFlags: {"DECIBEL_VOLUME LATENCY " if monitor_of else "HARDWARE HW_MUTE_CTRL HW_VOLUME_CTRL DECIBEL_VOLUME LATENCY "}
+\tProperties:
+\t\tdevice.description = "{desc}"
+\t\tdevice.class = "{"monitor" if monitor_of else "sound"}"
+\t\talsa.card = "{card}"
+\t\tdevice.bus_path = "{bus}"
+\t\tdevice.icon_name = "audio-card-usb"
+"""
+    if monitor_of is None:
+        out += "\tPorts:\n\t\tanalog-input: Analog Input (type: Analog, priority: 10000, availability unknown)\n\tActive Port: analog-input\n"
+    return out + "\tFormats:\n\t\tpcm\n\n"
+
+def pactl_list(count):
+    """
+    Returns `pactl list` output: built-in output (sink 0), one sink and input per USB device, each input looped back to sink 0.
+    """
+    names = devices(count)
+    modules = [(0, "module-device-restore", ""), (1, "module-stream-restore", ""), (2, "module-card-restore", ""), (3, "module-udev-detect", "tsched=0"),
+        (4, "module-native-protocol-unix", ""), (5, "module-default-device-restore", ""), (6, "module-always-sink", ""), (7, "module-suspend-on-idle", ""),
+        (8, "module-position-event-sounds", "")]
+    cards = ["platform-bcm2835_audio"] + ["usb-" + name + "-00" for name in names]
+
+    alsa_modules = []
+    for i, card in enumerate(cards):
+        alsa_modules.append(len(modules))
+        modules.append((len(modules), "module-alsa-card", f'device_id="{i}" name="{card}" card_name="alsa_card.{card}" namereg_fail=false tsched=no fixed_latency_range=no ignore_dB=no deferred_volume=yes use_ucm=yes avoid_resampling=no card_properties="module-udev-detect.discovered=1"'))
+    for i in range(count):
+        modules.append((len(modules), "module-loopback", f"source={2 * (i + 1)} sink=0"))
+
+    out = "".join(pactl_module(*module) for module in modules)
+    out += pactl_sink(0, "alsa_output.platform-bcm2835_audio.analog-stereo", "Built-in Audio Analog Stereo", alsa_modules[0], 0, 100, "platform-bcm2835_audio")
+    for i, name in enumerate(names):
+        out += pactl_sink(i + 1, f"alsa_output.usb-{name}-00.analog-stereo", name.replace("_", " ") + " Analog Stereo", alsa_modules[i + 1], i + 1, 60 + (i * 7) % 40, f"platform-fd500000.pcie-pci-0000:01:00.0-usb-0:1.{i + 1}:1.0")
+    out += pactl_source(0, "alsa_output.platform-bcm2835_audio.analog-stereo.monitor", "Monitor of Built-in Audio Analog Stereo", alsa_modules[0], 0, 100, "platform-bcm2835_audio", 0)
+    for i, name in enumerate(names):
+        out += pactl_source(2 * (i + 1) - 1, f"alsa_output.usb-{name}-00.analog-stereo.monitor", f"Monitor of {name.replace('_', ' ')} Analog Stereo", alsa_modules[i + 1], i + 1, 100, f"usb-0:1.{i + 1}:1.0", i + 1)
+        out += pactl_source(2 * (i + 1), f"alsa_input.usb-{name}-00.analog-stereo", name.replace("_", " ") + " Analog Stereo", alsa_modules[i + 1], i + 1, 40 + (i * 11) % 60, f"platform-fd500000.pcie-pci-0000:01:00.0-usb-0:1.{i + 1}:1.0")
+
+    for i in range(count):
+        out += f"""Sink Input #{i}
+\tDriver: module-loopback.c
+\tOwner Module: {modules[-count + i][0]}
+\tClient: n/a
+\tSink: 0
+\tSample Specification: s16le 2ch 48000Hz
+\tChannel Map: front-left,front-right
+\tFormat: pcm, format.sample_format = "\\"s16le\\""  format.rate = "48000"  format.channels = "2"  format.channel_map = "\\"front-left,front-right\\""
+\tCorked: no
+\tMute: no
+\tVolume: {volume(100)}
+\tBuffer Latency: 183446 usec
+\tSink Latency: 95000 usec
+\tResample method: speex-float-1
+\tProperties:
+\t\tmedia.role = "abstract"
+\t\tmedia.name = "Loopback from {names[i].replace('_', ' ')} Analog Stereo"
+
+"""
+
+    for i, card in enumerate(cards):
+        out += f"""Card #{i}
+\tName: alsa_card.{card}
+\tDriver: module-alsa-card.c
+\tOwner Module: {alsa_modules[i]}
+\tProperties:
+\t\talsa.card = "{i}"
+\t\tdevice.description = "{"Built-in Audio" if i == 0 else names[i - 1].replace('_', ' ')}"
+\tProfiles:
+\t\toutput:analog-stereo: Analog Stereo Output (sinks: 1, sources: 0, priority: 6500, available: yes)
+\t\toff: Off (sinks: 0, sources: 0, priority: 0, available: yes)
+\tActive Profile: output:analog-stereo
+\tPorts:
+\t\tanalog-output: Analog Output (type: Analog, priority: 9900, latency offset: 0 usec, availability unknown)
+\t\t\tPart of profile(s): output:analog-stereo
+
+"""
+
+    return out.rstrip("\n") + "\n"
+
+def aconnect_list(count, writable):
+    """
+    Returns `aconnect -i -l` (or `-o -l` if writable) output: System, Midi Through and one client per USB device (client 20 up).
+    """
+    out = ""
+    if not writable:
+        out += "client 0: 'System' [type=kernel]\n    0 'Timer           '\n    1 'Announce        '\n"
+    out += "client 14: 'Midi Through' [type=kernel]\n    0 'Midi Through Port-0'\n"
+    for i, name in enumerate(devices(count)):
+        client = 20 + i
+        name = name.replace("_", " ")
+        out += f"client {client}: '{name}' [type=kernel,card={i + 1}]\n    0 '{name} MIDI 1'\n"
+    return out
+
+def main():
+    for count in parse(__doc__, positional=None, kind=int) or counts:
+        for path, output in (
+            ("/fixtures/pactl-list-%d.txt", pactl_list(count)),
+            ("/fixtures/aconnect-i-%d.txt", aconnect_list(count, False)),
+            ("/fixtures/aconnect-o-%d.txt", aconnect_list(count, True)),
+        ):
+            with open(cur_dir + path % count, "w") as file:
+                file.write(output)
+            print(path % count)
+
+if __name__ == "__main__": # Also imported by bench_parsers.py for larger outputs
+    main()
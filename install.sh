@@ -118,60 +118,64 @@ echo
 echo " 🎹 Installing pip packages for display support..."
 echo
 
-pip3 install --break-system-packages Pillow numpy font_source_sans_pro inky[rpi] qrcode psutil
+pip3 install --break-system-packages Pillow numpy font_source_sans_pro inky[rpi] qrcode
 
 echo
-echo " 🎹 Applying new udev, systemd and pulseaudio configs..."
+echo " 🎹 Removing the udev rules, cron job and services of earlier versions..."
+echo
+
+# Now handled by the midipipes daemon, left in place they would still launch
+# midi.py per udev event, render from cron and hold port 80
+for unit in midipipes-midi midipipes-web
+do
+    systemctl disable --now "$unit.service" 2>/dev/null
+    rm -f "/lib/systemd/system/$unit.service"
+done
+
+rm -f /etc/udev/rules.d/33-midipipes-midiusb.rules /etc/udev/rules.d/44-midipipes-bt.rules
+udevadm control --reload
+
+crontab -l 2>/dev/null | grep -vF "bin/display.py" | crontab -
+
+echo
+echo " 🎹 Applying new systemd and pulseaudio configs..."
 echo
 
-sh -c "sed 's|{MIDIPI_USER}|$current_dir|g' './lib/33-midipipes-midiusb.rules' > '/etc/udev/rules.d/33-midipipes-midiusb.rules'"
-sh -c "sed 's|{MIDIPI_USER}|$current_dir|g' './lib/44-midipipes-bt.rules' > '/etc/udev/rules.d/44-midipipes-bt.rules'"
 sh -c "sed 's|{MIDIPI_USER}|$current_user|g' './lib/midipipes-btmidi.service' > '/lib/systemd/system/midipipes-btmidi.service'"
-sh -c "sed 's|{MIDIPI_USER}|$current_dir|g' './lib/midipipes-midi.service' > '/lib/systemd/system/midipipes-midi.service'"
+sh -c "sed 's|{MIDIPI_USER}|$current_dir|g' './lib/midipipes.service' > '/lib/systemd/system/midipipes.service'"
 sh -c "sed 's|{MIDIPI_USER}|$current_dir|g' './lib/midipipes-pulseaudio.service' > '/lib/systemd/system/midipipes-pulseaudio.service'"
-sh -c "sed 's|{MIDIPI_USER}|$current_dir|g' './lib/midipipes-web.service' > '/lib/systemd/system/midipipes-web.service'"
 
 sh -c "echo 'system-instance = yes' >> /etc/pulse/daemon.conf"
 sh -c "echo 'disallow-module-loading = no' >> /etc/pulse/daemon.conf"
 sh -c "echo 'allow-module-loading = yes' >> /etc/pulse/daemon.conf"
 sh -c "echo 'autospawn = no' >> /etc/pulse/client.conf"
+sh -c "grep -qx 'load-module module-cli-protocol-unix' /etc/pulse/system.pa || echo 'load-module module-cli-protocol-unix' >> /etc/pulse/system.pa" # Once, install.sh also upgrades
 
 echo
-echo " 🎹 Restarting udev and systemd daemons..."
+echo " 🎹 Restarting systemd daemons..."
 echo
 
-udevadm control --reload
-service udev restart
-
 systemctl daemon-reload
 
-systemctl enable midipipes-midi.service
-systemctl start midipipes-midi.service
-
 systemctl enable midipipes-btmidi.service
 systemctl start midipipes-btmidi.service
 
 systemctl enable midipipes-pulseaudio
 systemctl start midipipes-pulseaudio
 
-systemctl enable midipipes-web.service
-systemctl start midipipes-web.service
+systemctl enable midipipes.service
+systemctl start midipipes.service
 
 echo
 echo " 🎹 Ensuring all scripts are executable..."
 echo
 
+chmod +x ./bin/midipipes.py
 chmod +x ./bin/midi.py
 chmod +x ./bin/audio.py
 chmod +x ./bin/display.py
 chmod +x ./bin/web.py
 
-echo
-echo " 🎹 Configuring display updater..."
-echo
-
-crontab -l | { echo "* * * * * /usr/bin/python $current_dir/bin/display.py"; } | crontab -
-
 echo
 echo " 🎹 Setting system to read-only..."
 echo